@@ -1,11 +1,13 @@
 from logging import Logger
 from settingstree import Settings
 import responder
-from starlette.websockets import WebSocketDisconnect, WebSocket, WebSocketState
 from chain import ProcessingChain, WebFunctionDoesNotExistException
+from chain.preview import pack_preview
+from chain.telemetry import negotiate_subprotocol
+from chain.connections import WSConnectionPool, TelemetryConnection, ContextPublisher
 from json.decoder import JSONDecodeError
 from threading import Thread, Lock
-from collections import defaultdict
+from time import perf_counter
 import sys
 import asyncio
 
@@ -13,6 +15,8 @@ log = Logger(__name__)
 settings = Settings()
 responder_api = responder.API()
 
+# Chain elements import their dependencies on activation, so building the chain only costs the construction.
+construction_start = perf_counter()
 PlatformProcessingChain = ProcessingChain.get_platform_specific_chain()
 processing_chain = PlatformProcessingChain(settings)
 
@@ -20,9 +24,29 @@ if not processing_chain:
     log.error('Your platform is currently not supported.')
     sys.exit(1)
 
+settings_load_start = perf_counter()
 # Load settings after chain initialized tree.
 settings.load()
 
+startup_report = {
+    'chain_construction': (settings_load_start - construction_start) * 1000,
+    'settings_load': (perf_counter() - settings_load_start) * 1000,
+}
+log.info(f'Startup took {startup_report["chain_construction"]:.1f}ms for the processing chain and '
+         f'{startup_report["settings_load"]:.1f}ms for loading the settings.')
+
+
+async def send_outputs(data_to_send: dict, previews: dict):
+    """
+    Sends the telemetry of a processed frame to /ws/index (see chain.telemetry) and its previews as binary messages to
+    /ws/ap_image.
+    """
+    if data_to_send:
+        await ws_connection_pool.send_telemetry('/ws/index', data_to_send)
+
+    for preview_type, jpeg in previews.items():
+        await ws_connection_pool.send_bytes('/ws/ap_image', pack_preview(preview_type, jpeg))
+
 
 # TODO: move this somewhere else
 class ProcessingThread(Thread):
@@ -36,6 +60,7 @@ class ProcessingThread(Thread):
 
         self.processing_chain = processing_chain
         self.stopped = False
+        self.publisher = None
 
     @classmethod
     def get_instance(cls, processing_chain: ProcessingChain):
@@ -45,10 +70,15 @@ class ProcessingThread(Thread):
         return cls.instance
 
     def start(self) -> None:
+        """
+        Must be called from within the event loop of the web server, the processed frames get sent on it.
+        """
         # Thread is already running.
         if self.is_alive():
             return
 
+        self.publisher = ContextPublisher(asyncio.get_running_loop(), send_outputs)
+
         with ProcessingThread.lock:
             ProcessingThread.ap_active = True
 
@@ -60,93 +90,90 @@ class ProcessingThread(Thread):
 
     def run(self) -> None:
         try:
+            self.processing_chain.start()
+
             while ProcessingThread.ap_active:
-                result = self.processing_chain.run()
-                # Test: Send message to clients from inside the thread. (Is this even legal?)
+                context = self.processing_chain.run()
+                self.publisher.publish(context)
 
-                for element in result:
-                    # TODO: find format for element
-                    asyncio.run(ws_connection_pool.send_json('/ws/index', element))
+                self.processing_chain.wait_for_next_frame()
         finally:
+            self.processing_chain.stop()
             self.stopped = True
             # TODO: set ap_active to False?
 
 
 # TODO: move this somewhere else
-class WSConnectionPool:
-    def __init__(self):
-        self._connection_pool = defaultdict(list)
+class AsyncProcessingTask:
+    """
+    Runs the processing chain as task on the event loop of the web server (execution mode async). Messages are sent
+    directly on this loop.
+    """
+    instance = None
 
-    def _cleanup_closed_connections(self):
-        for path in self._connection_pool:
-            for ws_conn in self._connection_pool[path]:
-                if ws_conn.client_state == WebSocketState.DISCONNECTED or \
-                        ws_conn.application_state == WebSocketState.DISCONNECTED:
-                    # TODO: maybe we need to close the connection to the client sometimes.
-                    self.remove_connection(ws_conn)
+    def __init__(self, processing_chain: ProcessingChain):
+        self.processing_chain = processing_chain
+        self.active = False
+        self._task = None
 
-    def add_connection(self, ws: WebSocket):
-        if not isinstance(ws, WebSocket):
-            raise TypeError('ws needs to be an instance of starlette.websockets.Websocket.')
+    @classmethod
+    def get_instance(cls, processing_chain: ProcessingChain):
+        if not cls.instance:
+            cls.instance = cls(processing_chain)
 
-        if ws not in self._connection_pool[ws.url.path]:
-            self._connection_pool[ws.url.path].append(ws)
+        return cls.instance
 
-    def remove_connection(self, ws: WebSocket):
-        self._connection_pool[ws.url.path].remove(ws)
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
 
-    async def send_text(self, path_or_websocket, *args, **kwargs):
-        if isinstance(path_or_websocket, WebSocket):
-            path = path_or_websocket.url.path
-        else:
-            path = path_or_websocket
+    def start(self):
+        """
+        Must be called from within the event loop.
+        """
+        self.active = True
 
-        self._cleanup_closed_connections()
+        if not self.is_running():
+            self._task = asyncio.get_running_loop().create_task(self.run())
 
-        for ws_conn in self._connection_pool[path]:
-            try:
-                await ws_conn.send_text(*args, **kwargs)
-            except RuntimeError:
-                # Gets raised when trying to send to an already closed connection.
-                log.exception('')
+    def stop(self):
+        self.active = False
 
-    async def send_bytes(self, path_or_websocket, *args, **kwargs):
-        if isinstance(path_or_websocket, WebSocket):
-            path = path_or_websocket.url.path
-        else:
-            path = path_or_websocket
+    async def run(self):
+        loop = asyncio.get_running_loop()
 
-        self._cleanup_closed_connections()
+        try:
+            # Starting may spawn processes and threads, keep it off the loop.
+            await loop.run_in_executor(None, self.processing_chain.start)
 
-        for ws_conn in self._connection_pool[path]:
-            try:
-                await ws_conn.send_bytes(*args, **kwargs)
-            except RuntimeError:
-                # Gets raised when trying to send to an already closed connection.
-                log.exception('')
+            while self.active:
+                context = await self.processing_chain.run_async()
+                await send_outputs(context.data_to_send, context.previews)
+
+                await self.processing_chain.wait_for_next_frame_async()
+        except Exception:
+            log.exception('Error in processing task.')
+        finally:
+            await loop.run_in_executor(None, self.processing_chain.stop)
+            self.active = False
 
-    async def send_json(self, path_or_websocket, *args, **kwargs):
-        if isinstance(path_or_websocket, WebSocket):
-            path = path_or_websocket.url.path
-        else:
-            path = path_or_websocket
 
-        self._cleanup_closed_connections()
+def get_autopilot_runner():
+    """
+    Returns the ProcessingThread or AsyncProcessingTask, depending on the execution mode of the processing chain.
+    """
+    if processing_chain.is_async():
+        return AsyncProcessingTask.get_instance(processing_chain)
 
-        for ws_conn in self._connection_pool[path]:
-            try:
-                await ws_conn.send_json(*args, **kwargs)
-            except RuntimeError:
-                # Gets raised when trying to send to an already closed connection.
-                log.exception('')
+    return ProcessingThread.get_instance(processing_chain)
 
 
-ws_connection_pool = WSConnectionPool()
+ws_connection_pool = WSConnectionPool(connection_types={'/ws/index': TelemetryConnection})
 
 
 @responder_api.route(before_request=True, websocket=True)
 async def prepare_response(ws):
-    await ws.accept()
+    # Telemetry clients negotiate the encoding with the subprotocol, see chain.telemetry.
+    await ws.accept(subprotocol=negotiate_subprotocol(ws.scope.get('subprotocols', [])))
     # Add connection to connection pool.
     ws_connection_pool.add_connection(ws)
 
@@ -162,33 +189,75 @@ async def page_settings(request, response):
     response.html = responder_api.template('settings.html', form_html=settings_form)
 
 
+@responder_api.route('/api/timings')
+async def timings(request, response):
+    """
+    Returns the timing statistics of the processing chain as json.
+    """
+    response.media = processing_chain.get_timing_stats()
+
+
+@responder_api.route('/api/startup')
+async def startup(request, response):
+    """
+    Returns the startup cost of the server and of every chain element (construction and dependency import) as json.
+    """
+    response.media = dict(startup_report, elements=processing_chain.get_startup_report())
+
+
+@responder_api.route('/api/connections')
+async def connections(request, response):
+    """
+    Returns the websocket connections and their queued, sent and dropped messages by path as json.
+    """
+    response.media = ws_connection_pool.get_stats()
+
+
 @responder_api.route('/ws/index', websocket=True)
 async def index_route(ws):
     """
-    Controls the autopilot. Possible commands are: activate, deactivate
+    Controls the autopilot and streams the telemetry (see chain.telemetry). Possible commands are: activate,
+    deactivate, subscribe (with the list of telemetry fields or null for all fields)
     :param ws:
     :return:
     """
-    while True:
-        received_json = await ws.receive_json()
-        cmd = received_json['cmd']
-
-        # TODO: figure out better way. Maybe use an interface where you can register the commands.
-        if cmd == 'activate':
-            try:
-                ProcessingThread.get_instance(processing_chain).start()
-            except RuntimeError:
-                log.exception('')
-        elif cmd == 'deactivate':
-            try:
-                ProcessingThread.get_instance(processing_chain).stop()
-            except RuntimeError:
-                log.exception('')
+    with ws_connection_pool.connection(ws) as connection:
+        while True:
+            received_json = await ws.receive_json()
+            cmd = received_json['cmd']
+
+            # TODO: figure out better way. Maybe use an interface where you can register the commands.
+            if cmd == 'activate':
+                try:
+                    get_autopilot_runner().start()
+                except RuntimeError:
+                    log.exception('')
+            elif cmd == 'subscribe':
+                if connection is not None:
+                    connection.subscribe(received_json.get('fields'))
+            elif cmd == 'deactivate':
+                # Stop both, the execution mode may have changed since activating.
+                try:
+                    ProcessingThread.get_instance(processing_chain).stop()
+                    AsyncProcessingTask.get_instance(processing_chain).stop()
+                except RuntimeError:
+                    log.exception('')
 
 
 @responder_api.route('/ws/ap_image', websocket=True)
 async def apimage_route(ws):
-    pass
+    """
+    Streams the preview images as binary messages, see chain.preview.pack_preview. The chain only encodes previews
+    while there are clients on this websocket.
+    """
+    processing_chain.preview_scheduler.add_subscriber()
+    try:
+        with ws_connection_pool.connection(ws):
+            # Clients don't send anything, wait for them to disconnect.
+            while True:
+                await ws.receive_text()
+    finally:
+        processing_chain.preview_scheduler.remove_subscriber()
 
 
 @responder_api.route('/ws/settings', websocket=True)
@@ -198,42 +267,43 @@ async def settings_route(ws):
     Sends json with status, fqid, value.
     :param ws: websocket
     """
-    while True:
-        # Try to receive json and catch exception if data is not valid json.
-        try:
-            received_json = await ws.receive_json()
-        except JSONDecodeError:
-            log.exception('Received message is not valid json!')
-            continue
+    with ws_connection_pool.connection(ws):
+        while True:
+            # Try to receive json and catch exception if data is not valid json.
+            try:
+                received_json = await ws.receive_json()
+            except JSONDecodeError:
+                log.exception('Received message is not valid json!')
+                continue
 
-        cmd = received_json['cmd']
-        fqid = received_json['fqid']
-        value = received_json.get('value')
+            cmd = received_json['cmd']
+            fqid = received_json['fqid']
+            value = received_json.get('value')
 
-        response = {'status': 500, 'fqid': fqid, 'value': ''}
+            response = {'status': 500, 'fqid': fqid, 'value': ''}
 
-        try:
-            # Send back the value of fqid.
-            if cmd == 'get':
-                response['status'] = 200
-                response['value'] = settings.root.get_value_of_child(fqid)
-            # Set value of fqid and send it back.
-            elif cmd == 'set':
-                if not value:
-                    raise AttributeError('Value is not set.')
+            try:
+                # Send back the value of fqid.
+                if cmd == 'get':
+                    response['status'] = 200
+                    response['value'] = settings.root.get_value_of_child(fqid)
+                # Set value of fqid and send it back.
+                elif cmd == 'set':
+                    if not value:
+                        raise AttributeError('Value is not set.')
 
-                settings.root.set_value_of_child(fqid, value)
-                response['status'] = 200
-                response['value'] = settings.root.get_value_of_child(fqid)
+                    settings.root.set_value_of_child(fqid, value)
+                    response['status'] = 200
+                    response['value'] = settings.root.get_value_of_child(fqid)
 
-                settings.dump()
-        except Exception as e:
-            log.exception('Error in settings websocket.')
-            response['status'] = 500
-            response['value'] = str(e)
+                    settings.dump()
+            except Exception as e:
+                log.exception('Error in settings websocket.')
+                response['status'] = 500
+                response['value'] = str(e)
 
-        # Send changes to all websocket connections.
-        await ws_connection_pool.send_json(ws, response)
+            # Send changes to all websocket connections.
+            await ws_connection_pool.send_json(ws, response)
 
 
 @responder_api.route('/ws/web_functions', websocket=True)
@@ -242,29 +312,30 @@ async def web_functions_route(ws):
     Websocket endpoint for web functions. Call functions in settings nodes by name. They may also return something.
     :param ws: websocket
     """
-    while True:
-        try:
-            received_json = await ws.receive_json()
-        except JSONDecodeError:
-            log.exception('Received message is not valid json!')
-            continue
+    with ws_connection_pool.connection(ws):
+        while True:
+            try:
+                received_json = await ws.receive_json()
+            except JSONDecodeError:
+                log.exception('Received message is not valid json!')
+                continue
 
-        function_name = received_json['function_name']
-        function_arguments = received_json.get('function_arguments', {})
+            function_name = received_json['function_name']
+            function_arguments = received_json.get('function_arguments', {})
 
-        response = {'status': 500, 'function_name': function_name, 'function_arguments': function_arguments,
-                    'result': None}
+            response = {'status': 500, 'function_name': function_name, 'function_arguments': function_arguments,
+                        'result': None}
 
-        try:
-            function_result = await processing_chain.call_web_function(function_name, function_arguments)
-            response['status'] = 200
-            response['result'] = function_result
-        except WebFunctionDoesNotExistException:
-            response['status'] = 500
-            response['result'] = 'The web function does not exist.'
-        except Exception as e:
-            log.exception('Error in settings websocket.')
-            response['status'] = 500
-            response['result'] = str(e)
-
-        await ws_connection_pool.send_json(ws, response)
+            try:
+                function_result = await processing_chain.call_web_function(function_name, function_arguments)
+                response['status'] = 200
+                response['result'] = function_result
+            except WebFunctionDoesNotExistException:
+                response['status'] = 500
+                response['result'] = 'The web function does not exist.'
+            except Exception as e:
+                log.exception('Error in settings websocket.')
+                response['status'] = 500
+                response['result'] = str(e)
+
+            await ws_connection_pool.send_json(ws, response)
@@ -0,0 +1,5 @@
+"""
+Headless benchmarks for the processing chain. Run them from the python/ directory:
+
+    python -m benchmarks.run --help
+"""
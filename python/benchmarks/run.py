@@ -0,0 +1,161 @@
+"""
+Runs the processing chain on synthetic or recorded frames and reports the timings of every chain element and of the
+whole frame. Results can be stored as baseline and later runs compared against it.
+
+Examples:
+
+    python -m benchmarks.run --save-baseline baseline.json
+    python -m benchmarks.run --baseline baseline.json --tolerance 0.2
+    python -m benchmarks.run --recording recordings/session --no-optimize
+"""
+from argparse import ArgumentParser
+from chain import ProcessingChain, processing, capturing
+from settingstree import Settings
+from benchmarks.standins import SyntheticCapturingDevice, NullController
+import json
+import sys
+
+RESOLUTIONS = {
+    '720p': (1280, 720),
+    '1080p': (1920, 1080),
+    '1440p': (2560, 1440),
+    '4k': (3840, 2160),
+}
+
+
+class BenchmarkChain(ProcessingChain):
+    # Never selected by get_platform_specific_chain.
+    platform = None
+
+    def __init__(self, settings, capturing_device):
+        super().__init__(settings)
+
+        self.register(capturing_device)
+        self.register(processing.ColorConversionPreProcessingUnit.for_pixel_format(capturing_device.get_pixel_format()))
+        self.register(processing.ROIPreProcessingUnit())
+        self.register(processing.GrayscaleConversionPreProcessingUnit())
+        self.register(processing.DownscalePreProcessingUnit())
+        self.register(processing.CVLaneDetectionProcessingUnit())
+        self.register(NullController())
+
+
+def run_benchmark(capturing_device, frames=200, warmup_frames=20, optimize=True, execution_mode='sequential',
+                  previews=False):
+    """
+    Runs the BenchmarkChain and returns its timing statistics.
+    :param previews: Simulate a web ui client, so the elements prepare previews for every frame.
+    """
+    chain = BenchmarkChain(Settings(), capturing_device)
+    chain.optimize.value = '1' if optimize else '0'
+    chain.execution_mode.value = execution_mode
+    if previews:
+        chain.preview_fps.value = '0'
+        chain.preview_scheduler.add_subscriber()
+
+    chain.start()
+    try:
+        for _ in range(warmup_frames):
+            chain.run()
+
+        # Only measure the frames after the warmup.
+        chain.profiler.reset()
+        for _ in range(frames):
+            chain.run()
+    finally:
+        chain.stop()
+
+    return chain.get_timing_stats()
+
+
+def compare_to_baseline(results: dict, baseline: dict, tolerance: float, min_difference=0.05) -> list:
+    """
+    Compares the p50 timings of results and baseline.
+    :param tolerance: Allowed relative slowdown (0.1 = 10 %).
+    :param min_difference: Slowdowns up to this many ms are always allowed. Relative noise on elements which take next
+                           to no time would fail the comparison otherwise.
+    :return: List with descriptions of all regressions.
+    """
+    regressions = []
+
+    for name, stats in results.items():
+        baseline_stats = baseline.get(name)
+        if not baseline_stats:
+            continue
+
+        timings = {'frame': stats['frame'], **stats['elements']}
+        baseline_timings = {'frame': baseline_stats['frame'], **baseline_stats['elements']}
+
+        for element, element_stats in timings.items():
+            if element not in baseline_timings:
+                continue
+
+            current, previous = element_stats['p50'], baseline_timings[element]['p50']
+            if previous and current > previous * (1 + tolerance) and current - previous > min_difference:
+                regressions.append(f'{name} {element}: p50 {current:.2f} ms (baseline {previous:.2f} ms)')
+
+    return regressions
+
+
+def print_results(results: dict):
+    rows = [(name, element, *(f'{element_stats[key]:.2f}' for key in ('p50', 'p95', 'p99', 'max')))
+            for name, stats in results.items()
+            for element, element_stats in {**stats['elements'], 'frame': stats['frame']}.items()]
+    element_width = max(len(row[1]) for row in rows)
+    row_format = '{:<8} {:<%d} {:>9} {:>9} {:>9} {:>9}' % element_width
+
+    print(row_format.format('Run', 'Element', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for row in rows:
+        print(row_format.format(*row))
+
+    for name, stats in results.items():
+        print(f'{name}: {stats["frame"]["fps"]:.1f} fps')
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='Benchmark the processing chain without display and controller.')
+    parser.add_argument('--resolutions', default=','.join(RESOLUTIONS),
+                        help=f'Comma separated ROI sizes of the synthetic frames ({", ".join(RESOLUTIONS)}).')
+    parser.add_argument('--recording', help='Use the frames of this recording instead of synthetic frames.')
+    parser.add_argument('--frames', type=int, default=200, help='Number of measured frames per run.')
+    parser.add_argument('--warmup-frames', type=int, default=20)
+    parser.add_argument('--execution-mode', default='sequential', choices=('sequential', 'pipelined'))
+    parser.add_argument('--no-optimize', action='store_true', help='Run every element on its own (no fusing).')
+    parser.add_argument('--previews', action='store_true', help='Encode previews for every frame like with a client.')
+    parser.add_argument('--baseline', help='Compare the results with this baseline file.')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed relative slowdown against baseline.')
+    parser.add_argument('--min-difference', type=float, default=0.05,
+                        help='Slowdown in ms against baseline which is always allowed.')
+    parser.add_argument('--save-baseline', help='Store the results in this file.')
+    args = parser.parse_args(argv)
+
+    if args.recording:
+        capturing_devices = {'recording': capturing.ReplayDevice(args.recording)}
+    else:
+        capturing_devices = {name: SyntheticCapturingDevice(*RESOLUTIONS[name])
+                             for name in args.resolutions.split(',')}
+
+    results = {name: run_benchmark(device, frames=args.frames, warmup_frames=args.warmup_frames,
+                                   optimize=not args.no_optimize, execution_mode=args.execution_mode,
+                                   previews=args.previews)
+               for name, device in capturing_devices.items()}
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance, args.min_difference)
+
+        for regression in regressions:
+            print(f'Regression: {regression}')
+
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
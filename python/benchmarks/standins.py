@@ -0,0 +1,56 @@
+"""
+Stand-ins for the chain elements which need a display or a controller driver.
+"""
+from chain.builtin import FrameContext
+from chain.capturing import CapturingDevice
+from chain.controller import ControllerInstance
+from time import perf_counter
+import numpy as np
+import cv2
+
+
+def create_road_frame(width, height, lane_offset=0, seed=0):
+    """
+    Returns a RGB frame which looks roughly like a road: noisy asphalt with two bright lane markings converging towards
+    the horizon.
+    :param lane_offset: Horizontal shift of the lanes at the bottom of the frame in pixels.
+    """
+    rng = np.random.default_rng(seed)
+    frame = rng.integers(60, 100, (height, width, 3), dtype=np.uint8)
+    horizon = height // 3
+    frame[:horizon] = (140, 170, 200)
+
+    thickness = max(2, width // 150)
+    for bottom_x, top_x in ((width * 0.2, width * 0.45), (width * 0.8, width * 0.55)):
+        cv2.line(frame, (int(bottom_x + lane_offset), height - 1), (int(top_x + lane_offset / 3), horizon),
+                 (235, 235, 235), thickness)
+
+    return frame
+
+
+class SyntheticCapturingDevice(CapturingDevice):
+    """
+    Cycles through a few pregenerated road frames.
+    """
+    def __init__(self, width, height, frame_count=8):
+        super().__init__()
+
+        shift = width // 40
+        self.frames = [create_road_frame(width, height, lane_offset=(i - frame_count // 2) * shift, seed=i)
+                       for i in range(frame_count)]
+        self._frame_number = 0
+
+    def process(self, context: FrameContext):
+        context.frame = self.frames[self._frame_number % len(self.frames)]
+        context.capture_time = perf_counter()
+        self._frame_number += 1
+
+
+class NullController(ControllerInstance):
+    """
+    Discards the steering angle but computes and sends it to the UI like a real controller.
+    """
+    RUN_IN_EXECUTOR = False
+
+    def process(self, context: FrameContext):
+        self.get_steering_angle(context)
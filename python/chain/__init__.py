@@ -1,10 +1,20 @@
 import platform
 from abc import ABC, abstractmethod
-from settingstree import Settings, SettingsNode
+from settingstree import Settings, SettingsNode, NodeInput
 from settingstree.widgets.nodewidgets import NodeSubtree
-from chain import capturing, processing, controller
-from chain.builtin import ChainElement, ProcessingResult
+from chain import capturing, processing, controller, recording
+from chain.builtin import ChainElement, FrameContext
+from chain.profiling import ChainProfiler
+from chain.pipeline import PipelinedExecutor, DROP_POLICIES
+from chain import optimizer
+from chain.scheduling import FrameRateGovernor
+from chain.preview import PreviewScheduler, PreviewEncoder
+from chain.tools import setting_to_bool
+from time import perf_counter
 import logging
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
 
 log = logging.getLogger(__name__)
 
@@ -13,6 +23,12 @@ class WebFunctionDoesNotExistException(Exception):
     pass
 
 
+EXECUTION_MODE_SEQUENTIAL = 'sequential'
+EXECUTION_MODE_PIPELINED = 'pipelined'
+EXECUTION_MODE_ASYNC = 'async'
+EXECUTION_MODES = (EXECUTION_MODE_SEQUENTIAL, EXECUTION_MODE_PIPELINED, EXECUTION_MODE_ASYNC)
+
+
 class ProcessingChain(ABC):
     # Use this chain if platform string matches platform.system()
     platform = 'Linux'
@@ -22,6 +38,49 @@ class ProcessingChain(ABC):
         self.chain_elements = []
         self._settings = settings
         self._web_functions = {}
+        self.profiler = ChainProfiler()
+        self._pipelined_executor = None
+        self._execution_elements = None
+        self.frame_rate_governor = FrameRateGovernor()
+        # The web server announces the clients watching the previews here.
+        self.preview_scheduler = PreviewScheduler()
+        # Encodes the preview frames of the elements in the background.
+        self.preview_encoder = PreviewEncoder()
+        # The context gets reused for every frame in sequential and async mode.
+        self._context = FrameContext()
+        # Runs the elements of run_async().
+        self._executor = None
+        # Seconds spent constructing each registered element, see get_startup_report().
+        self._construction_times = {}
+        self._last_register_time = perf_counter()
+
+        self.execution_mode = SettingsNode(key='execution_mode', value=EXECUTION_MODE_SEQUENTIAL, widget=NodeInput,
+                                           verbose_name=f'Execution mode ({"/".join(EXECUTION_MODES)})')
+        self.queue_size = SettingsNode(key='queue_size', value='2', widget=NodeInput,
+                                       verbose_name='Pipeline queue size')
+        self.drop_policy = SettingsNode(key='drop_policy', value=DROP_POLICIES[0], widget=NodeInput,
+                                        verbose_name=f'Pipeline drop policy ({"/".join(DROP_POLICIES)})')
+        self.optimize = SettingsNode(key='optimize', value='1', widget=NodeInput,
+                                     verbose_name='Fuse chain elements (1/0)')
+        self.target_fps = SettingsNode(key='target_fps', value='60', widget=NodeInput,
+                                       verbose_name='Target fps (0 for unlimited)')
+        self.adaptive_fps = SettingsNode(key='adaptive_fps', value='0', widget=NodeInput,
+                                         verbose_name='Lower fps to measured processing time (1/0)')
+        self.warm_up = SettingsNode(key='warm_up', value='1', widget=NodeInput,
+                                    verbose_name='Import dependencies on activation instead of on first frame (1/0)')
+        self.preview_fps = SettingsNode(key='preview_fps', value='10', widget=NodeInput,
+                                        verbose_name='Preview images per second (0 for every frame)')
+        self.preview_scale = SettingsNode(key='preview_scale', value='0.5', widget=NodeInput,
+                                          verbose_name='Size of the preview images (0-1)')
+        self.preview_workers = SettingsNode(key='preview_workers', value='2', widget=NodeInput,
+                                            verbose_name='Threads encoding the preview images')
+
+        chain_settings = SettingsNode(key='ProcessingChain', verbose_name='Processing chain', widget=NodeSubtree)
+        for settings_node in (self.execution_mode, self.queue_size, self.drop_policy, self.optimize, self.target_fps,
+                              self.adaptive_fps, self.warm_up, self.preview_fps, self.preview_scale,
+                              self.preview_workers):
+            chain_settings.add_child(settings_node)
+        self._settings.root.add_child(chain_settings)
 
     @classmethod
     def get_platform_specific_chain(cls):
@@ -38,13 +97,22 @@ class ProcessingChain(ABC):
     def register(self, chain_element):
         """
         This method adds the given chain_element to the internal list with chain_elements.
-        :param chain_element:
+        :param chain_element: Elements with RUN_IN_PROCESS set get wrapped into a ProcessChainElement.
         :return:
         """
         if not isinstance(chain_element, ChainElement):
             raise TypeError('chain_element needs to be an instance of chain.ChainElement!')
 
+        if chain_element.RUN_IN_PROCESS:
+            # Imported here because multiprocessing.shared_memory needs Python 3.8.
+            from chain.multiprocess import ProcessChainElement
+            chain_element = ProcessChainElement(chain_element)
+
+        # Everything constructed since the last registration belongs to this element (e.g. wrapped devices).
+        self._construction_times[chain_element.get_name()] = perf_counter() - self._last_register_time
+
         self.chain_elements.append(chain_element)
+        self._execution_elements = None
 
         # Collect element specific settings from chain_element.
         chain_element_settings_subtree = chain_element.collect_settings()
@@ -57,6 +125,8 @@ class ProcessingChain(ABC):
         self._web_functions.update(chain_element.collect_web_functions())
         log.debug(f'Registed web functions: {[key for key in chain_element.collect_web_functions().keys()]}')
 
+        self._last_register_time = perf_counter()
+
     async def call_web_function(self, name, kwargs):
         """
         Tries to find web functions with given `name` and executes it.
@@ -70,29 +140,246 @@ class ProcessingChain(ABC):
 
         return await self._web_functions[name](kwargs)
 
-    def run(self) -> list:
+    def get_timing_stats(self) -> dict:
         """
-        This method iterates through all registered chain_elements. It calls the process method and passes the output
-        to the next chain element.
-        :return: list with data from chain members.
+        Returns the rolling timing statistics (p50/p95/p99, max, mean in ms) of every chain element and of the whole
+        frame including fps.
         """
-        mid_result = ProcessingResult([], {})
-        end_result = []
+        stats = self.profiler.get_stats()
+
+        stats['governor'] = self.frame_rate_governor.get_stats()
+        stats['previews'] = {**self.preview_scheduler.get_stats(), **self.preview_encoder.get_stats()}
+
+        if self._pipelined_executor is not None:
+            stats['pipeline'] = self._pipelined_executor.get_stats()
+
+        return stats
 
+    def get_startup_report(self) -> dict:
+        """
+        Returns the startup cost of every registered chain element in ms: the time spent constructing it and the time
+        spent importing its dependencies. The import time is None until the dependencies got imported (on activation
+        or on the first frame).
+        """
+        report = {}
         for element in self.chain_elements:
+            import_time = element.get_import_time()
+            report[element.get_name()] = {
+                'construction': self._construction_times.get(element.get_name(), 0) * 1000,
+                'import': None if import_time is None else import_time * 1000,
+            }
+
+        return report
+
+    def get_execution_elements(self) -> list:
+        """
+        Returns the chain elements which actually get executed. These are the registered chain elements, rewritten by
+        chain.optimizer if optimizing is enabled. The list gets built once and is rebuilt by start().
+        """
+        if self._execution_elements is None:
+            if setting_to_bool(self.optimize.value):
+                self._execution_elements = optimizer.optimize(self.chain_elements)
+            else:
+                self._execution_elements = list(self.chain_elements)
+
+        return self._execution_elements
+
+    def is_pipelined(self) -> bool:
+        return self.execution_mode.value == EXECUTION_MODE_PIPELINED
+
+    def is_async(self) -> bool:
+        return self.execution_mode.value == EXECUTION_MODE_ASYNC
+
+    def _set_output_buffer_depth(self, depth: int):
+        for element in self.get_execution_elements():
+            element.output_buffer_depth = depth
+
+    def _start_pipelined_executor(self):
+        if self._pipelined_executor is not None:
+            return
+
+        # Every element gets its own stage.
+        elements = self.get_execution_elements()
+        queue_size = int(self.queue_size.value)
+        # An output may be referenced by every waiting and processed frame behind it, by the frame returned from run()
+        # and it must not be overwritten while the element writes the next one.
+        self._set_output_buffer_depth(len(elements) * (queue_size + 1) + 2)
+
+        self._pipelined_executor = PipelinedExecutor([[element] for element in elements], self._run_elements,
+                                                     queue_size=queue_size, drop_policy=self.drop_policy.value,
+                                                     prepare_context=self._schedule_preview)
+        self._pipelined_executor.start()
+
+    def _stop_pipelined_executor(self):
+        if self._pipelined_executor is None:
+            return
+
+        self._pipelined_executor.stop()
+        self._pipelined_executor = None
+        self._set_output_buffer_depth(1)
+
+    def start(self):
+        """
+        Prepares all chain elements for processing (e.g. starts background threads). Call this before run().
+        """
+        self.profiler.reset()
+        self.frame_rate_governor.reset()
+        # Respect changed settings.
+        self._execution_elements = None
+
+        if setting_to_bool(self.warm_up.value):
+            for element in self.get_execution_elements():
+                element.warm_up()
+
+        for element in self.get_execution_elements():
+            element.start()
+
+        if self.is_pipelined():
+            self._start_pipelined_executor()
+
+        self._start_preview_encoder()
+
+    def stop(self):
+        """
+        Stops background work of all chain elements. Call this after the last run().
+        """
+        self._stop_pipelined_executor()
+        self.preview_encoder.stop()
+
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+        for element in self.get_execution_elements():
+            try:
+                element.stop()
+            except Exception:
+                log.exception(f'Error while stopping ChainElement {element}.')
+
+    def _configure_frame_rate_governor(self):
+        try:
+            self.frame_rate_governor.target_fps = float(self.target_fps.value or 0)
+        except ValueError:
+            log.exception('Invalid target fps.')
+            self.frame_rate_governor.target_fps = 0
+
+        self.frame_rate_governor.adaptive = setting_to_bool(self.adaptive_fps.value)
+
+    def wait_for_next_frame(self):
+        """
+        Sleeps until the next frame is due according to the target fps settings. Call this once after every run().
+        """
+        self._configure_frame_rate_governor()
+        self.frame_rate_governor.tick()
+
+    async def wait_for_next_frame_async(self):
+        """
+        Like wait_for_next_frame() but without blocking the event loop. Call this once after every run_async().
+        """
+        self._configure_frame_rate_governor()
+        await self.frame_rate_governor.tick_async()
+
+    def _schedule_preview(self, context: FrameContext):
+        """
+        Decides if the elements send previews for the frame of context.
+        """
+        try:
+            self.preview_scheduler.fps = float(self.preview_fps.value or 0)
+            self.preview_scheduler.scale = float(self.preview_scale.value or 1)
+        except ValueError:
+            log.exception('Invalid preview settings.')
+
+        self.preview_scheduler.schedule(context)
+
+    def _start_preview_encoder(self):
+        if self.preview_encoder.is_running():
+            return
+
+        try:
+            self.preview_encoder.worker_count = int(self.preview_workers.value or 1)
+        except ValueError:
+            log.exception('Invalid number of preview workers.')
+            self.preview_encoder.worker_count = 1
+
+        self.preview_encoder.start()
+
+    def _handle_previews(self, context: FrameContext):
+        """
+        Hands the preview frames of context to the encoder and puts the previews it finished since the last frame into
+        context.previews. So previews arrive a frame or two after their frame, but the chain never waits for encoding.
+        """
+        if context.preview_frames:
+            self._start_preview_encoder()
+            for preview_type, frame in context.preview_frames.items():
+                self.preview_encoder.submit(preview_type, frame)
+
+        context.previews.update(self.preview_encoder.collect())
+
+    def _run_elements(self, elements, context: FrameContext):
+        """
+        Passes the frame context through the given chain elements and records their timings.
+        """
+        for element in elements:
+            element_start = perf_counter()
             try:
-                mid_result = element.process(*mid_result.args, **mid_result.kwargs)
-                if mid_result.data_to_send:
-                    end_result.append(mid_result.data_to_send)
+                element.process(context)
             except TypeError as e:
                 log.exception(f'Error in while processing ChainElement {element}.')
+            finally:
+                self.profiler.add_element_timing(element.get_name(), perf_counter() - element_start)
+
+    def run(self) -> FrameContext:
+        """
+        This method iterates through all registered chain_elements. It calls the process method of every chain element
+        with the FrameContext of the current frame.
+        In pipelined mode the elements run in their own threads and this method returns the next finished frame.
+        :return: FrameContext of the processed frame. It is only valid until the next call of run().
+        """
+        if self.is_pipelined():
+            self._start_pipelined_executor()
+            context = self._pipelined_executor.get_result()
+        else:
+            # The execution mode was switched while running.
+            self._stop_pipelined_executor()
+            context = self._context
+            context.reset(context.frame_number + 1)
+            self._schedule_preview(context)
+            self._run_elements(self.get_execution_elements(), context)
+
+        self.profiler.add_frame_timing(perf_counter() - context.start_time)
+        self._handle_previews(context)
 
-        return end_result
+        return context
 
-        # TODO: add field content_for_websocket to ProcessingResult. This than gets returned to the api which sends it
-        #  to the browser via websocket.
         # TODO: find a way to send data via websocket from inside a chain_element.
 
+    async def run_async(self) -> FrameContext:
+        """
+        Version of run() for the event loop of the web server. Elements with RUN_IN_EXECUTOR set run in a worker thread,
+        consecutive ones in a single executor call. The other elements run directly on the event loop.
+        :return: FrameContext of the processed frame. It is only valid until the next call of run_async().
+        """
+        if self._executor is None:
+            # One worker keeps the elements of a frame in order.
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ProcessingChain')
+
+        loop = asyncio.get_running_loop()
+        context = self._context
+        context.reset(context.frame_number + 1)
+        self._schedule_preview(context)
+
+        for run_in_executor, elements in groupby(self.get_execution_elements(),
+                                                 key=lambda element: element.RUN_IN_EXECUTOR):
+            if run_in_executor:
+                await loop.run_in_executor(self._executor, self._run_elements, list(elements), context)
+            else:
+                self._run_elements(elements, context)
+
+        self.profiler.add_frame_timing(perf_counter() - context.start_time)
+        self._handle_previews(context)
+
+        return context
+
 
 class CVChainWindows(ProcessingChain):
     platform = 'Windows'
@@ -100,23 +387,48 @@ class CVChainWindows(ProcessingChain):
     def __init__(self, settings):
         super().__init__(settings)
 
-        self.register(capturing.ImageGrabDevice())
-        self.register(processing.ColorConversionPreProcessingUnit())
-        self.register(processing.ROIPreProcessingUnit())
+        # The capturing device only grabs the viewport configured in the ROI unit.
+        roi_unit = processing.ROIPreProcessingUnit()
+
+        capturing_device = capturing.ThreadedCapturingDevice(capturing.ImageGrabDevice(roi_unit=roi_unit))
+        self.register(capturing_device)
+        self.register(recording.FrameRecorder(capturing_device.get_pixel_format()))
+        self.register(processing.ColorConversionPreProcessingUnit.for_pixel_format(capturing_device.get_pixel_format()))
+        self.register(roi_unit)
         self.register(processing.GrayscaleConversionPreProcessingUnit())
-        # self.register(processing.CVLaneDetectionProcessingUnit())
+        self.register(processing.DownscalePreProcessingUnit())
+        self.register(processing.CVLaneDetectionProcessingUnit())
         self.register(controller.VjoyController())
 
 
 class CVChainLinux(ProcessingChain):
     platform = 'Linux'
 
-    def __init__(self, settings):
+    def __init__(self, settings, capturing_device=None):
+        """
+        :param capturing_device: Use this CapturingDevice instead of grabbing the screen (e.g. a
+                                 capturing.ReplayDevice for headless runs).
+        """
         super().__init__(settings)
 
-        self.register(capturing.PyscreenshotDevice())
-        self.register(processing.ColorConversionPreProcessingUnit())
-        self.register(processing.ROIPreProcessingUnit())
+        # The capturing device only grabs the viewport configured in the ROI unit.
+        roi_unit = processing.ROIPreProcessingUnit()
+
+        # Prefer the zero-copy shared memory grab. It is fast enough to run without the capture thread, which would
+        # have to copy every frame.
+        if capturing_device is None and capturing.XShmDevice.is_available():
+            capturing_device = capturing.ThreadedCapturingDevice(capturing.XShmDevice(roi_unit=roi_unit),
+                                                                 threaded=False)
+        elif capturing_device is None:
+            capturing_device = capturing.ThreadedCapturingDevice(capturing.PyscreenshotDevice(roi_unit=roi_unit))
+
+        # The color conversion follows the device, e.g. replays of XShm recordings are BGRA.
+        pixel_format = capturing_device.get_pixel_format()
+        self.register(capturing_device)
+        self.register(recording.FrameRecorder(pixel_format))
+        self.register(processing.ColorConversionPreProcessingUnit.for_pixel_format(pixel_format))
+        self.register(roi_unit)
         self.register(processing.GrayscaleConversionPreProcessingUnit())
+        self.register(processing.DownscalePreProcessingUnit())
         self.register(processing.CVLaneDetectionProcessingUnit())
         # self.register()
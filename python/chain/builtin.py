@@ -1,20 +1,112 @@
 from abc import ABC, abstractmethod
 from settingstree import SettingsNode
 from settingstree.widgets.nodewidgets import NodeSubtree
-from collections import namedtuple
 from importlib import import_module
+from time import perf_counter
 
-ProcessingResult = namedtuple('ProcessingResult', ('args', 'kwargs', 'data_to_send'), defaults=([], {}, {}))
+
+class FrameContext:
+    """
+    Carries one frame and the values derived from it through the chain. Every chain element reads from and writes to
+    the context. The chain reuses context objects for later frames, so elements must not keep references to the
+    context or its data_to_send, preview_frames and previews dicts after process() returned.
+    """
+    __slots__ = ('frame', 'angle', 'frame_number', 'capture_time', 'capture_bbox', 'start_time', 'scale',
+                 'preview_scale', 'data_to_send', 'preview_frames', 'previews')
+
+    def __init__(self):
+        self.data_to_send = dict()
+        self.preview_frames = dict()
+        self.previews = dict()
+        self.reset()
+
+    def reset(self, frame_number=0):
+        """
+        Clears the context for the next frame.
+        """
+        # The current frame (numpy array). Elements replace it with their output.
+        self.frame = None
+        # Steering angle (-1 <= angle <= 1) once a processing unit figured it out.
+        self.angle = None
+        self.frame_number = frame_number
+        # perf_counter() timestamp of the moment the frame was captured.
+        self.capture_time = None
+        # Screen area (x1, y1, x2, y2) the capturing device grabbed or None if the frame shows the whole screen.
+        self.capture_bbox = None
+        # perf_counter() timestamp of the moment the chain started working on this frame.
+        self.start_time = perf_counter()
+        # Size of the current frame relative to the viewport. Divide coordinates by it to map them back to the viewport.
+        self.scale = 1.0
+        # Scale of the preview images for the web ui or None if this frame gets no previews (see chain.preview).
+        self.preview_scale = None
+        # Data for the web ui.
+        self.data_to_send.clear()
+        # Preview images by preview type, which the chain still has to encode (see chain.preview.create_preview_frame).
+        self.preview_frames.clear()
+        # JPEG encoded preview images for the web ui by preview type (see chain.preview.PREVIEW_TYPES).
+        self.previews.clear()
 
 
 class ChainElement(ABC):
     VERBOSE_NAME = None
+    # Set this to True to run process() in a worker process (see chain.multiprocess.ProcessChainElement).
+    RUN_IN_PROCESS = False
+    # Set this to False if process() is so cheap that ProcessingChain.run_async() can call it on the event loop.
+    RUN_IN_EXECUTOR = True
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        self._imported_dependencies = dict()
-        self.import_dependencies()
+        # Dependencies get imported on first access of self._imported_dependencies.
+        self._dependencies = None
+        # Seconds it took to import the dependencies. None as long as they are not imported.
+        self.import_time = None
+        # Number of outputs which have to stay valid at the same time (see chain.tools.OutputBuffers).
+        self.output_buffer_depth = 1
+
+    def __getstate__(self):
+        # Modules can not be pickled. They get imported again on first use after unpickling.
+        state = self.__dict__.copy()
+        state['_dependencies'] = None
+        return state
+
+    @property
+    def _imported_dependencies(self) -> dict:
+        """
+        Dict with the modules imported by import_dependencies(). They are imported on first access, so constructing
+        chain elements stays cheap.
+        """
+        if self._dependencies is None:
+            # _import_helper() fills the dict through this property while importing.
+            self._dependencies = dict()
+            import_start = perf_counter()
+            try:
+                self.import_dependencies()
+            except Exception:
+                # Don't keep the partly filled dict, the next access tries again.
+                self._dependencies = None
+                raise
+            self.import_time = perf_counter() - import_start
+
+        return self._dependencies
+
+    def get_import_time(self):
+        """
+        Returns the seconds it took to import the dependencies or None if they are not imported yet.
+        """
+        return self.import_time
+
+    def warm_up(self):
+        """
+        Imports the dependencies now instead of on the first call of process().
+        """
+        self._imported_dependencies
+
+    def get_name(self) -> str:
+        """
+        Returns the name of the chain element used in statistics and logs.
+        """
+        return self.__class__.__name__
 
     def collect_settings(self) -> SettingsNode:
         """
@@ -24,9 +116,11 @@ class ChainElement(ABC):
         """
         settings_node = SettingsNode(key=self.__class__.__name__, verbose_name=self.__class__.VERBOSE_NAME,
                                      widget=NodeSubtree)
-        for attribute in dir(self):
-            if isinstance(getattr(self, attribute), SettingsNode):
-                settings_node.add_child(getattr(self, attribute))
+        # Only look at instance attributes (sorted like dir()), properties like _imported_dependencies must not be
+        # evaluated here.
+        for attribute, value in sorted(vars(self).items()):
+            if isinstance(value, SettingsNode):
+                settings_node.add_child(value)
 
         return settings_node
 
@@ -48,15 +142,27 @@ class ChainElement(ABC):
 
     def import_dependencies(self):
         """
-        Import python libs here. Gets called on init.
+        Import python libs here with self._import_helper. Gets called on first access of self._imported_dependencies,
+        at the latest on warm_up().
         """
         pass
 
-    @abstractmethod
-    def process(self, *args, **kwargs) -> ProcessingResult:
+    def start(self):
+        """
+        Gets called by the ProcessingChain before the first frame is processed. Start background work here.
         """
+        pass
 
-        :param args:
-        :return:
+    def stop(self):
+        """
+        Gets called by the ProcessingChain after the last frame was processed. Stop background work here.
+        """
+        pass
+
+    @abstractmethod
+    def process(self, context: FrameContext):
+        """
+        Processes the frame context in place.
+        :param context: FrameContext of the current frame.
         """
 
@@ -1,16 +1,55 @@
 from logging import Logger
 from abc import ABC, abstractmethod
-from .builtin import ChainElement, ProcessingResult
+from threading import Thread, Event
+from time import perf_counter
+from .builtin import ChainElement, FrameContext
+from settingstree import SettingsNode, NodeInput
+from chain.tools import LatestFrameBuffer, OutputBuffers, setting_to_bool
+from chain.recording import FrameRecordingReader
+from chain import xshm
 import numpy as np
 
 log = Logger(__name__)
 
+# Channel order of the captured frames, see CapturingDevice.get_pixel_format().
+PIXEL_FORMAT_RGB = 'RGB'
+PIXEL_FORMAT_BGRA = 'BGRA'
+
 
 class CapturingDevice(ChainElement):
+    # Set this to True if the returned frames share memory which gets overwritten by the next capture.
+    REUSES_FRAME_MEMORY = False
+    PIXEL_FORMAT = PIXEL_FORMAT_RGB
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self._frame_buffers = OutputBuffers()
+
+    def get_pixel_format(self) -> str:
+        """
+        Returns the channel order of the captured frames. The chain picks its color conversion accordingly.
+        """
+        return self.PIXEL_FORMAT
+
+    def _keep_frame(self, context: FrameContext):
+        """
+        Copies context.frame into a rotating output buffer if the chain processes several frames at once (pipelined
+        mode). Devices with REUSES_FRAME_MEMORY call this, otherwise the next capture would overwrite the frame while
+        later stages still work on it.
+        """
+        if self.output_buffer_depth <= 1:
+            return
+
+        frame = context.frame
+        context.frame = self._frame_buffers.get(frame.shape, frame.dtype, self.output_buffer_depth)
+        np.copyto(context.frame, frame)
+
     @abstractmethod
-    def process(self, *args, **kwargs):
+    def process(self, context: FrameContext):
         """
-        This method returns the current frame from the capturing device.
+        This method stores the current frame from the capturing device in context.frame, the moment it was captured
+        in context.capture_time and the grabbed screen area in context.capture_bbox.
         """
 
 
@@ -18,16 +57,22 @@ class ImageGrabDevice(CapturingDevice):
     """
     ImageGrab CapturingDevice.
     Usable on Windows.
+    If roi_unit is given only the configured viewport gets grabbed instead of the whole screen.
     """
+    def __init__(self, roi_unit=None):
+        super().__init__()
+
+        self.roi_unit = roi_unit
 
     def import_dependencies(self):
         self._import_helper('PIL.ImageGrab', 'ImageGrab')
 
-    def process(self, *args, **kwargs):
-        # TODO: bbox (Via settings?)
-        frame_screen = self._imported_dependencies['ImageGrab'].grab()
-        frame_screen_converted = np.uint8(frame_screen)
-        return ProcessingResult(args=(frame_screen_converted,))
+    def process(self, context: FrameContext):
+        bbox = self.roi_unit.get_bbox() if self.roi_unit else None
+        context.capture_time = perf_counter()
+        frame_screen = self._imported_dependencies['ImageGrab'].grab(bbox=bbox)
+        context.frame = np.uint8(frame_screen)
+        context.capture_bbox = bbox
 
 
 class PyscreenshotDevice(ImageGrabDevice):
@@ -37,3 +82,222 @@ class PyscreenshotDevice(ImageGrabDevice):
     """
     def import_dependencies(self):
         self._import_helper('pyscreenshot', 'ImageGrab')
+
+
+class XShmDevice(CapturingDevice):
+    """
+    Grabs the screen through the X11 MIT-SHM extension. The X server writes into shared memory and the frame is a numpy
+    view on it, so no copy is made. Frames are in BGRA order.
+    The returned frame is only valid until the next call to process() or stop(). Elements which need the frame longer
+    than one chain run have to copy it.
+    Usable on Linux with X11 (e.g. Xvfb).
+    """
+    REUSES_FRAME_MEMORY = True
+    PIXEL_FORMAT = PIXEL_FORMAT_BGRA
+
+    def __init__(self, roi_unit=None):
+        super().__init__()
+
+        self.roi_unit = roi_unit
+        self._grabber = None
+
+    @staticmethod
+    def is_available() -> bool:
+        return xshm.is_available()
+
+    def stop(self):
+        if self._grabber is not None:
+            self._grabber.close()
+            self._grabber = None
+
+    def process(self, context: FrameContext):
+        if self._grabber is None:
+            self._grabber = xshm.XShmScreenGrabber()
+
+        bbox = self.roi_unit.get_bbox() if self.roi_unit else None
+        context.capture_time = perf_counter()
+        context.frame = self._grabber.grab(bbox=bbox)
+        context.capture_bbox = bbox
+        self._keep_frame(context)
+
+
+class ReplayDevice(CapturingDevice):
+    """
+    Replays the frames of a recording made with chain.recording.FrameRecorder.
+    Frames are read-only views on a memory map, so they are neither copied nor loaded into memory up front.
+    Usable without a display.
+    """
+    VERBOSE_NAME = 'Replay'
+
+    def __init__(self, recording_path=''):
+        super().__init__()
+
+        self.recording_path = SettingsNode(key='recording_path', value=recording_path, widget=NodeInput,
+                                           verbose_name='Recording')
+        self.loop = SettingsNode(key='loop', value='1', widget=NodeInput, verbose_name='Loop recording (1/0)')
+
+        self._reader = None
+        self._reader_path = None
+        self._frame_number = 0
+
+    def get_reader(self) -> FrameRecordingReader:
+        # (Re)open the recording if the path changed.
+        if self._reader is None or self._reader_path != self.recording_path.value:
+            self._reader = FrameRecordingReader(self.recording_path.value)
+            self._reader_path = self.recording_path.value
+            self._frame_number = 0
+
+        return self._reader
+
+    def get_pixel_format(self) -> str:
+        """
+        Returns the pixel format stored in the recording, the default one if no recording is set or it can't be read.
+        """
+        if not self.recording_path.value:
+            return self.PIXEL_FORMAT
+
+        try:
+            return self.get_reader().get_pixel_format() or self.PIXEL_FORMAT
+        except (OSError, ValueError):
+            return self.PIXEL_FORMAT
+
+    def start(self):
+        self._frame_number = 0
+
+    def process(self, context: FrameContext):
+        reader = self.get_reader()
+
+        if self._frame_number >= len(reader):
+            if not len(reader) or not setting_to_bool(self.loop.value):
+                raise EOFError(f'No more frames in recording {self.recording_path.value}.')
+
+            self._frame_number = 0
+
+        context.frame, _ = reader[self._frame_number]
+        context.capture_bbox = reader.get_bbox(self._frame_number)
+        context.capture_time = perf_counter()
+        self._frame_number += 1
+
+
+class ThreadedCapturingDevice(CapturingDevice):
+    """
+    Wraps another CapturingDevice and runs it in its own thread. Captured frames are written into a LatestFrameBuffer
+    and process() returns the newest one without waiting for the next grab. This way capturing frame n+1 overlaps with
+    processing frame n.
+    Frames of devices with REUSES_FRAME_MEMORY get copied inside the capture thread, or into rotating output buffers
+    in pipelined mode if the threaded mode is disabled.
+    The wrapped device calls process() directly if the threaded mode is disabled in the settings.
+    """
+    # Seconds to wait before grabbing again after the wrapped device raised an exception.
+    ERROR_BACKOFF = 0.1
+    # Seconds process() waits for the first frame before it raises the last capture error (or a TimeoutError).
+    FRAME_TIMEOUT = 1.0
+
+    def __init__(self, capturing_device: CapturingDevice, buffer_size=2, threaded=True):
+        if not isinstance(capturing_device, CapturingDevice):
+            raise TypeError('capturing_device needs to be an instance of chain.capturing.CapturingDevice!')
+
+        super().__init__()
+
+        self.capturing_device = capturing_device
+        self.threaded = SettingsNode(key='threaded', value='1' if threaded else '0', widget=NodeInput,
+                                     verbose_name='Capture in background thread (1/0)')
+
+        self._frame_buffer = LatestFrameBuffer(buffer_size)
+        self._capture_thread = None
+        self._stop_event = Event()
+        # Exception of the last failed capture, None after a successful one.
+        self._capture_error = None
+
+    def get_name(self) -> str:
+        return f'{self.capturing_device.get_name()} (threaded)'
+
+    def warm_up(self):
+        self.capturing_device.warm_up()
+
+    def get_import_time(self):
+        return self.capturing_device.get_import_time()
+
+    def get_pixel_format(self) -> str:
+        return self.capturing_device.get_pixel_format()
+
+    def collect_settings(self) -> SettingsNode:
+        # Show the settings of the wrapped device and the threading switch in one subtree.
+        settings_node = self.capturing_device.collect_settings()
+        settings_node.add_child(self.threaded)
+        return settings_node
+
+    def collect_web_functions(self) -> dict:
+        return self.capturing_device.collect_web_functions()
+
+    def is_capturing(self) -> bool:
+        return self._capture_thread is not None and self._capture_thread.is_alive()
+
+    def start(self):
+        self.capturing_device.start()
+
+        if setting_to_bool(self.threaded.value):
+            self._start_capture_thread()
+
+    def stop(self):
+        self._stop_capture_thread()
+        self.capturing_device.stop()
+
+    def _start_capture_thread(self):
+        if self.is_capturing():
+            return
+
+        self._stop_event.clear()
+        self._frame_buffer.clear()
+        self._capture_error = None
+        self._capture_thread = Thread(target=self._capture_loop, name=self.capturing_device.__class__.__name__,
+                                      daemon=True)
+        self._capture_thread.start()
+
+    def _stop_capture_thread(self):
+        self._stop_event.set()
+
+        if self._capture_thread is not None:
+            self._capture_thread.join()
+            self._capture_thread = None
+
+    def _capture_loop(self):
+        copy_frames = self.capturing_device.REUSES_FRAME_MEMORY
+        # The capture thread has its own context. Only frame, capture time and bbox are handed over to the chain.
+        context = FrameContext()
+
+        while not self._stop_event.is_set():
+            try:
+                context.reset()
+                self.capturing_device.process(context)
+                # The next grab overwrites the frame while the chain is still processing it.
+                frame = context.frame.copy() if copy_frames else context.frame
+
+                self._frame_buffer.put((frame, context.capture_time, context.capture_bbox))
+                self._capture_error = None
+            except Exception as e:
+                log.exception(f'Error while capturing with {self.capturing_device}.')
+                self._capture_error = e
+                self._stop_event.wait(self.ERROR_BACKOFF)
+
+    def process(self, context: FrameContext):
+        # The threaded mode can be switched in the settings while the chain is running.
+        if not setting_to_bool(self.threaded.value):
+            self._stop_capture_thread()
+            self.capturing_device.process(context)
+            if self.capturing_device.REUSES_FRAME_MEMORY:
+                # The wrapped device does not know about the frames in flight, its output_buffer_depth stays 1.
+                self._keep_frame(context)
+            return
+
+        self._start_capture_thread()
+
+        try:
+            _, (context.frame, context.capture_time, context.capture_bbox) = self._frame_buffer.get_latest(
+                self.FRAME_TIMEOUT)
+        except TimeoutError:
+            # Don't block the chain forever if the wrapped device keeps failing (e.g. no display).
+            capture_error = self._capture_error
+            if capture_error is not None:
+                raise capture_error
+            raise
@@ -0,0 +1,273 @@
+"""
+Websocket connections of the web server. Every connection has its own bounded send queue and a sender task, so sending
+to all clients of a path never waits for a slow client. The ContextPublisher hands the outputs of frames processed in
+another thread over to the event loop the connections live on.
+"""
+from logging import Logger
+from contextlib import contextmanager
+from collections import defaultdict
+from starlette.websockets import WebSocketDisconnect, WebSocket
+from threading import Lock
+from chain.builtin import FrameContext
+from chain.telemetry import TelemetryState, negotiate_subprotocol, get_encoding
+import json
+import asyncio
+
+log = Logger(__name__)
+
+
+class WSConnection:
+    """
+    A websocket of the WSConnectionPool with its own bounded send queue. A sender task works through the queue, so a
+    slow client only delays its own messages. If the queue is full the oldest message gets dropped, clients are only
+    interested in the latest state anyway.
+    Must be created from within the event loop.
+    """
+    def __init__(self, ws: WebSocket, pool, queue_size: int):
+        self.ws = ws
+        self.sent_messages = 0
+        self.dropped_messages = 0
+        self.closed = False
+        self._pool = pool
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._sender = asyncio.get_running_loop().create_task(self._send_messages())
+
+    def put(self, method_name: str, data):
+        """
+        Queues data for the websocket send method with the given name (send_text, send_bytes).
+        """
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped_messages += 1
+
+        self._queue.put_nowait((method_name, data))
+
+    def close(self):
+        """
+        Stops the sender task. Queued messages get discarded.
+        """
+        self.closed = True
+        if self._sender is not asyncio.current_task():
+            self._sender.cancel()
+
+    def get_stats(self) -> dict:
+        return {'queued_messages': self._queue.qsize(), 'sent_messages': self.sent_messages,
+                'dropped_messages': self.dropped_messages}
+
+    async def _next_message(self) -> tuple:
+        """
+        Waits for the next message and returns the name of the websocket send method and the data.
+        """
+        return await self._queue.get()
+
+    async def _send_messages(self):
+        try:
+            while True:
+                method_name, data = await self._next_message()
+                await getattr(self.ws, method_name)(data)
+                self.sent_messages += 1
+        except (WebSocketDisconnect, RuntimeError, OSError):
+            # The client is gone (starlette raises RuntimeError for sends after the close message).
+            pass
+        except Exception:
+            log.exception('Error while sending to websocket.')
+        finally:
+            # The pool closes connections after removing them.
+            if not self.closed:
+                self._pool.remove_connection(self.ws)
+
+
+class TelemetryConnection(WSConnection):
+    """
+    Connection of a dashboard. The telemetry of new frames is not queued but merged into the client's TelemetryState,
+    the sender only sends the subscribed fields which changed since its last message (see chain.telemetry).
+    """
+    def __init__(self, ws: WebSocket, pool, queue_size: int):
+        self.telemetry = TelemetryState(get_encoding(negotiate_subprotocol(ws.scope.get('subprotocols', []))))
+        self._wake_up = asyncio.Event()
+
+        super().__init__(ws, pool, queue_size)
+
+    def put(self, method_name: str, data):
+        super().put(method_name, data)
+        self._wake_up.set()
+
+    def put_telemetry(self, values: dict):
+        if self.telemetry.has_updates():
+            # The message of the last frame was not sent yet, this frame gets merged into it.
+            self.dropped_messages += 1
+
+        self.telemetry.update(values)
+        self._wake_up.set()
+
+    def subscribe(self, fields=None):
+        """
+        :param fields: Names of the telemetry fields the client displays or None for all fields.
+        """
+        self.telemetry.subscribe(fields)
+        self._wake_up.set()
+
+    async def _next_message(self) -> tuple:
+        while True:
+            # Other messages (e.g. replies) go first.
+            if not self._queue.empty():
+                return self._queue.get_nowait()
+
+            if self.telemetry.has_updates():
+                message = self.telemetry.get_message()
+                if message is not None:
+                    return ('send_bytes' if isinstance(message, bytes) else 'send_text'), message
+
+            await self._wake_up.wait()
+            self._wake_up.clear()
+
+
+class WSConnectionPool:
+    """
+    Keeps the websocket connections by path and sends messages to all connections of a path. Sending only queues the
+    message for every connection (see WSConnection), it never waits for the clients. Connections get removed as soon as
+    sending to them fails.
+    """
+    def __init__(self, queue_size=8, connection_types=None):
+        """
+        :param queue_size: Maximum number of messages waiting for a client before the oldest gets dropped.
+        :param connection_types: Path: WSConnection subclass for the connections of the path.
+        """
+        self.queue_size = queue_size
+        self.connection_types = connection_types or {}
+        # Path: {websocket: WSConnection}
+        self._connection_pool = defaultdict(dict)
+
+    def add_connection(self, ws: WebSocket):
+        """
+        Must be called from within the event loop.
+        """
+        if not isinstance(ws, WebSocket):
+            raise TypeError('ws needs to be an instance of starlette.websockets.Websocket.')
+
+        path = ws.url.path
+        if ws not in self._connection_pool[path]:
+            connection_type = self.connection_types.get(path, WSConnection)
+            self._connection_pool[path][ws] = connection_type(ws, self, self.queue_size)
+
+    def get_connection(self, ws: WebSocket):
+        """
+        Returns the WSConnection of ws or None.
+        """
+        return self._connection_pool[ws.url.path].get(ws)
+
+    def remove_connection(self, ws: WebSocket):
+        connection = self._connection_pool[ws.url.path].pop(ws, None)
+        if connection is not None:
+            connection.close()
+
+    @contextmanager
+    def connection(self, ws: WebSocket):
+        """
+        Wraps the receive loop of a websocket route. Yields the WSConnection of ws, ends the route quietly when the
+        client disconnects and removes the connection in any case, so no sender task is left behind.
+        """
+        try:
+            yield self.get_connection(ws)
+        except WebSocketDisconnect:
+            pass
+        finally:
+            self.remove_connection(ws)
+
+    def get_stats(self) -> dict:
+        """
+        Returns the number of connections and their queued, sent and dropped messages by path.
+        """
+        stats = {}
+        for path, connections in self._connection_pool.items():
+            connection_stats = [connection.get_stats() for connection in connections.values()]
+            stats[path] = {'connections': len(connection_stats)}
+            for key in ('queued_messages', 'sent_messages', 'dropped_messages'):
+                stats[path][key] = sum(connection[key] for connection in connection_stats)
+
+        return stats
+
+    def _get_connections(self, path_or_websocket):
+        if isinstance(path_or_websocket, WebSocket):
+            path = path_or_websocket.url.path
+        else:
+            path = path_or_websocket
+
+        return self._connection_pool[path].values()
+
+    def _put(self, path_or_websocket, method_name: str, data):
+        for connection in self._get_connections(path_or_websocket):
+            connection.put(method_name, data)
+
+    async def send_text(self, path_or_websocket, data: str):
+        self._put(path_or_websocket, 'send_text', data)
+
+    async def send_bytes(self, path_or_websocket, data: bytes):
+        self._put(path_or_websocket, 'send_bytes', data)
+
+    async def send_json(self, path_or_websocket, data):
+        # Serialize once for all connections, the same way as WebSocket.send_json.
+        self._put(path_or_websocket, 'send_text', json.dumps(data, separators=(',', ':'), ensure_ascii=False))
+
+    async def send_telemetry(self, path_or_websocket, values: dict):
+        """
+        Sends the telemetry of a frame to the TelemetryConnections of the path.
+        """
+        for connection in self._get_connections(path_or_websocket):
+            connection.put_telemetry(values)
+
+
+class ContextPublisher:
+    """
+    Hands the outputs of processed frames from the ProcessingThread to the event loop of the web server, so websockets
+    are only used on their loop. The thread merges the outputs into a pending slot and wakes up the loop with
+    call_soon_threadsafe. If the loop falls behind, the outputs of several frames get coalesced into one message (the
+    latest value of every key wins).
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, send_outputs):
+        """
+        :param loop: Event loop of the web server. Nothing gets published without a loop or after it is closed.
+        :param send_outputs: Coroutine function which gets called on the loop with data_to_send and previews.
+        """
+        self.published_frames = 0
+        self.coalesced_frames = 0
+        self._loop = loop
+        self._send_outputs = send_outputs
+        self._lock = Lock()
+        # (data_to_send, previews) waiting for the loop or None.
+        self._pending = None
+
+    def publish(self, context: FrameContext):
+        """
+        Thread-safe. Copies the outputs of context, so the chain can reuse it right away.
+        """
+        if not context.data_to_send and not context.previews:
+            return
+
+        if self._loop is None or self._loop.is_closed():
+            # The server is shutting down.
+            return
+
+        with self._lock:
+            self.published_frames += 1
+            wake_up = self._pending is None
+            if wake_up:
+                self._pending = (dict(context.data_to_send), dict(context.previews))
+            else:
+                self.coalesced_frames += 1
+                self._pending[0].update(context.data_to_send)
+                self._pending[1].update(context.previews)
+
+        if wake_up:
+            try:
+                self._loop.call_soon_threadsafe(self._send_pending)
+            except RuntimeError:
+                # The loop got closed since the check above.
+                log.warning('Event loop is closed, dropping frame outputs.')
+
+    def _send_pending(self):
+        with self._lock:
+            data_to_send, previews = self._pending
+            self._pending = None
+
+        self._loop.create_task(self._send_outputs(data_to_send, previews))
@@ -1,40 +1,332 @@
 from logging import Logger
 from abc import ABC, abstractmethod
-from .builtin import ChainElement, ProcessingResult
+from .builtin import ChainElement, FrameContext
 from settingstree import SettingsNode, NodeInput
+from chain.tools import setting_to_bool
+from time import perf_counter, sleep
+from threading import Thread, Condition
 
 log = Logger(__name__)
 
 
+class SteeringFilter:
+    """
+    Turns the angles computed from frames into steering commands.
+    When the command reaches the controller, the frame it was computed from is already capture + processing time old.
+    The filter smooths the angles with an exponential moving average, measures how fast the smoothed angle changes
+    between the capture times of consecutive frames and extrapolates it over that latency. The change of the command
+    is rate limited at the end.
+    """
+    def __init__(self, smoothing=0.0, max_rate=0.0, compensation=True, max_latency=0.2):
+        """
+        :param smoothing: Weight of the previous smoothed angle (0 = no smoothing).
+        :param max_rate: Maximum change of the command per second (0 = unlimited).
+        :param compensation: Extrapolate the angle over the latency.
+        :param max_latency: Longest latency (seconds) to extrapolate over. Longer gaps between frames reset the rate.
+        """
+        self.smoothing = smoothing
+        self.max_rate = max_rate
+        self.compensation = compensation
+        self.max_latency = max_latency
+        self.reset()
+
+    def reset(self):
+        self.latency = None
+        self._smoothed_angle = None
+        self._angle_rate = 0.0
+        self._capture_time = None
+        self._command = None
+        self._command_time = None
+
+    def update(self, angle: float, capture_time, now: float) -> float:
+        """
+        Returns the steering command (-1 <= command <= 1) for angle.
+        :param capture_time: perf_counter() timestamp of the capture of the frame angle was computed from. Without it
+                             the latency is unknown and the angle does not get extrapolated.
+        :param now: perf_counter() timestamp of the actuation.
+        """
+        if self._smoothed_angle is None:
+            smoothed_angle = angle
+        else:
+            smoothed_angle = self.smoothing * self._smoothed_angle + (1 - self.smoothing) * angle
+
+        if capture_time is None:
+            self.latency = None
+            self._angle_rate = 0.0
+            self._smoothed_angle = smoothed_angle
+        elif capture_time == self._capture_time:
+            # The threaded capture hands out the same frame again if the chain is faster than the grabber. Keep angle
+            # and rate, only the latency grows, otherwise the extrapolation would switch on and off between frames.
+            self.latency = now - capture_time
+        else:
+            self.latency = now - capture_time
+            if self._capture_time is not None and 0 < capture_time - self._capture_time <= self.max_latency:
+                self._angle_rate = (smoothed_angle - self._smoothed_angle) / (capture_time - self._capture_time)
+            else:
+                self._angle_rate = 0.0
+            self._capture_time = capture_time
+            self._smoothed_angle = smoothed_angle
+
+        smoothed_angle = self._smoothed_angle
+
+        command = smoothed_angle
+        if self.compensation and self.latency is not None:
+            command += self._angle_rate * min(max(self.latency, 0), self.max_latency)
+
+        if self.max_rate and self._command is not None:
+            max_change = self.max_rate * max(now - self._command_time, 0)
+            command = min(max(command, self._command - max_change), self._command + max_change)
+
+        self._command = min(max(command, -1.0), 1.0)
+        self._command_time = now
+        return self._command
+
+
 class ControllerInstance(ChainElement):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.latency_compensation = SettingsNode(key='latency_compensation', value='1', widget=NodeInput,
+                                                 verbose_name='Extrapolate angle over capture to output latency (1/0)')
+        self.smoothing = SettingsNode(key='smoothing', value='0.3', widget=NodeInput,
+                                      verbose_name='Weight of the last angle (0-1)')
+        self.max_rate = SettingsNode(key='max_rate', value='4', widget=NodeInput,
+                                     verbose_name='Maximum angle change per second (0 for unlimited)')
+
+        self.steering_filter = SteeringFilter()
+
+    def start(self):
+        self.steering_filter.reset()
+
+    def get_steering_angle(self, context: FrameContext) -> float:
+        """
+        Returns context.angle compensated for the time since the frame was captured, smoothed and rate limited with
+        the settings of the controller. Also sends angle and latency to the UI.
+        """
+        self.steering_filter.smoothing = float(self.smoothing.value)
+        self.steering_filter.max_rate = float(self.max_rate.value)
+        self.steering_filter.compensation = setting_to_bool(self.latency_compensation.value)
+
+        angle = self.steering_filter.update(context.angle, context.capture_time, perf_counter())
+
+        context.data_to_send['angle'] = angle
+        if self.steering_filter.latency is not None:
+            context.data_to_send['latency'] = self.steering_filter.latency * 1000
+        return angle
+
+    @abstractmethod
+    def process(self, context: FrameContext):
+        """
+        This method takes the steering angle context.angle (-1 <= angle <= 1) and passes it to a controller device.
+        Use get_steering_angle() to get the compensated angle.
+        :param context: FrameContext of the current frame.
+        """
+
+
+class ControllerBackend(ABC):
+    """
+    Driver of a controller device with one steering axis.
+    """
+    def open(self):
+        """
+        Opens the device. Gets called once before the first set_axis().
+        """
+
     @abstractmethod
-    def process(self, angle, *args, **kwargs):
+    def set_axis(self, value: float):
+        """
+        Moves the steering axis.
+        :param value: -1 <= value <= 1
+        """
+
+    def close(self):
+        """
+        Releases the device.
+        """
+
+
+class VjoyBackend(ControllerBackend):
+    # Highest value of a vJoy axis.
+    AXIS_MAX = 32768
+
+    def __init__(self, pyvjoy, device_id: int):
         """
-        This method takes a steering angle and passes it to a controller device.
-        :param angle: Steering angle (-1 <= angle <= 1)
+        :param pyvjoy: The imported pyvjoy module.
         """
+        self.pyvjoy = pyvjoy
+        self.device_id = device_id
+        self._device = None
+
+    def open(self):
+        self._device = self.pyvjoy.VJoyDevice(self.device_id)
+        self._device.reset()
+
+    def set_axis(self, value: float):
+        self._device.set_axis(self.pyvjoy.HID_USAGE_X, int((value + 1) * self.AXIS_MAX / 2))
+
+    def close(self):
+        if self._device is not None:
+            self._device.reset()
+            self._device = None
+
+
+class FakeControllerBackend(ControllerBackend):
+    """
+    In-memory backend which records the written values. Useful for tests and systems without a controller driver.
+    """
+    def __init__(self, write_delay=0.0):
+        """
+        :param write_delay: Seconds every set_axis() takes, to simulate a slow driver.
+        """
+        self.write_delay = write_delay
+        self.values = []
+        self.is_open = False
+
+    def open(self):
+        self.is_open = True
+
+    def set_axis(self, value: float):
+        if self.write_delay:
+            sleep(self.write_delay)
+        self.values.append(value)
+
+    def close(self):
+        self.is_open = False
+
+
+class ControllerOutput:
+    """
+    Writes axis values to a ControllerBackend. Values within the deadband of the last accepted value are skipped.
+    With a threaded output a dedicated thread performs the writes. write() only replaces the pending value, so a slow
+    driver call never stalls the chain and values which got overtaken before they were written are dropped.
+    """
+    def __init__(self, backend: ControllerBackend, deadband=0.0, threaded=True):
+        self.backend = backend
+        self.deadband = deadband
+        self.threaded = threaded
+
+        self.written_values = 0
+        self.skipped_values = 0
+        self.dropped_values = 0
+
+        self._last_value = None
+        self._pending_value = None
+        self._condition = Condition()
+        self._output_thread = None
+        self._running = False
+
+    def start(self):
+        self.backend.open()
+        self._last_value = None
+
+        if self.threaded:
+            self._running = True
+            self._output_thread = Thread(target=self._output_loop, name=self.backend.__class__.__name__, daemon=True)
+            self._output_thread.start()
+
+    def stop(self):
+        """
+        Writes the pending value, stops the output thread and closes the backend.
+        """
+        if self._output_thread is not None:
+            with self._condition:
+                self._running = False
+                self._condition.notify_all()
+            self._output_thread.join()
+            self._output_thread = None
+
+        self.backend.close()
+
+    def write(self, value: float) -> bool:
+        """
+        Passes value to the backend unless it is within the deadband.
+        :return: False if the value got skipped.
+        """
+        if self._last_value is not None and abs(value - self._last_value) <= self.deadband:
+            self.skipped_values += 1
+            return False
+
+        self._last_value = value
+        if not self.threaded:
+            self._write(value)
+            return True
+
+        with self._condition:
+            if self._pending_value is not None:
+                self.dropped_values += 1
+            self._pending_value = value
+            self._condition.notify_all()
+        return True
+
+    def get_stats(self) -> dict:
+        return {'written': self.written_values, 'skipped': self.skipped_values, 'dropped': self.dropped_values}
+
+    def _write(self, value: float):
+        self.backend.set_axis(value)
+        self.written_values += 1
+
+    def _output_loop(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending_value is not None or not self._running)
+                value, self._pending_value = self._pending_value, None
+
+            if value is not None:
+                try:
+                    self._write(value)
+                except Exception:
+                    log.exception(f'Error while writing to {self.backend}.')
+            elif not self._running:
+                return
 
 
 class VjoyController(ControllerInstance):
     """
-    ControllerInstance for VJoy.
+    ControllerInstance for VJoy. The device is opened once on start() and written by a ControllerOutput.
     """
-    def __init__(self):
+    def __init__(self, backend: ControllerBackend = None):
+        """
+        :param backend: Write to this backend instead of vJoy (e.g. FakeControllerBackend for tests).
+        """
         super().__init__()
 
         self.vjoy_device = SettingsNode(key='vjoy_device', value='0', widget=NodeInput, verbose_name='vJoy Device ID')
+        self.deadband = SettingsNode(key='deadband', value='0.002', widget=NodeInput,
+                                     verbose_name='Skip angle changes up to (deadband)')
+        self.threaded_output = SettingsNode(key='threaded_output', value='1', widget=NodeInput,
+                                            verbose_name='Write to the device in a background thread (1/0)')
+
+        self.backend = backend
+        self.output = None
 
     def import_dependencies(self):
-        self._import_helper('pyvjoy', 'pyvjoy')
+        if self.backend is None:
+            self._import_helper('pyvjoy', 'pyvjoy')
+
+    def start(self):
+        super().start()
+
+        if self.output is not None:
+            return
+
+        backend = self.backend
+        if backend is None:
+            backend = VjoyBackend(self._imported_dependencies['pyvjoy'], int(self.vjoy_device.value))
+
+        self.output = ControllerOutput(backend, threaded=setting_to_bool(self.threaded_output.value))
+        self.output.start()
 
-    def process(self, angle, *args, **kwargs):
-        # Write angle to vjoy.
-        vjoy_controller = self._imported_dependencies['pyvjoy'].VJoyDevice(int(self.vjoy_device.value))
-        vjoy_controller.reset()
+    def stop(self):
+        if self.output is not None:
+            self.output.stop()
+            self.output = None
 
-        vjoy_angle = (angle + 1) * 32768 / 2
+    def process(self, context: FrameContext):
+        # start() resets the steering filter, so it has to happen before the first angle goes through the filter.
+        if self.output is None:
+            self.start()
 
-        vjoy_controller.set_axis(self._imported_dependencies['pyvjoy'].HID_USAGE_X, vjoy_angle)
+        angle = self.get_steering_angle(context)
 
-        # Send angle to UI
-        return ProcessingResult(data_to_send={'angle': angle})
+        self.output.deadband = float(self.deadband.value)
+        self.output.write(angle)
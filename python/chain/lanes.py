@@ -0,0 +1,299 @@
+"""
+Vectorized lane detection for grayscale viewport frames.
+
+The full search (detect_lanes) is Canny edge detection below the horizon, a column histogram of the lower half to find
+where the lanes start and a sliding window search upwards which collects the edge pixels of each lane. Every lane gets a
+second order polynomial x = f(y) fitted through its pixels. Pixels are only touched by OpenCV and NumPy, Python only
+loops over the few search windows.
+
+Lanes barely move between frames, so track_lanes only detects edges in a narrow band around the fits of the previous
+frame.
+"""
+import numpy as np
+import cv2
+
+# Polynomial order of the lane fits.
+FIT_ORDER = 2
+
+
+class LaneDetection:
+    """
+    Lanes found in one frame. The fits are np.polyfit coefficients of x = f(y) in frame coordinates or None if the
+    lane was not found.
+    """
+    __slots__ = ('left_fit', 'right_fit', 'shape', 'horizon_row', 'left_pixel_count', 'right_pixel_count', 'tracked')
+
+    def __init__(self, shape, horizon_row, left_fit=None, right_fit=None, left_pixel_count=0, right_pixel_count=0,
+                 tracked=False):
+        """
+        :param tracked: True if the lanes were found by track_lanes instead of a full search.
+        """
+        self.shape = shape
+        self.horizon_row = horizon_row
+        self.tracked = tracked
+        self.left_fit = left_fit
+        self.right_fit = right_fit
+        self.left_pixel_count = left_pixel_count
+        self.right_pixel_count = right_pixel_count
+
+    def has_lanes(self) -> bool:
+        return self.left_fit is not None and self.right_fit is not None
+
+    def get_center_fit(self):
+        """
+        Returns the polynomial of the lane center or None if one of the lanes is missing.
+        """
+        if not self.has_lanes():
+            return None
+
+        return (self.left_fit + self.right_fit) / 2
+
+    def rescaled(self, scale):
+        """
+        Returns the detection in the coordinates of a frame which is 1 / scale times the size of the detection frame
+        (e.g. the viewport if the lanes were detected in a frame downscaled by context.scale).
+        """
+        height, width = self.shape
+        return LaneDetection((int(round(height / scale)), int(round(width / scale))),
+                             int(round(self.horizon_row / scale)), scale_fit(self.left_fit, scale),
+                             scale_fit(self.right_fit, scale), self.left_pixel_count, self.right_pixel_count,
+                             self.tracked)
+
+    def is_plausible(self) -> bool:
+        """
+        Checks that both lanes exist and the left lane stays left of the right lane between horizon and bottom.
+        """
+        if not self.has_lanes():
+            return False
+
+        rows = (self.horizon_row, self.shape[0] - 1)
+        return bool(np.all(np.polyval(self.right_fit, rows) > np.polyval(self.left_fit, rows)))
+
+
+def scale_fit(fit, scale):
+    """
+    Maps the polynomial x = f(y) of a frame scaled by scale back to the unscaled frame. None stays None.
+    """
+    if fit is None:
+        return None
+
+    # x = f(y * scale) / scale, so the coefficient of y^k gets multiplied with scale^(k-1).
+    powers = np.arange(fit.shape[0] - 1, -1, -1)
+    return fit * np.power(float(scale), powers - 1)
+
+
+def get_horizon_row(height, horizon) -> int:
+    """
+    Returns the first row below the horizon.
+    :param horizon: Fraction of the frame height from the top which is ignored.
+    """
+    return min(height - 1, int(height * horizon))
+
+
+def detect_edges(gray, horizon_row, low_threshold, high_threshold, output_buffers=None):
+    """
+    Returns the Canny edges of the rows below horizon_row.
+    :param gray: Grayscale frame.
+    :param output_buffers: chain.tools.OutputBuffers to write the blurred frame and the edges into.
+    """
+    road = gray[horizon_row:]
+    blurred = edges = None
+    if output_buffers is not None:
+        # Both arrays have the same shape, so the buffers alternate between them.
+        blurred = output_buffers.get(road.shape, np.uint8, depth=2)
+        edges = output_buffers.get(road.shape, np.uint8, depth=2)
+
+    blurred = cv2.GaussianBlur(road, (5, 5), 0, dst=blurred)
+    return cv2.Canny(blurred, low_threshold, high_threshold, edges=edges)
+
+
+def find_lane_bases(ys, xs, width, split_row, margin, min_pixels):
+    """
+    Returns the columns where the left and the right lane start at the bottom of the frame. They are the peaks of the
+    column histogram of the edge pixels below split_row in the left and the right half of the frame. The histogram gets
+    summed over windows of 2 * margin + 1 columns first, slanted lanes only hit a few pixels per column. A base is None
+    if its window has less than min_pixels edge pixels.
+    """
+    histogram = np.bincount(xs[ys >= split_row], minlength=width)
+    histogram = np.convolve(histogram, np.ones(2 * margin + 1, dtype=np.int64), mode='same')
+    middle = width // 2
+
+    left_base = int(np.argmax(histogram[:middle]))
+    right_base = middle + int(np.argmax(histogram[middle:]))
+
+    return (left_base if histogram[left_base] >= min_pixels else None,
+            right_base if histogram[right_base] >= min_pixels else None)
+
+
+def sliding_window_search(ys, xs, base_x, y_range, window_count, margin, min_pixels):
+    """
+    Collects the pixels of one lane with windows stacked from the bottom to the top of y_range. Each window is
+    2 * margin wide and centered on the mean column of the pixels found in the window below.
+    :param ys: Rows of all edge pixels, sorted ascending (like np.nonzero returns them).
+    :param xs: Columns of all edge pixels.
+    :param base_x: Column the lane starts at the bottom.
+    :param y_range: (top, bottom) rows of the searched area.
+    :return: Indices of the lane pixels in ys and xs.
+    """
+    top, bottom = y_range
+    window_height = max(1, (bottom - top) // window_count)
+    current_x = base_x
+    lane_indices = []
+
+    for window in range(window_count):
+        window_bottom = bottom - window * window_height
+        window_top = max(top, window_bottom - window_height)
+        # ys is sorted, so the pixels of the window rows are one slice.
+        start, end = np.searchsorted(ys, (window_top, window_bottom))
+        window_xs = xs[start:end]
+
+        in_window = np.flatnonzero(np.abs(window_xs - current_x) <= margin)
+        lane_indices.append(in_window + start)
+
+        if in_window.shape[0] >= min_pixels:
+            current_x = int(window_xs[in_window].mean())
+
+    return np.concatenate(lane_indices)
+
+
+def fit_lane(ys, xs, indices, min_pixels):
+    """
+    Fits x = f(y) through the given pixels. Returns None if there are less than min_pixels.
+    """
+    if indices.shape[0] < min_pixels:
+        return None
+
+    return np.polyfit(ys[indices], xs[indices], FIT_ORDER)
+
+
+def detect_lanes(gray, horizon=0.4, low_threshold=50, high_threshold=150, window_count=9, margin=0.05,
+                 min_pixels=50, output_buffers=None) -> LaneDetection:
+    """
+    Detects the left and the right lane in a grayscale frame.
+    :param horizon: Fraction of the frame height from the top which is ignored.
+    :param low_threshold: Lower hysteresis threshold of the Canny edge detection.
+    :param high_threshold: Upper hysteresis threshold of the Canny edge detection.
+    :param window_count: Number of stacked sliding windows per lane.
+    :param margin: Half width of a sliding window as fraction of the frame width.
+    :param min_pixels: Minimum number of edge pixels to accept a lane base, to recenter a window and to fit a lane.
+    :param output_buffers: chain.tools.OutputBuffers for the intermediate frames.
+    """
+    height, width = gray.shape[:2]
+    horizon_row = get_horizon_row(height, horizon)
+
+    edges = detect_edges(gray, horizon_row, low_threshold, high_threshold, output_buffers)
+    detection = LaneDetection(gray.shape[:2], horizon_row)
+    # findNonZero is much faster than np.nonzero for sparse edges. The points are sorted by row as well.
+    points = cv2.findNonZero(edges)
+    if points is None:
+        return detection
+
+    points = points.reshape(-1, 2)
+    xs = points[:, 0]
+    ys = points[:, 1] + horizon_row
+
+    margin_px = max(1, int(width * margin))
+    lane_bases = find_lane_bases(ys, xs, width, (horizon_row + height) // 2, margin_px, min_pixels)
+    for side, base_x in zip(('left', 'right'), lane_bases):
+        if base_x is None:
+            continue
+
+        indices = sliding_window_search(ys, xs, base_x, (horizon_row, height), window_count, margin_px, min_pixels)
+        setattr(detection, f'{side}_fit', fit_lane(ys, xs, indices, min_pixels))
+        setattr(detection, f'{side}_pixel_count', indices.shape[0])
+
+    return detection
+
+
+def track_lanes(gray, previous: LaneDetection, horizon=0.4, low_threshold=50, high_threshold=150, strip_count=9,
+                margin=0.02, min_pixels=50) -> LaneDetection:
+    """
+    Finds the lanes of previous again. The road below the horizon is split into strip_count strips and edges are only
+    detected in a box per strip and lane which covers the previous fit plus margin. That is a small part of the frame,
+    so tracking is much cheaper than detect_lanes. A lane is None if less than min_pixels edge pixels are within margin
+    of its previous fit or if they are in less than half of the strips (e.g. only the far end of a lane which moved).
+    :param previous: Detection of the last frame. Both lanes have to exist.
+    :param margin: Distance from the previous fit as fraction of the frame width.
+    The other parameters are the same as for detect_lanes.
+    """
+    height, width = gray.shape[:2]
+    horizon_row = get_horizon_row(height, horizon)
+    margin_px = max(1, int(width * margin))
+    strip_rows = np.linspace(horizon_row, height, strip_count + 1).astype(np.int64)
+
+    detection = LaneDetection(gray.shape[:2], horizon_row, tracked=True)
+    for side in ('left', 'right'):
+        previous_fit = getattr(previous, f'{side}_fit')
+        # Columns of the previous fit at the strip borders. The margin covers the curvature within a strip.
+        fit_columns = np.polyval(previous_fit, strip_rows)
+        strip_ys, strip_xs = [], []
+
+        for index, (top, bottom) in enumerate(zip(strip_rows[:-1], strip_rows[1:])):
+            left = max(0, int(min(fit_columns[index], fit_columns[index + 1])) - margin_px)
+            right = min(width, int(max(fit_columns[index], fit_columns[index + 1])) + margin_px + 1)
+            if right - left < 3 or bottom <= top:
+                continue
+
+            blurred = cv2.GaussianBlur(gray[top:bottom, left:right], (5, 5), 0)
+            points = cv2.findNonZero(cv2.Canny(blurred, low_threshold, high_threshold))
+            if points is None:
+                continue
+
+            points = points.reshape(-1, 2)
+            strip_xs.append(points[:, 0] + left)
+            strip_ys.append(points[:, 1] + top)
+
+        if not strip_ys:
+            continue
+
+        ys = np.concatenate(strip_ys)
+        xs = np.concatenate(strip_xs)
+        indices = np.flatnonzero(np.abs(xs - np.polyval(previous_fit, ys)) <= margin_px)
+        covered_strips = np.unique(np.searchsorted(strip_rows, ys[indices], side='right')).shape[0]
+        if covered_strips * 2 < strip_count:
+            continue
+
+        setattr(detection, f'{side}_fit', fit_lane(ys, xs, indices, min_pixels))
+        setattr(detection, f'{side}_pixel_count', indices.shape[0])
+
+    return detection
+
+
+def steering_angle(center_fit, shape, lookahead=0.3, gain=1.0) -> float:
+    """
+    Returns the steering angle in [-1, 1] which moves the frame center onto the lane center. Positive values steer to
+    the right.
+    :param center_fit: Polynomial of the lane center.
+    :param shape: Shape of the frame the polynomial was fitted in.
+    :param lookahead: Row to steer towards as fraction of the frame height from the bottom.
+    :param gain: Multiplier of the normalized offset between lane center and frame center.
+    """
+    height, width = shape[:2]
+    lookahead_row = (height - 1) * (1 - lookahead)
+    half_width = width / 2
+    offset = (np.polyval(center_fit, lookahead_row) - half_width) / half_width
+
+    return float(np.clip(gain * offset, -1, 1))
+
+
+def draw_lane_overlay(gray, detection: LaneDetection, output_buffers=None, point_count=20):
+    """
+    Returns a BGR copy of the grayscale frame with the detected lanes (green) and their center (red) drawn on it.
+    """
+    overlay = None
+    if output_buffers is not None:
+        overlay = output_buffers.get(gray.shape[:2] + (3,), np.uint8)
+    overlay = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR, dst=overlay)
+
+    rows = np.linspace(detection.horizon_row, detection.shape[0] - 1, point_count)
+    fits = ((detection.left_fit, (0, 255, 0)), (detection.right_fit, (0, 255, 0)),
+            (detection.get_center_fit(), (0, 0, 255)))
+    thickness = max(2, detection.shape[1] // 300)
+    for fit, color in fits:
+        if fit is None:
+            continue
+
+        points = np.column_stack((np.polyval(fit, rows), rows)).astype(np.int32)
+        cv2.polylines(overlay, [points], False, color, thickness)
+
+    return overlay
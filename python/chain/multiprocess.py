@@ -0,0 +1,258 @@
+"""
+Runs chain elements in worker processes. Frames are handed over through shared memory instead of being pickled, only
+small values (settings, angles, encoded images) go through the pipe.
+Needs Python 3.8 (multiprocessing.shared_memory), chain only imports this module if an element sets RUN_IN_PROCESS.
+"""
+from logging import Logger
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from .builtin import ChainElement, FrameContext
+from settingstree import SettingsNode
+import numpy as np
+
+log = Logger(__name__)
+
+
+class SharedFrameBuffer:
+    """
+    Shared memory block owned by the main process. It gets replaced by a larger block if a frame does not fit.
+    """
+    def __init__(self):
+        self._shared_memory = None
+
+    @property
+    def name(self):
+        return self._shared_memory.name if self._shared_memory else None
+
+    @property
+    def size(self) -> int:
+        return self._shared_memory.size if self._shared_memory else 0
+
+    def ensure_size(self, nbytes: int):
+        if nbytes > self.size:
+            self.release()
+            self._shared_memory = SharedMemory(create=True, size=max(nbytes, 1))
+
+    def write(self, frame: np.ndarray) -> tuple:
+        """
+        Copies the frame into the shared memory.
+        :return: Description (name, shape, dtype) the worker needs to map the frame.
+        """
+        self.ensure_size(frame.nbytes)
+        np.copyto(self.view(frame.shape, frame.dtype), frame)
+        return self.name, frame.shape, frame.dtype.str
+
+    def view(self, shape, dtype) -> np.ndarray:
+        return np.ndarray(shape=shape, dtype=dtype, buffer=self._shared_memory.buf)
+
+    def release(self):
+        if self._shared_memory is not None:
+            self._shared_memory.close()
+            self._shared_memory.unlink()
+            self._shared_memory = None
+
+
+class SharedArray:
+    """
+    Placeholder for an array the worker wrote into the output buffer.
+    """
+    def __init__(self, shape, dtype):
+        self.shape = shape
+        self.dtype = dtype
+
+
+class UnchangedFrame:
+    """
+    Placeholder for a frame the element did not replace.
+    """
+
+
+class _AttachedMemory:
+    """
+    Shared memory blocks the worker attached to, by role. Blocks get closed as soon as the main process replaces them.
+    """
+    def __init__(self):
+        self._blocks = {}
+
+    def get(self, role, name) -> SharedMemory:
+        current = self._blocks.get(role)
+        if current is None or current.name != name:
+            self._close(current)
+            current = self._blocks[role] = SharedMemory(name=name)
+
+        return current
+
+    @staticmethod
+    def _close(shared_memory):
+        if shared_memory is None:
+            return
+
+        try:
+            shared_memory.close()
+        except BufferError:
+            # An element still holds a view on the frame. The memory gets released when the worker exits.
+            pass
+
+    def close(self):
+        for shared_memory in self._blocks.values():
+            self._close(shared_memory)
+        self._blocks = {}
+
+
+def _process_request(element: ChainElement, context: FrameContext, request: tuple, attached_memory: _AttachedMemory):
+    (input_name, shape, dtype), (output_name, output_size), settings_values, context_values = request
+
+    for attribute, value in settings_values.items():
+        getattr(element, attribute).value = value
+
+    frame_number, capture_time, capture_bbox, angle, scale, preview_scale = context_values
+    context.reset(frame_number)
+    context.capture_time, context.capture_bbox, context.angle, context.scale = capture_time, capture_bbox, angle, scale
+    context.preview_scale = preview_scale
+
+    input_memory = attached_memory.get('input', input_name)
+    input_frame = np.ndarray(shape=shape, dtype=np.dtype(dtype), buffer=input_memory.buf)
+    context.frame = input_frame
+    element.process(context)
+
+    # Put the new frame into the output buffer if it fits. Otherwise it gets pickled.
+    frame = context.frame
+    if frame is input_frame:
+        frame = UnchangedFrame()
+    elif isinstance(frame, np.ndarray) and frame.nbytes <= output_size:
+        output_memory = attached_memory.get('output', output_name)
+        np.copyto(np.ndarray(shape=frame.shape, dtype=frame.dtype, buffer=output_memory.buf), frame)
+        frame = SharedArray(frame.shape, frame.dtype.str)
+
+    return frame, context.angle, context.scale, context.data_to_send, context.preview_frames
+
+
+def _worker_main(element: ChainElement, connection):
+    attached_memory = _AttachedMemory()
+    context = FrameContext()
+    element.warm_up()
+    element.start()
+
+    try:
+        while True:
+            request = connection.recv()
+            if request is None:
+                break
+
+            try:
+                response = ('ok', _process_request(element, context, request, attached_memory))
+            except Exception as e:
+                response = ('error', e)
+
+            try:
+                connection.send(response)
+            except Exception as e:
+                # E.g. the exception can not be pickled.
+                connection.send(('error', RuntimeError(repr(e))))
+            finally:
+                # Release the view on the input memory.
+                context.reset()
+    finally:
+        element.stop()
+        attached_memory.close()
+
+
+class ProcessChainElement(ChainElement):
+    """
+    Wraps a chain element and runs its process method in a worker process. This frees the main process (capturing,
+    control, web server) from CPU-heavy elements and lets them use other cores than the GIL-bound main process.
+    The frame is copied into shared memory. A new frame set by the element is passed back the same way and copied out
+    again, so it stays valid independently of the worker. The other context values, data_to_send, the preview frames
+    and the settings values of the element are pickled, so they should be small.
+    The wrapped element gets pickled into the worker, see ChainElement.__getstate__.
+    Elements with RUN_IN_PROCESS set get wrapped automatically by ProcessingChain.register.
+    """
+    def __init__(self, chain_element: ChainElement):
+        if not isinstance(chain_element, ChainElement):
+            raise TypeError('chain_element needs to be an instance of chain.ChainElement!')
+
+        super().__init__()
+
+        self.chain_element = chain_element
+        self._process = None
+        self._connection = None
+        self._input_buffer = SharedFrameBuffer()
+        self._output_buffer = SharedFrameBuffer()
+
+    def get_name(self) -> str:
+        return f'{self.chain_element.get_name()} (process)'
+
+    def warm_up(self):
+        # The worker imports the dependencies of the wrapped element. Starting it takes the longest anyway.
+        self.start()
+
+    def collect_settings(self) -> SettingsNode:
+        return self.chain_element.collect_settings()
+
+    def collect_web_functions(self) -> dict:
+        return self.chain_element.collect_web_functions()
+
+    def is_running(self) -> bool:
+        return self._process is not None and self._process.is_alive()
+
+    def start(self):
+        if self.is_running():
+            return
+
+        # Spawn instead of fork, forking a process with running threads is unsafe.
+        context = get_context('spawn')
+        self._connection, worker_connection = context.Pipe()
+        self._process = context.Process(target=_worker_main, args=(self.chain_element, worker_connection),
+                                        name=self.get_name(), daemon=True)
+        self._process.start()
+        worker_connection.close()
+
+    def stop(self):
+        if self._process is not None:
+            try:
+                self._connection.send(None)
+            except (OSError, ValueError):
+                pass
+
+            self._process.join()
+            self._connection.close()
+            self._process = None
+            self._connection = None
+
+        self._input_buffer.release()
+        self._output_buffer.release()
+
+    def _get_settings_values(self) -> dict:
+        return {attribute: value.value for attribute, value in vars(self.chain_element).items()
+                if isinstance(value, SettingsNode)}
+
+    def process(self, context: FrameContext):
+        if not self.is_running():
+            self.start()
+
+        frame = np.asarray(context.frame)
+        input_description = self._input_buffer.write(frame)
+        self._output_buffer.ensure_size(frame.nbytes)
+
+        self._connection.send((input_description, (self._output_buffer.name, self._output_buffer.size),
+                               self._get_settings_values(),
+                               (context.frame_number, context.capture_time, context.capture_bbox, context.angle,
+                                context.scale,
+                                context.preview_scale)))
+
+        try:
+            status, response = self._connection.recv()
+        except EOFError:
+            raise RuntimeError(f'The worker process of {self.chain_element.get_name()} died.')
+
+        if status == 'error':
+            raise response
+
+        frame, context.angle, context.scale, data_to_send, preview_frames = response
+        if isinstance(frame, SharedArray):
+            context.frame = self._output_buffer.view(frame.shape, np.dtype(frame.dtype)).copy()
+        elif not isinstance(frame, UnchangedFrame):
+            context.frame = frame
+
+        context.data_to_send.update(data_to_send)
+        context.preview_frames.update(preview_frames)
@@ -0,0 +1,51 @@
+"""
+Rewrites the list of registered chain elements into an equivalent, faster list of elements which gets executed.
+"""
+from logging import Logger
+from chain import processing
+
+log = Logger(__name__)
+
+
+def fuse_grayscale_roi(elements: list) -> list:
+    """
+    Replaces every sequence ColorConversionPreProcessingUnit, ROIPreProcessingUnit,
+    GrayscaleConversionPreProcessingUnit by one FusedGrayscaleROIPreProcessingUnit.
+    """
+    pattern = (processing.ColorConversionPreProcessingUnit, processing.ROIPreProcessingUnit,
+               processing.GrayscaleConversionPreProcessingUnit)
+    result = []
+    i = 0
+
+    while i < len(elements):
+        candidates = elements[i:i + len(pattern)]
+        if len(candidates) == len(pattern) and \
+                all(type(element) is element_class for element, element_class in zip(candidates, pattern)) and \
+                processing.FusedGrayscaleROIPreProcessingUnit.can_fuse(candidates[0]):
+            result.append(processing.FusedGrayscaleROIPreProcessingUnit(*candidates))
+            i += len(pattern)
+        else:
+            result.append(elements[i])
+            i += 1
+
+    return result
+
+
+# Optimizations get applied in this order.
+OPTIMIZATIONS = [
+    fuse_grayscale_roi,
+]
+
+
+def optimize(elements: list) -> list:
+    """
+    Returns a new list of chain elements with all OPTIMIZATIONS applied.
+    """
+    optimized_elements = list(elements)
+    for optimization in OPTIMIZATIONS:
+        optimized_elements = optimization(optimized_elements)
+
+    if len(optimized_elements) != len(elements):
+        log.info(f'Optimized chain: {[element.get_name() for element in optimized_elements]}')
+
+    return optimized_elements
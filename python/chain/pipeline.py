@@ -0,0 +1,197 @@
+from logging import Logger
+from threading import Thread, Event
+from queue import Queue, SimpleQueue, Empty, Full
+from time import perf_counter
+from .builtin import FrameContext
+
+log = Logger(__name__)
+
+DROP_POLICY_BLOCK = 'block'
+DROP_POLICY_DROP_OLDEST = 'drop_oldest'
+DROP_POLICY_DROP_NEWEST = 'drop_newest'
+DROP_POLICIES = (DROP_POLICY_BLOCK, DROP_POLICY_DROP_OLDEST, DROP_POLICY_DROP_NEWEST)
+
+
+class StageQueue:
+    """
+    Bounded queue between two pipeline stages. The drop policy decides what happens if the queue is full:
+
+    * block: Wait until the next stage took an item (backpressure).
+    * drop_oldest: Throw away the oldest waiting item.
+    * drop_newest: Throw away the new item.
+    """
+    # Seconds between checks of the stop event while waiting.
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, maxsize=2, drop_policy=DROP_POLICY_BLOCK, on_drop=None):
+        """
+        :param on_drop: Gets called with every dropped item.
+        """
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f'drop_policy needs to be one of {DROP_POLICIES}.')
+
+        self.drop_policy = drop_policy
+        self.dropped_items = 0
+        self._on_drop = on_drop
+        self._queue = Queue(maxsize=maxsize)
+
+    def _drop(self, item):
+        self.dropped_items += 1
+        if self._on_drop is not None:
+            self._on_drop(item)
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def put(self, item, stop_event: Event):
+        if self.drop_policy == DROP_POLICY_BLOCK:
+            while not stop_event.is_set():
+                try:
+                    self._queue.put(item, timeout=self.POLL_INTERVAL)
+                    return
+                except Full:
+                    pass
+        elif self.drop_policy == DROP_POLICY_DROP_NEWEST:
+            try:
+                self._queue.put_nowait(item)
+            except Full:
+                self._drop(item)
+        else:
+            while True:
+                try:
+                    self._queue.put_nowait(item)
+                    return
+                except Full:
+                    try:
+                        self._drop(self._queue.get_nowait())
+                    except Empty:
+                        pass
+
+    def get(self, stop_event: Event, timeout=None):
+        """
+        Returns the next item or None if stop_event was set (or timeout passed) before an item arrived.
+        """
+        deadline = None if timeout is None else perf_counter() + timeout
+
+        while not stop_event.is_set():
+            try:
+                return self._queue.get(timeout=self.POLL_INTERVAL)
+            except Empty:
+                if deadline is not None and perf_counter() >= deadline:
+                    return None
+
+        return None
+
+
+class PipelinedExecutor:
+    """
+    Runs groups of chain elements (stages) in their own threads, connected through StageQueues. While the last stage
+    works on frame n the first stage already captures frame n+1 and so on. Every stage has exactly one thread, so the
+    order of frames is kept.
+    FrameContexts are recycled: the context returned by get_result() is reused once get_result() gets called again.
+    """
+    def __init__(self, stages: list, run_elements, queue_size=2, drop_policy=DROP_POLICY_BLOCK, prepare_context=None):
+        """
+        :param stages: List of lists with chain elements. Every inner list is executed by one thread.
+        :param run_elements: Callable (elements, FrameContext) which processes the context with the given elements.
+        :param prepare_context: Callable (FrameContext) which gets called with every new frame before the first stage.
+        :param queue_size: Maximum number of frames waiting in front of each stage.
+        :param drop_policy: What to do if a stage falls behind. See StageQueue.
+        """
+        self.stages = [list(stage) for stage in stages if stage]
+        self._run_elements = run_elements
+        self._prepare_context = prepare_context
+        self._queues = [StageQueue(queue_size, drop_policy, on_drop=self._release_context) for _ in self.stages]
+        self._threads = []
+        self._stop_event = Event()
+        self._error = None
+        self._free_contexts = SimpleQueue()
+        self._returned_context = None
+        self._frame_number = 0
+
+    def _acquire_context(self) -> FrameContext:
+        try:
+            context = self._free_contexts.get_nowait()
+        except Empty:
+            context = FrameContext()
+
+        context.reset(self._frame_number)
+        self._frame_number += 1
+        if self._prepare_context is not None:
+            self._prepare_context(context)
+        return context
+
+    def _release_context(self, context: FrameContext):
+        self._free_contexts.put(context)
+
+    def is_running(self) -> bool:
+        return any(thread.is_alive() for thread in self._threads)
+
+    def start(self):
+        if self._threads:
+            return
+
+        self._stop_event.clear()
+        input_queues = [None] + self._queues[:-1]
+
+        for stage, input_queue, output_queue in zip(self.stages, input_queues, self._queues):
+            thread = Thread(target=self._stage_loop, args=(stage, input_queue, output_queue), daemon=True,
+                            name=f'Stage {" > ".join(element.get_name() for element in stage)}')
+            self._threads.append(thread)
+            thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+        for thread in self._threads:
+            thread.join()
+
+        self._threads = []
+
+    def _stage_loop(self, stage, input_queue: StageQueue, output_queue: StageQueue):
+        try:
+            while not self._stop_event.is_set():
+                # The first stage starts a new frame whenever it is ready.
+                context = self._acquire_context() if input_queue is None else input_queue.get(self._stop_event)
+                if context is None:
+                    continue
+
+                self._run_elements(stage, context)
+                output_queue.put(context, self._stop_event)
+        except Exception as e:
+            log.exception(f'Error in pipeline stage {stage}.')
+            self._error = e
+            self._stop_event.set()
+
+    def get_result(self, timeout=None) -> FrameContext:
+        """
+        Returns the context of the next finished frame. It stays valid until the next call.
+        :raises Exception: the error of a failed stage. The pipeline stops in this case.
+        :raises TimeoutError: if no frame finished within timeout.
+        """
+        if self._returned_context is not None:
+            self._release_context(self._returned_context)
+            self._returned_context = None
+
+        context = self._queues[-1].get(self._stop_event, timeout)
+
+        if self._error is not None:
+            error, self._error = self._error, None
+            self.stop()
+            raise error
+
+        if context is None:
+            raise TimeoutError('No frame finished in time.')
+
+        self._returned_context = context
+        return context
+
+    def get_stats(self) -> dict:
+        """
+        Returns the number of waiting and dropped frames behind every stage.
+        """
+        return {
+            ' > '.join(element.get_name() for element in stage): {'queued': queue.qsize(),
+                                                                  'dropped': queue.dropped_items}
+            for stage, queue in zip(self.stages, self._queues)
+        }
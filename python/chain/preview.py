@@ -0,0 +1,203 @@
+"""
+Previews are the images chain elements send to the web ui. Encoding them costs more than most processing steps, so the
+chain only asks for previews while somebody watches and not more often than the preview fps.
+Elements only prepare preview frames (context.preview_frames, see create_preview_frame). The chain hands them to a
+PreviewEncoder, which compresses them in background threads, and puts the finished JPEGs into context.previews. They
+are streamed as binary websocket messages (see pack_preview), not as base64 inside the JSON telemetry.
+"""
+from collections import OrderedDict
+from threading import Thread, Condition
+from logging import Logger
+from time import perf_counter
+import cv2
+from chain.tools import encode_frame_to_jpeg
+
+log = Logger(__name__)
+
+# Preview type: id in the first byte of the binary preview messages.
+PREVIEW_TYPES = {
+    'full': 0,
+    'roi': 1,
+    'lanes': 2,
+}
+
+
+class PreviewScheduler:
+    """
+    Decides which frames get previews. The chain calls schedule() once for every new frame, elements check
+    context.preview_scale before preparing a preview frame.
+    """
+    def __init__(self, fps=10.0, scale=1.0):
+        """
+        :param fps: Maximum previews per second (0 = every frame).
+        :param scale: Size of the previews relative to the frames the elements send.
+        """
+        self.fps = fps
+        self.scale = scale
+        self.subscribers = 0
+        self.scheduled_previews = 0
+        self._next_preview_time = 0
+
+    def add_subscriber(self):
+        self.subscribers += 1
+
+    def remove_subscriber(self):
+        self.subscribers = max(0, self.subscribers - 1)
+
+    def schedule(self, context, now=None):
+        """
+        Sets context.preview_scale to the preview scale if the frame is due for previews, otherwise to None.
+        :param now: perf_counter() timestamp, defaults to now.
+        """
+        now = perf_counter() if now is None else now
+
+        if self.subscribers <= 0 or now < self._next_preview_time:
+            context.preview_scale = None
+            return
+
+        context.preview_scale = self.scale
+        self.scheduled_previews += 1
+        # Frames don't arrive exactly on time. Counting the period from the due time keeps the rate, but after a pause
+        # (e.g. no subscribers) the period starts again, otherwise the previews would catch up in a burst.
+        period = 1 / self.fps if self.fps > 0 else 0
+        if now - self._next_preview_time < period / 2:
+            self._next_preview_time += period
+        else:
+            self._next_preview_time = now + period
+
+    def get_stats(self) -> dict:
+        return {'subscribers': self.subscribers, 'scheduled_previews': self.scheduled_previews, 'fps': self.fps,
+                'scale': self.scale}
+
+
+def create_preview_frame(frame, scale, conversion=None):
+    """
+    Returns a new array with the frame shrunk by scale and converted with the cv2 color conversion code, ready for
+    context.preview_frames. The encoder works on it while the chain goes on, so it must not share memory with frames
+    the element reuses.
+    """
+    if 0 < scale < 1:
+        height, width = frame.shape[:2]
+        frame = cv2.resize(frame, (max(1, int(width * scale)), max(1, int(height * scale))),
+                           interpolation=cv2.INTER_LINEAR)
+    elif conversion is None:
+        return frame.copy()
+
+    # Shrinking before the color conversion only converts the pixels of the preview.
+    if conversion is not None:
+        frame = cv2.cvtColor(frame, conversion)
+
+    return frame
+
+
+class PreviewEncoder:
+    """
+    Encodes preview frames to JPEG in a small pool of worker threads (cv2.imencode releases the GIL), so the control
+    path never waits for the compression. A preview frame which still waits for a worker gets replaced by a newer frame
+    of the same type (latest wins) and counts as dropped, so does a preview which finishes after a newer one of the same
+    type (submissions carry a sequence number).
+    """
+    def __init__(self, worker_count=2):
+        self.worker_count = worker_count
+        self.encoded_previews = 0
+        self.dropped_previews = 0
+
+        # Preview type: (sequence number, frame), in order of submission.
+        self._pending = OrderedDict()
+        # Preview type: JPEG, finished since the last collect().
+        self._finished = {}
+        # Preview type: sequence number of the newest finished preview.
+        self._finished_sequence = {}
+        self._sequence = 0
+        self._condition = Condition()
+        self._workers = []
+        self._running = False
+
+    def is_running(self) -> bool:
+        return self._running
+
+    def start(self):
+        if self._running:
+            return
+
+        self._running = True
+        self._workers = [Thread(target=self._work, name=f'PreviewEncoder-{number}', daemon=True)
+                         for number in range(max(1, self.worker_count))]
+        for worker in self._workers:
+            worker.start()
+
+    def stop(self):
+        """
+        Stops the workers. Previews which were not encoded yet get discarded.
+        """
+        with self._condition:
+            self._running = False
+            self._pending.clear()
+            self._condition.notify_all()
+
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def submit(self, preview_type: str, frame):
+        """
+        Queues the frame for encoding. The frame must not be changed afterwards (see create_preview_frame).
+        """
+        with self._condition:
+            if preview_type in self._pending:
+                self.dropped_previews += 1
+                del self._pending[preview_type]
+
+            self._sequence += 1
+            self._pending[preview_type] = (self._sequence, frame)
+            self._condition.notify()
+
+    def collect(self) -> dict:
+        """
+        Returns the JPEGs (by preview type) which were finished since the last call.
+        """
+        with self._condition:
+            finished, self._finished = self._finished, {}
+
+        return finished
+
+    def get_queue_depth(self) -> int:
+        with self._condition:
+            return len(self._pending)
+
+    def get_stats(self) -> dict:
+        return {'queue_depth': self.get_queue_depth(), 'encoded_previews': self.encoded_previews,
+                'dropped_previews': self.dropped_previews, 'workers': len(self._workers)}
+
+    def _work(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending or not self._running)
+                if not self._running:
+                    return
+
+                preview_type, (sequence, frame) = self._pending.popitem(last=False)
+
+            try:
+                jpeg = encode_frame_to_jpeg(frame)
+            except Exception:
+                log.exception(f'Error while encoding the {preview_type} preview.')
+                continue
+
+            with self._condition:
+                self.encoded_previews += 1
+                # An older frame of the same type can finish after a newer one on another worker, it must not replace
+                # the newer preview (also not if that one was collected already).
+                if sequence < self._finished_sequence.get(preview_type, 0):
+                    self.dropped_previews += 1
+                    continue
+
+                self._finished_sequence[preview_type] = sequence
+                self._finished[preview_type] = jpeg
+
+
+def pack_preview(preview_type: str, jpeg: bytes) -> bytes:
+    """
+    Returns the binary websocket message for a preview: one byte with the id of the preview type followed by the JPEG.
+    """
+    return bytes((PREVIEW_TYPES[preview_type],)) + jpeg
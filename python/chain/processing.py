@@ -1,39 +1,63 @@
 from logging import Logger
 from abc import ABC, abstractmethod
-from .builtin import ChainElement, ProcessingResult
+from .builtin import ChainElement, FrameContext
 from settingstree import SettingsNode, NodeInput
 import numpy as np
 import cv2
-from chain.tools import encode_frame_to_base64
+from chain import lanes
+from chain.capturing import PIXEL_FORMAT_RGB, PIXEL_FORMAT_BGRA
+from chain.preview import create_preview_frame
+from chain.tools import convert_color, OutputBuffers, setting_to_bool
 
 log = Logger(__name__)
 
 
 class PreProcessingUnit(ChainElement):
     @abstractmethod
-    def process(self, frame, *args, **kwargs):
+    def process(self, context: FrameContext):
         """
-        This method is doing something with your frame (e.g. resizing) and returns the new frame.
-        :param frame: A frame you want to pre-process.
-        :return: pre-processed frame.
+        This method is doing something with context.frame (e.g. resizing) and replaces it with the new frame.
+        :param context: FrameContext with the frame you want to pre-process.
         """
 
 
 class ProcessingUnit(ChainElement):
     @abstractmethod
-    def process(self, frame, *args, **kwargs):
+    def process(self, context: FrameContext):
         """
-        This method takes a frame and figures out the steering angle.
-        :param frame: A frame you want to process.
-        :return: Steering angle.
+        This method takes context.frame, figures out the steering angle and stores it in context.angle.
+        :param context: FrameContext with the frame you want to process.
         """
 
 
 class ColorConversionPreProcessingUnit(PreProcessingUnit):
-    def process(self, frame, *args, **kwargs):
-        frame_converted = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        return ProcessingResult(args=(frame_converted,),
-                                data_to_send={'image_full': encode_frame_to_base64(frame_converted)})
+    # Conversion from the pixel format of a capturing device to BGR.
+    PIXEL_FORMAT_CONVERSIONS = {
+        PIXEL_FORMAT_RGB: cv2.COLOR_RGB2BGR,
+        PIXEL_FORMAT_BGRA: cv2.COLOR_BGRA2BGR,
+    }
+
+    def __init__(self, conversion=cv2.COLOR_BGR2RGB, *args, **kwargs):
+        """
+        :param conversion: cv2 color conversion code which turns frames of the capturing device into BGR frames.
+        """
+        super().__init__(*args, **kwargs)
+
+        self.conversion = conversion
+        self._output_buffers = OutputBuffers()
+
+    @classmethod
+    def for_pixel_format(cls, pixel_format: str):
+        """
+        Returns a unit which converts frames of the given pixel format (see CapturingDevice.get_pixel_format) to BGR.
+        """
+        return cls(cls.PIXEL_FORMAT_CONVERSIONS[pixel_format])
+
+    def process(self, context: FrameContext):
+        context.frame = convert_color(context.frame, self.conversion, self._output_buffers, self.output_buffer_depth)
+
+        if context.preview_scale is not None:
+            context.preview_frames['full'] = create_preview_frame(context.frame, context.preview_scale)
 
 
 class ROIPreProcessingUnit(PreProcessingUnit):
@@ -47,29 +71,299 @@ class ROIPreProcessingUnit(PreProcessingUnit):
         self.y1 = SettingsNode(key='y1', widget=NodeInput, verbose_name='Top')
         self.y2 = SettingsNode(key='y2', widget=NodeInput, verbose_name='Bottom')
 
-    def process(self, frame, *args, **kwargs):
+    def get_bbox(self):
+        """
+        Returns the viewport as bounding box (x1, y1, x2, y2) or None if it is not completely configured yet.
+        """
+        try:
+            x1, y1, x2, y2 = (int(node.value) for node in (self.x1, self.y1, self.x2, self.y2))
+        except (TypeError, ValueError):
+            return None
+
+        if x1 < 0 or y1 < 0 or x2 <= x1 or y2 <= y1:
+            return None
+
+        return x1, y1, x2, y2
+
+    def crop(self, frame, capture_bbox=None):
+        """
+        Returns the viewport of frame as view. Unset viewport settings are set to the size of the frame.
+        :param capture_bbox: Screen area (x1, y1, x2, y2) shown by frame (see FrameContext.capture_bbox) or None for
+                             the whole screen.
+        """
+        left, top = capture_bbox[:2] if capture_bbox is not None else (0, 0)
+
         # Set settings variables to size of frame if they are still unset.
         if not self.x1.value:
-            self.x1.value = 0
+            self.x1.value = left
         if not self.y1.value:
-            self.y1.value = 0
+            self.y1.value = top
         if not self.x2.value:
-            self.x2.value = frame.shape[1]
+            self.x2.value = left + frame.shape[1]
         if not self.y2.value:
-            self.y2.value = frame.shape[0]
+            self.y2.value = top + frame.shape[0]
 
-        roi_frame = frame[int(self.y1.value):int(self.y2.value), int(self.x1.value):int(self.x2.value)]
-        return ProcessingResult(args=(roi_frame,), data_to_send={'image_roi': encode_frame_to_base64(roi_frame)})
+        bbox = self.get_bbox()
+        # The capturing device grabbed exactly the viewport.
+        if bbox is None or (capture_bbox is not None and tuple(capture_bbox) == bbox):
+            return frame
+
+        x1, y1, x2, y2 = bbox
+        roi_frame = frame[max(0, y1 - top):max(0, y2 - top), max(0, x1 - left):max(0, x2 - left)]
+        # The viewport was moved out of the grabbed area (e.g. edited after the grab), the next grab follows it.
+        if not roi_frame.size:
+            return frame
+
+        return roi_frame
+
+    def process(self, context: FrameContext):
+        context.frame = self.crop(context.frame, context.capture_bbox)
+
+        if context.preview_scale is not None:
+            context.preview_frames['roi'] = create_preview_frame(context.frame, context.preview_scale)
 
 
 class GrayscaleConversionPreProcessingUnit(PreProcessingUnit):
-    def process(self, frame, *args, **kwargs):
-        grayscale_frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
-        return ProcessingResult(args=(grayscale_frame,))
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self._output_buffers = OutputBuffers()
+
+    def process(self, context: FrameContext):
+        context.frame = convert_color(context.frame, cv2.COLOR_RGB2GRAY, self._output_buffers,
+                                      self.output_buffer_depth)
+
+
+class FusedGrayscaleROIPreProcessingUnit(PreProcessingUnit):
+    """
+    Replaces the sequence ColorConversionPreProcessingUnit, ROIPreProcessingUnit, GrayscaleConversionPreProcessingUnit
+    (see chain.optimizer). It crops the viewport first and converts only the viewport to grayscale with one direct
+    conversion. Frame and sent data are identical to the output of the single elements.
+    """
+    # Conversion of the ColorConversionPreProcessingUnit followed by COLOR_RGB2GRAY equals these direct conversions.
+    GRAYSCALE_CONVERSIONS = {
+        cv2.COLOR_BGR2RGB: cv2.COLOR_BGR2GRAY,
+        cv2.COLOR_BGRA2BGR: cv2.COLOR_RGBA2GRAY,
+        cv2.COLOR_BGRA2RGB: cv2.COLOR_BGRA2GRAY,
+    }
+
+    def __init__(self, color_conversion_unit: ColorConversionPreProcessingUnit, roi_unit: ROIPreProcessingUnit,
+                 grayscale_unit: GrayscaleConversionPreProcessingUnit, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.color_conversion_unit = color_conversion_unit
+        self.roi_unit = roi_unit
+        self.grayscale_unit = grayscale_unit
+
+        self._output_buffers = OutputBuffers()
+
+    @classmethod
+    def can_fuse(cls, color_conversion_unit: ColorConversionPreProcessingUnit) -> bool:
+        return color_conversion_unit.conversion in cls.GRAYSCALE_CONVERSIONS
+
+    def get_name(self) -> str:
+        return ' + '.join(element.get_name()
+                          for element in (self.color_conversion_unit, self.roi_unit, self.grayscale_unit))
+
+    def warm_up(self):
+        for element in (self.color_conversion_unit, self.roi_unit, self.grayscale_unit):
+            element.warm_up()
+
+    def start(self):
+        for element in (self.color_conversion_unit, self.roi_unit, self.grayscale_unit):
+            element.start()
+
+    def stop(self):
+        for element in (self.color_conversion_unit, self.roi_unit, self.grayscale_unit):
+            element.stop()
+
+    def process(self, context: FrameContext):
+        conversion = self.color_conversion_unit.conversion
+        # The color conversion does not change the geometry, so cropping before converting gives the same viewport.
+        frame = context.frame
+        roi_frame = self.roi_unit.crop(frame, context.capture_bbox)
+        context.frame = convert_color(roi_frame, self.GRAYSCALE_CONVERSIONS[conversion], self._output_buffers,
+                                      self.output_buffer_depth)
+
+        if context.preview_scale is not None:
+            context.preview_frames['full'] = create_preview_frame(frame, context.preview_scale, conversion)
+            context.preview_frames['roi'] = create_preview_frame(roi_frame, context.preview_scale, conversion)
+
+
+class DownscalePreProcessingUnit(PreProcessingUnit):
+    """
+    Shrinks the frame to a working resolution for the processing units, which do not need every pixel of the viewport.
+    context.scale gets multiplied with the scale, so later elements can map frame coordinates back to the viewport by
+    dividing them by context.scale.
+    The frame gets halved (pyramid levels) as long as it is at least twice the working resolution, the rest is one
+    linear resize. Halving with INTER_AREA averages 2x2 blocks and is much faster than arbitrary area ratios.
+    """
+    VERBOSE_NAME = 'Working resolution'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.scale = SettingsNode(key='scale', value='0.5', widget=NodeInput,
+                                  verbose_name='Scale of the viewport (0-1, 1 keeps the full resolution)')
+        self._output_buffers = OutputBuffers()
+        # One OutputBuffers per intermediate pyramid level.
+        self._level_buffers = []
+
+    def _resize(self, frame, size, interpolation, output_buffers, depth=1):
+        output = output_buffers.get((size[1], size[0]) + frame.shape[2:], frame.dtype, depth)
+        return cv2.resize(frame, size, dst=output, interpolation=interpolation)
+
+    def process(self, context: FrameContext):
+        scale = float(self.scale.value)
+        if not 0 < scale < 1:
+            return
+
+        frame = context.frame
+        height, width = frame.shape[:2]
+        size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+
+        level = 0
+        while frame.shape[1] // 2 >= size[0] and frame.shape[0] // 2 >= size[1]:
+            half_size = (frame.shape[1] // 2, frame.shape[0] // 2)
+            if half_size == size:
+                frame = self._resize(frame, size, cv2.INTER_AREA, self._output_buffers, self.output_buffer_depth)
+                break
+
+            if level == len(self._level_buffers):
+                self._level_buffers.append(OutputBuffers())
+            frame = self._resize(frame, half_size, cv2.INTER_AREA, self._level_buffers[level])
+            level += 1
+        else:
+            if frame.shape[1::-1] != size:
+                frame = self._resize(frame, size, cv2.INTER_LINEAR, self._output_buffers, self.output_buffer_depth)
+
+        context.frame = frame
+        context.scale *= size[0] / width
 
 
 class CVLaneDetectionProcessingUnit(ProcessingUnit):
-    def process(self, frame, *args, **kwargs):
-        angle = 0
-        # TODO: Also send image with drawn lanes to webapp.
-        return ProcessingResult(kwargs={'angle': angle})
+    """
+    Finds the lanes in the grayscale viewport and steers towards their center.
+    With tracking enabled, the lanes of the last frame are searched in a narrow band with chain.lanes.track_lanes and
+    the new fits get blended with the previous ones. If tracking loses a lane or the lanes cross, the unit falls back to
+    the full search of chain.lanes.detect_lanes. If that only finds one lane, the other one is estimated with the lane
+    width of the last frame with both lanes.
+    The lanes are sent to the web ui in viewport coordinates, also if a DownscalePreProcessingUnit shrank the frame.
+
+    Time budget (TIME_BUDGET): 12 ms per frame on a 1920x1080 viewport without the overlay. The full search takes about
+    8 ms on a desktop CPU, mostly Canny, findNonZero and Gaussian blur, tracking about a quarter of it. Drawing the
+    overlay (only for frames with previews) adds about 1 ms, the chain encodes it in the background. Behind a
+    DownscalePreProcessingUnit with scale 0.5 the unit works on a quarter of the pixels and the full search takes about
+    3.5 ms.
+    chain/test/test_lanes.py checks the budget and benchmarks/run.py tracks the timings over releases.
+    """
+    VERBOSE_NAME = 'Lane detection'
+    # Seconds per 1920x1080 frame, see above.
+    TIME_BUDGET = 0.012
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.horizon = SettingsNode(key='horizon', value='0.4', widget=NodeInput,
+                                    verbose_name='Horizon (fraction of viewport height ignored from the top)')
+        self.low_threshold = SettingsNode(key='low_threshold', value='50', widget=NodeInput,
+                                          verbose_name='Lower edge threshold')
+        self.high_threshold = SettingsNode(key='high_threshold', value='150', widget=NodeInput,
+                                           verbose_name='Upper edge threshold')
+        self.window_count = SettingsNode(key='window_count', value='9', widget=NodeInput,
+                                         verbose_name='Sliding windows per lane')
+        self.margin = SettingsNode(key='margin', value='0.05', widget=NodeInput,
+                                   verbose_name='Sliding window half width (fraction of viewport width)')
+        self.min_pixels = SettingsNode(key='min_pixels', value='50', widget=NodeInput,
+                                       verbose_name='Minimum edge pixels per lane')
+        self.lookahead = SettingsNode(key='lookahead', value='0.3', widget=NodeInput,
+                                      verbose_name='Lookahead (fraction of viewport height from the bottom)')
+        self.gain = SettingsNode(key='gain', value='1', widget=NodeInput, verbose_name='Steering gain')
+        self.overlay = SettingsNode(key='overlay', value='1', widget=NodeInput,
+                                    verbose_name='Send image with drawn lanes (1/0)')
+        self.tracking = SettingsNode(key='tracking', value='1', widget=NodeInput,
+                                     verbose_name='Search near the lanes of the last frame (1/0)')
+        self.tracking_margin = SettingsNode(key='tracking_margin', value='0.02', widget=NodeInput,
+                                            verbose_name='Tracking band half width (fraction of viewport width)')
+        self.smoothing = SettingsNode(key='smoothing', value='0.5', widget=NodeInput,
+                                      verbose_name='Weight of the last lane fits while tracking (0-1)')
+
+        self.detection = None
+        # Right lane fit minus left lane fit of the last frame with both lanes.
+        self._lane_width_fit = None
+        self.tracked_frames = 0
+        self.full_searches = 0
+        self._edge_buffers = OutputBuffers()
+        self._overlay_buffers = OutputBuffers()
+
+    def track(self, frame):
+        """
+        Tracks the lanes of the last frame. Returns None if there is nothing to track or the tracked lanes are not
+        plausible.
+        """
+        previous = self.detection
+        if not setting_to_bool(self.tracking.value) or previous is None or not previous.is_plausible() \
+                or previous.shape != frame.shape[:2]:
+            return None
+
+        detection = lanes.track_lanes(frame, previous, horizon=float(self.horizon.value),
+                                      low_threshold=int(self.low_threshold.value),
+                                      high_threshold=int(self.high_threshold.value),
+                                      strip_count=int(self.window_count.value),
+                                      margin=float(self.tracking_margin.value), min_pixels=int(self.min_pixels.value))
+        if not detection.is_plausible():
+            return None
+
+        smoothing = float(self.smoothing.value)
+        detection.left_fit = smoothing * previous.left_fit + (1 - smoothing) * detection.left_fit
+        detection.right_fit = smoothing * previous.right_fit + (1 - smoothing) * detection.right_fit
+        return detection
+
+    def detect(self, frame) -> lanes.LaneDetection:
+        """
+        Tracks or detects the lanes in frame and completes a missing lane with the last known lane width.
+        """
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+
+        detection = self.track(frame)
+        if detection is not None:
+            self.tracked_frames += 1
+            self._lane_width_fit = detection.right_fit - detection.left_fit
+            return detection
+
+        self.full_searches += 1
+        detection = lanes.detect_lanes(frame, horizon=float(self.horizon.value),
+                                       low_threshold=int(self.low_threshold.value),
+                                       high_threshold=int(self.high_threshold.value),
+                                       window_count=int(self.window_count.value), margin=float(self.margin.value),
+                                       min_pixels=int(self.min_pixels.value), output_buffers=self._edge_buffers)
+
+        if detection.has_lanes():
+            self._lane_width_fit = detection.right_fit - detection.left_fit
+        elif self._lane_width_fit is not None:
+            if detection.left_fit is not None:
+                detection.right_fit = detection.left_fit + self._lane_width_fit
+            elif detection.right_fit is not None:
+                detection.left_fit = detection.right_fit - self._lane_width_fit
+
+        return detection
+
+    def process(self, context: FrameContext):
+        self.detection = self.detect(context.frame)
+
+        center_fit = self.detection.get_center_fit()
+        if center_fit is None:
+            context.angle = 0
+        else:
+            context.angle = lanes.steering_angle(center_fit, self.detection.shape,
+                                                 lookahead=float(self.lookahead.value), gain=float(self.gain.value))
+
+        viewport_detection = self.detection.rescaled(context.scale)
+        fits = (('left', viewport_detection.left_fit), ('right', viewport_detection.right_fit))
+        context.data_to_send['lanes'] = {side: None if fit is None else fit.tolist() for side, fit in fits}
+        context.data_to_send['lanes_detected'] = self.detection.has_lanes()
+        context.data_to_send['lanes_tracked'] = self.detection.tracked
+        if context.preview_scale is not None and setting_to_bool(self.overlay.value) and context.frame.ndim == 2:
+            context.preview_frames['lanes'] = create_preview_frame(
+                lanes.draw_lane_overlay(context.frame, self.detection, self._overlay_buffers), context.preview_scale)
@@ -0,0 +1,92 @@
+from threading import Lock
+from time import perf_counter
+import numpy as np
+
+
+class RollingTimings:
+    """
+    Keeps the last `size` durations (in seconds) in a ring buffer and computes statistics over them.
+    """
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, size=1000):
+        self._durations = np.zeros(size)
+        self._count = 0
+        self._lock = Lock()
+
+    def __len__(self):
+        return min(self._count, len(self._durations))
+
+    def add(self, duration: float):
+        with self._lock:
+            self._durations[self._count % len(self._durations)] = duration
+            self._count += 1
+
+    def get_window(self) -> np.ndarray:
+        """
+        Returns a copy of the durations currently in the window.
+        """
+        with self._lock:
+            return self._durations[:len(self)].copy()
+
+    def get_stats(self) -> dict:
+        """
+        Returns count, mean, max and percentiles of the window in milliseconds.
+        """
+        window = self.get_window() * 1000
+        stats = {'count': len(window), 'mean': 0.0, 'max': 0.0}
+        stats.update({f'p{percentile}': 0.0 for percentile in self.PERCENTILES})
+
+        if len(window):
+            stats['mean'] = float(window.mean())
+            stats['max'] = float(window.max())
+            for percentile, value in zip(self.PERCENTILES, np.percentile(window, self.PERCENTILES)):
+                stats[f'p{percentile}'] = float(value)
+
+        return stats
+
+
+class ChainProfiler:
+    """
+    Collects wall-clock durations per chain element and per frame.
+    """
+    def __init__(self, window_size=1000):
+        self.window_size = window_size
+        self.reset()
+
+    def reset(self):
+        self._element_timings = {}
+        self._frame_timings = RollingTimings(self.window_size)
+        self._frame_end_times = RollingTimings(self.window_size)
+
+    def add_element_timing(self, name: str, duration: float):
+        timings = self._element_timings.get(name)
+        if timings is None:
+            timings = self._element_timings[name] = RollingTimings(self.window_size)
+
+        timings.add(duration)
+
+    def add_frame_timing(self, duration: float):
+        self._frame_timings.add(duration)
+        self._frame_end_times.add(perf_counter())
+
+    def get_fps(self) -> float:
+        end_times = self._frame_end_times.get_window()
+        if len(end_times) < 2:
+            return 0.0
+
+        # The ring buffer is not sorted once it wrapped around.
+        elapsed = end_times.max() - end_times.min()
+        return float((len(end_times) - 1) / elapsed) if elapsed > 0 else 0.0
+
+    def get_stats(self) -> dict:
+        """
+        Returns the statistics of the whole frame (including fps) and of every element in milliseconds.
+        """
+        frame_stats = self._frame_timings.get_stats()
+        frame_stats['fps'] = self.get_fps()
+
+        return {
+            'frame': frame_stats,
+            'elements': {name: timings.get_stats() for name, timings in list(self._element_timings.items())},
+        }
@@ -0,0 +1,208 @@
+"""
+Recorded sessions consist of two files next to each other:
+
+* ``<name>.frames``: The raw frame bytes, appended one after another.
+* ``<name>.index``: One json object per line and frame with the keys offset, shape, dtype, timestamp, bbox (the
+  grabbed screen area, see FrameContext.capture_bbox) and pixel_format (see CapturingDevice.get_pixel_format).
+
+Frames are read back through a memory map, so replaying a session does not load it into memory.
+"""
+from logging import Logger
+from threading import Thread
+from queue import Queue, Full
+import json
+import pathlib
+import time
+import numpy as np
+from .builtin import ChainElement, FrameContext
+from settingstree import SettingsNode, NodeInput
+
+log = Logger(__name__)
+
+FRAMES_SUFFIX = '.frames'
+INDEX_SUFFIX = '.index'
+
+
+def get_recording_paths(path):
+    """
+    Returns the paths of the frames file and the index file of a recording.
+    :param path: Path of the recording without suffix.
+    """
+    path = pathlib.Path(path)
+    return path.with_name(path.name + FRAMES_SUFFIX), path.with_name(path.name + INDEX_SUFFIX)
+
+
+class FrameRecordingWriter:
+    """
+    Appends frames to a recording. Writes go through a large file buffer, so frames hit the disk in bulk.
+    """
+    WRITE_BUFFER_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, path, pixel_format=None):
+        """
+        :param pixel_format: Pixel format of the capturing device, replays use the same color conversion.
+        """
+        self.path = pathlib.Path(path)
+        self.pixel_format = pixel_format
+        frames_path, index_path = get_recording_paths(self.path)
+        frames_path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._frames_file = open(frames_path, 'ab', buffering=self.WRITE_BUFFER_SIZE)
+        self._index_file = open(index_path, 'a')
+        self._offset = self._frames_file.tell()
+
+    def write(self, frame: np.ndarray, timestamp: float, bbox=None):
+        frame = np.ascontiguousarray(frame)
+        self._frames_file.write(memoryview(frame).cast('B'))
+        self._index_file.write(json.dumps({'offset': self._offset, 'shape': frame.shape, 'dtype': frame.dtype.str,
+                                           'timestamp': timestamp, 'bbox': bbox,
+                                           'pixel_format': self.pixel_format}) + '\n')
+        self._offset += frame.nbytes
+
+    def flush(self):
+        # Flush the frames first, so the index never points to missing data.
+        self._frames_file.flush()
+        self._index_file.flush()
+
+    def close(self):
+        self.flush()
+        self._frames_file.close()
+        self._index_file.close()
+
+
+class FrameRecordingReader:
+    """
+    Gives random access to the frames of a recording. Frames are read-only views on a memory map of the frames file.
+    """
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        frames_path, index_path = get_recording_paths(self.path)
+
+        with open(index_path) as index_file:
+            self._index = [json.loads(line) for line in index_file if line.strip()]
+
+        self._memory_map = None
+        if self._index:
+            self._memory_map = np.memmap(frames_path, dtype=np.uint8, mode='r')
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, item):
+        """
+        Returns a tuple (frame, timestamp).
+        """
+        entry = self._index[item]
+        frame = np.ndarray(shape=tuple(entry['shape']), dtype=np.dtype(entry['dtype']), buffer=self._memory_map,
+                           offset=entry['offset'])
+        return frame, entry['timestamp']
+
+    def get_pixel_format(self):
+        """
+        Returns the pixel format of the capturing device which recorded the frames or None if it is unknown.
+        """
+        return self._index[0].get('pixel_format') if self._index else None
+
+    def get_bbox(self, item):
+        """
+        Returns the screen area the frame was grabbed from or None for the whole screen (and older recordings).
+        """
+        bbox = self._index[item].get('bbox')
+        return None if bbox is None else tuple(bbox)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class FrameRecorder(ChainElement):
+    """
+    Sink element which records the frames passing through into a recording and leaves them unchanged.
+    Frames are copied and handed over to a writer thread. If the disk can not keep up, frames are dropped instead of
+    stalling the chain. Recording is disabled as long as no path is set.
+    """
+    VERBOSE_NAME = 'Recorder'
+    # Number of frames waiting for the writer thread before new frames get dropped.
+    QUEUE_SIZE = 64
+
+    def __init__(self, pixel_format=None, *args, **kwargs):
+        """
+        :param pixel_format: Pixel format of the capturing device in front of the recorder, stored in the recording.
+        """
+        super().__init__(*args, **kwargs)
+
+        self.pixel_format = pixel_format
+        self.recording_path = SettingsNode(key='recording_path', widget=NodeInput,
+                                           verbose_name='Record frames to (empty disables recording)')
+
+        self.dropped_frames = 0
+        self._queue = None
+        self._writer_thread = None
+        self._current_path = None
+
+    def is_recording(self) -> bool:
+        return self._writer_thread is not None
+
+    def _start_writer(self, path):
+        self._queue = Queue(maxsize=self.QUEUE_SIZE)
+        writer = FrameRecordingWriter(path, self.pixel_format)
+        self._writer_thread = Thread(target=self._write_loop, args=(writer, self._queue), name='FrameRecorder',
+                                     daemon=True)
+        self._writer_thread.start()
+        log.info(f'Recording frames to {path}.')
+
+    def _stop_writer(self):
+        self._current_path = None
+        if not self.is_recording():
+            return
+
+        # The writer thread stops on errors, then nobody takes frames out of a full queue anymore.
+        while self._writer_thread.is_alive():
+            try:
+                self._queue.put(None, timeout=0.1)
+                break
+            except Full:
+                pass
+        self._writer_thread.join()
+        self._queue = None
+        self._writer_thread = None
+
+    @staticmethod
+    def _write_loop(writer: FrameRecordingWriter, queue: Queue):
+        try:
+            while True:
+                item = queue.get()
+                if item is None:
+                    break
+
+                writer.write(*item)
+
+                # Only flush if the writer has caught up, so frames get written in bulk.
+                if queue.empty():
+                    writer.flush()
+        except Exception:
+            log.exception('Error while writing recording.')
+        finally:
+            writer.close()
+
+    def stop(self):
+        self._stop_writer()
+
+    def process(self, context: FrameContext):
+        path = self.recording_path.value
+
+        if path != self._current_path:
+            self._stop_writer()
+            self._current_path = path
+            if path:
+                try:
+                    self._start_writer(path)
+                except OSError:
+                    log.exception(f'Can not record frames to {path}.')
+
+        if self.is_recording():
+            try:
+                # Copy the frame because upstream elements may reuse its memory.
+                self._queue.put_nowait((context.frame.copy(), time.time(), context.capture_bbox))
+            except Full:
+                self.dropped_frames += 1
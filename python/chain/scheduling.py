@@ -0,0 +1,110 @@
+from time import perf_counter, sleep
+import asyncio
+
+
+class FrameRateGovernor:
+    """
+    Limits the frame rate of a loop. Call tick() (or tick_async() in coroutines) once per iteration: it sleeps until the
+    deadline of the next frame.
+    Deadlines advance by a fixed period, so the rate does not drift with varying processing times. If a deadline was
+    missed, the schedule restarts from now instead of running a burst of frames to catch up.
+
+    In adaptive mode the period is stretched to the measured processing time (plus headroom) when the target rate can
+    not be reached, so the loop stops missing deadlines and leaves the remaining CPU time to others.
+    """
+    # time.sleep may wake up late, so the last part of the wait is spent spinning.
+    SPIN_DURATION = 0.0002
+    # Weight of the newest processing time in the moving average.
+    SMOOTHING = 0.1
+    # Factor applied to the average processing time for the adaptive period.
+    ADAPTIVE_HEADROOM = 1.1
+
+    def __init__(self, target_fps=0.0, adaptive=False):
+        """
+        :param target_fps: Frames per second. 0 disables the limit.
+        :param adaptive: Lower the rate to the measured processing time if the target can not be reached.
+        """
+        self.target_fps = target_fps
+        self.adaptive = adaptive
+        self.reset()
+
+    def reset(self):
+        self.ticks = 0
+        self.missed_deadlines = 0
+        self.average_work_time = 0.0
+        self._next_deadline = None
+        self._last_wakeup = None
+
+    def get_period(self) -> float:
+        """
+        Returns the current period between two frames in seconds.
+        """
+        if self.target_fps <= 0:
+            return 0.0
+
+        period = 1 / self.target_fps
+        if self.adaptive:
+            period = max(period, self.average_work_time * self.ADAPTIVE_HEADROOM)
+
+        return period
+
+    def _schedule(self, now):
+        """
+        Books the current tick and returns the deadline of the next frame or None if there is no need to wait.
+        """
+        self.ticks += 1
+
+        if self._last_wakeup is not None:
+            work_time = now - self._last_wakeup
+            self.average_work_time += (work_time - self.average_work_time) * self.SMOOTHING
+
+        period = self.get_period()
+        if not period:
+            self._next_deadline = None
+            return None
+
+        if self._next_deadline is None:
+            self._next_deadline = now + period
+        else:
+            self._next_deadline += period
+
+        if now > self._next_deadline:
+            self.missed_deadlines += 1
+            self._next_deadline = now
+            return None
+
+        return self._next_deadline
+
+    def tick(self):
+        deadline = self._schedule(perf_counter())
+
+        if deadline is not None:
+            remaining = deadline - perf_counter() - self.SPIN_DURATION
+            if remaining > 0:
+                sleep(remaining)
+
+            while perf_counter() < deadline:
+                pass
+
+        self._last_wakeup = perf_counter()
+
+    async def tick_async(self):
+        """
+        Like tick() but sleeps with asyncio.sleep, so the event loop keeps running. Less precise, there is no spinning.
+        """
+        deadline = self._schedule(perf_counter())
+
+        if deadline is not None:
+            await asyncio.sleep(max(deadline - perf_counter(), 0))
+
+        self._last_wakeup = perf_counter()
+
+    def get_stats(self) -> dict:
+        period = self.get_period()
+        return {
+            'target_fps': self.target_fps,
+            'effective_fps': 1 / period if period else 0.0,
+            'ticks': self.ticks,
+            'missed_deadlines': self.missed_deadlines,
+            'average_work_time': self.average_work_time * 1000,
+        }
@@ -0,0 +1,129 @@
+"""
+Telemetry is the data_to_send of the processed frames, streamed to the dashboards on /ws/index.
+A message is a map with the subscribed fields which changed since the last message to the client. Fields missing in a
+message keep their last value, the first message after connecting or subscribing contains all subscribed fields. Frames
+which arrive while a client still waits for its last message get merged into the next one (latest value wins), so a
+client never gets more than one message per frame.
+The encoding is negotiated at connect time with the websocket subprotocol: clients offer e.g.
+['telemetry.msgpack', 'telemetry.json'] and the server accepts the first encoding it supports. msgpack (binary
+messages) needs the optional msgpack package, JSON (text messages) is the default.
+"""
+from importlib import import_module
+import json
+
+SUBPROTOCOL_PREFIX = 'telemetry.'
+ENCODING_JSON = 'json'
+ENCODING_MSGPACK = 'msgpack'
+TELEMETRY_ENCODINGS = (ENCODING_JSON, ENCODING_MSGPACK)
+
+
+def is_encoding_available(encoding: str) -> bool:
+    if encoding == ENCODING_JSON:
+        return True
+
+    if encoding == ENCODING_MSGPACK:
+        try:
+            import_module('msgpack')
+        except ImportError:
+            return False
+        return True
+
+    return False
+
+
+def negotiate_subprotocol(offered_subprotocols) -> str:
+    """
+    Returns the first offered telemetry subprotocol with an available encoding or None.
+    """
+    for subprotocol in offered_subprotocols:
+        if subprotocol.startswith(SUBPROTOCOL_PREFIX):
+            encoding = subprotocol[len(SUBPROTOCOL_PREFIX):]
+            if encoding in TELEMETRY_ENCODINGS and is_encoding_available(encoding):
+                return subprotocol
+
+    return None
+
+
+def get_encoding(subprotocol) -> str:
+    """
+    Returns the encoding of a subprotocol returned by negotiate_subprotocol().
+    """
+    if subprotocol is None:
+        return ENCODING_JSON
+
+    return subprotocol[len(SUBPROTOCOL_PREFIX):]
+
+
+def encode(values: dict, encoding: str):
+    """
+    Returns values as str (JSON) or bytes (msgpack).
+    """
+    if encoding == ENCODING_MSGPACK:
+        return import_module('msgpack').packb(values, use_bin_type=True)
+
+    return json.dumps(values, separators=(',', ':'), ensure_ascii=False)
+
+
+class TelemetryState:
+    """
+    Telemetry of one client: its encoding, the fields it subscribed to and the values it got already.
+    The chain creates new values for every frame, values must not be changed after passing them to update().
+    """
+    def __init__(self, encoding=ENCODING_JSON):
+        self.encoding = encoding
+        # Subscribed field names or None for all fields.
+        self.fields = None
+        self.coalesced_updates = 0
+        # Latest value of every field, also of fields which are not subscribed (for later subscriptions).
+        self._values = {}
+        self._sent_values = {}
+        self._has_updates = False
+
+    def subscribe(self, fields=None):
+        """
+        Sends only the given fields from now on. The next message contains all of them.
+        :param fields: Field names or None for all fields.
+        """
+        self.fields = None if fields is None else set(fields)
+        self._sent_values = {}
+        self._has_updates = True
+
+    def update(self, values: dict):
+        """
+        Merges the telemetry of a new frame into the next message.
+        """
+        if self._has_updates:
+            self.coalesced_updates += 1
+
+        self._values.update(values)
+        self._has_updates = True
+
+    def has_updates(self) -> bool:
+        return self._has_updates
+
+    def get_changes(self) -> dict:
+        """
+        Returns the subscribed fields which changed since the last call and remembers them as sent.
+        """
+        changes = {}
+        for field, value in self._values.items():
+            if self.fields is not None and field not in self.fields:
+                continue
+
+            if field not in self._sent_values or self._sent_values[field] != value:
+                changes[field] = value
+
+        self._sent_values.update(changes)
+        self._has_updates = False
+
+        return changes
+
+    def get_message(self):
+        """
+        Returns the encoded changes since the last message or None if nothing changed.
+        """
+        changes = self.get_changes()
+        if not changes:
+            return None
+
+        return encode(changes, self.encoding)
@@ -0,0 +1,36 @@
+from benchmarks.run import compare_to_baseline
+
+
+def create_stats(frame, **elements) -> dict:
+    return {'frame': {'p50': frame}, 'elements': {name: {'p50': p50} for name, p50 in elements.items()}}
+
+
+def test_slowdown_above_tolerance_is_a_regression():
+    baseline = {'720p': create_stats(10.0, Lanes=5.0, Controller=2.0)}
+    results = {'720p': create_stats(10.5, Lanes=6.0, Controller=2.1)}
+
+    assert compare_to_baseline(results, baseline, tolerance=0.1) == ['720p Lanes: p50 6.00 ms (baseline 5.00 ms)']
+
+
+def test_tiny_absolute_slowdown_is_ignored():
+    baseline = {'720p': create_stats(10.0, Capture=0.001)}
+    results = {'720p': create_stats(10.0, Capture=0.004)}
+
+    assert compare_to_baseline(results, baseline, tolerance=0.1) == []
+    assert compare_to_baseline(results, baseline, tolerance=0.1, min_difference=0.0) == \
+        ['720p Capture: p50 0.00 ms (baseline 0.00 ms)']
+
+
+def test_absolute_slowdown_within_tolerance_is_ignored():
+    baseline = {'4k': create_stats(40.0)}
+    results = {'4k': create_stats(42.0)}
+
+    assert compare_to_baseline(results, baseline, tolerance=0.1) == []
+    assert compare_to_baseline(results, baseline, tolerance=0.01) == ['4k frame: p50 42.00 ms (baseline 40.00 ms)']
+
+
+def test_missing_baseline_entries_are_skipped():
+    baseline = {'720p': create_stats(10.0, Lanes=0.0)}
+    results = {'720p': create_stats(10.0, Lanes=5.0, Recorder=3.0), '1080p': create_stats(50.0, Lanes=20.0)}
+
+    assert compare_to_baseline(results, baseline, tolerance=0.1) == []
@@ -0,0 +1,101 @@
+import pickle
+import pytest
+from chain import ProcessingChain
+from chain.builtin import ChainElement, FrameContext
+from settingstree import Settings
+
+
+class JsonElement(ChainElement):
+    import_count = 0
+
+    def import_dependencies(self):
+        JsonElement.import_count += 1
+        self._import_helper('json', 'json')
+
+    def process(self, context: FrameContext):
+        context.data_to_send['json'] = self._imported_dependencies['json'].dumps(context.frame_number)
+
+
+class FlakyImportElement(ChainElement):
+    def __init__(self):
+        super().__init__()
+        self.fail_import = True
+
+    def import_dependencies(self):
+        self._import_helper('json', 'json')
+        if self.fail_import:
+            raise ImportError('Device driver missing.')
+        self._import_helper('pickle', 'pickle')
+
+    def process(self, context: FrameContext):
+        pass
+
+
+class JsonChain(ProcessingChain):
+    platform = None
+
+    def __init__(self, settings):
+        super().__init__(settings)
+
+        self.register(JsonElement())
+
+
+def test_dependencies_get_imported_on_first_use():
+    JsonElement.import_count = 0
+    element = JsonElement()
+    assert JsonElement.import_count == 0
+    assert element.get_import_time() is None
+
+    context = FrameContext()
+    context.reset(frame_number=3)
+    element.process(context)
+    element.process(context)
+
+    assert JsonElement.import_count == 1
+    assert context.data_to_send['json'] == '3'
+    assert element.get_import_time() is not None
+
+
+def test_failed_import_is_retried():
+    element = FlakyImportElement()
+    with pytest.raises(ImportError):
+        element.warm_up()
+    assert element.get_import_time() is None
+
+    element.fail_import = False
+    assert set(element._imported_dependencies) == {'json', 'pickle'}
+    assert element.get_import_time() is not None
+
+
+def test_pickled_element_imports_again_on_first_use():
+    element = JsonElement()
+    element.warm_up()
+
+    unpickled_element = pickle.loads(pickle.dumps(element))
+    assert unpickled_element._dependencies is None
+    assert 'json' in unpickled_element._imported_dependencies
+
+
+def test_chain_warms_up_elements_on_start():
+    chain = JsonChain(Settings())
+    report = chain.get_startup_report()
+    assert report['JsonElement']['construction'] >= 0
+    assert report['JsonElement']['import'] is None
+
+    chain.start()
+    try:
+        assert chain.get_startup_report()['JsonElement']['import'] is not None
+    finally:
+        chain.stop()
+
+
+def test_chain_without_warm_up_imports_on_first_frame():
+    chain = JsonChain(Settings())
+    chain.warm_up.value = '0'
+    chain.start()
+    try:
+        assert chain.get_startup_report()['JsonElement']['import'] is None
+        chain.run()
+        assert chain.get_startup_report()['JsonElement']['import'] is not None
+    finally:
+        chain.stop()
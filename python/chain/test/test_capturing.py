@@ -0,0 +1,101 @@
+import pytest
+from chain.builtin import FrameContext
+from chain.capturing import CapturingDevice, ThreadedCapturingDevice, XShmDevice
+from chain.tools import LatestFrameBuffer
+
+
+class CountingDevice(CapturingDevice):
+    def __init__(self):
+        super().__init__()
+        self.frame_number = 0
+
+    def process(self, context: FrameContext):
+        self.frame_number += 1
+        context.frame = self.frame_number
+        context.capture_time = self.frame_number
+
+
+def test_latest_frame_buffer_returns_newest_item():
+    frame_buffer = LatestFrameBuffer(size=2)
+    for item in ('a', 'b', 'c'):
+        frame_buffer.put(item)
+
+    assert frame_buffer.get_latest() == (2, 'c')
+    assert frame_buffer.item_count == 3
+
+
+def test_latest_frame_buffer_times_out_when_empty():
+    with pytest.raises(TimeoutError):
+        LatestFrameBuffer().get_latest(timeout=0.01)
+
+
+def test_threaded_capturing_device_returns_latest_frame():
+    device = ThreadedCapturingDevice(CountingDevice())
+    device.start()
+    try:
+        context = FrameContext()
+        device.process(context)
+        first = context.frame
+        assert device.is_capturing()
+        assert context.capture_time == first
+
+        device.process(context)
+        assert context.frame >= first
+    finally:
+        device.stop()
+
+    assert not device.is_capturing()
+
+
+class FailingDevice(CapturingDevice):
+    def process(self, context: FrameContext):
+        raise OSError('No display.')
+
+
+def test_threaded_capturing_device_raises_capture_errors_instead_of_blocking():
+    device = ThreadedCapturingDevice(FailingDevice())
+    device.FRAME_TIMEOUT = 0.2
+    device.start()
+    try:
+        with pytest.raises(OSError, match='No display'):
+            device.process(FrameContext())
+    finally:
+        device.stop()
+
+
+def test_threaded_capturing_device_can_be_disabled():
+    device = ThreadedCapturingDevice(CountingDevice())
+    device.threaded.value = '0'
+    device.start()
+
+    assert not device.is_capturing()
+    context = FrameContext()
+    device.process(context)
+    assert context.frame == 1
+    device.process(context)
+    assert context.frame == 2
+    device.stop()
+
+
+def test_threaded_capturing_device_exposes_wrapped_settings():
+    device = ThreadedCapturingDevice(CountingDevice())
+    settings_node = device.collect_settings()
+
+    assert settings_node.key == 'CountingDevice'
+    assert device.threaded in settings_node.children
+
+
+@pytest.mark.skipif(not XShmDevice.is_available(), reason='Needs a X display with MIT-SHM (e.g. Xvfb).')
+def test_xshm_device_returns_view_on_shared_memory():
+    device = XShmDevice()
+    try:
+        context = FrameContext()
+        device.process(context)
+        frame = context.frame
+        assert frame.ndim == 3 and frame.shape[2] == 4
+        assert not frame.flags.owndata
+
+        device.process(context)
+        assert context.frame is frame
+    finally:
+        device.stop()
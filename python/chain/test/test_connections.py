@@ -0,0 +1,229 @@
+import asyncio
+import json
+import threading
+import pytest
+from starlette.websockets import WebSocket, WebSocketDisconnect
+from chain.builtin import FrameContext
+from chain.connections import WSConnectionPool, TelemetryConnection, ContextPublisher
+
+
+class FakeWebSocket(WebSocket):
+    """
+    Records the sent messages, sends wait while the client is blocked. The client disconnects on receiving.
+    """
+    def __init__(self, path='/ws/settings', subprotocols=()):
+        scope = {'type': 'websocket', 'path': path, 'headers': [], 'query_string': b'', 'scheme': 'ws',
+                 'server': ('testserver', 80), 'subprotocols': list(subprotocols)}
+        super().__init__(scope, self._receive, self._send)
+        self.messages = []
+        self.disconnected = False
+        self.unblocked = asyncio.Event()
+        self.unblocked.set()
+
+    async def _receive(self):
+        raise WebSocketDisconnect()
+
+    async def _send(self, message):
+        raise WebSocketDisconnect()
+
+    async def receive_json(self, mode='text'):
+        await self._receive()
+
+    async def send_text(self, data):
+        await self._send_message(data)
+
+    async def send_bytes(self, data):
+        await self._send_message(data)
+
+    async def _send_message(self, data):
+        await self.unblocked.wait()
+        if self.disconnected:
+            raise WebSocketDisconnect()
+        self.messages.append(data)
+
+
+async def run_sender_tasks():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_full_queue_drops_oldest_message():
+    async def send():
+        pool = WSConnectionPool(queue_size=2)
+        ws = FakeWebSocket()
+        ws.unblocked.clear()
+        pool.add_connection(ws)
+
+        await pool.send_text(ws, 'first')
+        # The sender task takes the first message and waits for the client.
+        await run_sender_tasks()
+        for data in ('second', 'third', 'fourth'):
+            await pool.send_text(ws, data)
+        assert pool.get_stats()['/ws/settings']['queued_messages'] == 2
+
+        ws.unblocked.set()
+        await run_sender_tasks()
+        return ws, pool.get_connection(ws)
+
+    ws, connection = asyncio.run(send())
+    assert ws.messages == ['first', 'third', 'fourth']
+    assert connection.dropped_messages == 1
+    assert connection.sent_messages == 3
+
+
+def test_slow_client_does_not_delay_others():
+    async def send():
+        pool = WSConnectionPool()
+        slow_ws, ws = FakeWebSocket(), FakeWebSocket()
+        slow_ws.unblocked.clear()
+        pool.add_connection(slow_ws)
+        pool.add_connection(ws)
+
+        await pool.send_json('/ws/settings', {'status': 200})
+        await run_sender_tasks()
+        return slow_ws, ws
+
+    slow_ws, ws = asyncio.run(send())
+    assert slow_ws.messages == []
+    assert [json.loads(message) for message in ws.messages] == [{'status': 200}]
+
+
+def test_failed_send_removes_connection():
+    async def send():
+        pool = WSConnectionPool()
+        ws = FakeWebSocket()
+        ws.disconnected = True
+        pool.add_connection(ws)
+        connection = pool.get_connection(ws)
+
+        await pool.send_text(ws, 'message')
+        await run_sender_tasks()
+        return pool, ws, connection
+
+    pool, ws, connection = asyncio.run(send())
+    assert pool.get_connection(ws) is None
+    assert connection.closed
+    assert connection._sender.done()
+
+
+def test_disconnect_in_route_removes_connection():
+    async def route():
+        pool = WSConnectionPool(connection_types={'/ws/index': TelemetryConnection})
+        ws = FakeWebSocket('/ws/index', ['telemetry.json'])
+        pool.add_connection(ws)
+
+        with pool.connection(ws) as connection:
+            assert isinstance(connection, TelemetryConnection)
+            await ws.receive_json()
+
+        await run_sender_tasks()
+        return pool, ws, connection
+
+    pool, ws, connection = asyncio.run(route())
+    assert pool.get_connection(ws) is None
+    assert pool.get_stats()['/ws/index']['connections'] == 0
+    assert connection._sender.cancelled()
+
+
+@pytest.fixture
+def loop_thread():
+    """
+    Event loop running in another thread, like the one of the web server.
+    """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield loop, thread
+    if not loop.is_closed():
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(1)
+        loop.close()
+
+
+class OutputRecorder:
+    def __init__(self):
+        self.outputs = []
+        self.threads = []
+        self.sent = threading.Event()
+
+    async def send_outputs(self, data_to_send, previews):
+        self.outputs.append((data_to_send, previews))
+        self.threads.append(threading.current_thread())
+        self.sent.set()
+
+
+def create_context(**data_to_send) -> FrameContext:
+    context = FrameContext()
+    context.data_to_send.update(data_to_send)
+    return context
+
+
+def test_publisher_sends_copy_on_loop(loop_thread):
+    loop, thread = loop_thread
+    recorder = OutputRecorder()
+    publisher = ContextPublisher(loop, recorder.send_outputs)
+
+    context = create_context(angle=0.1)
+    context.previews['lanes'] = b'jpeg'
+    publisher.publish(context)
+    # The chain reuses the context right away.
+    context.reset()
+
+    assert recorder.sent.wait(1)
+    assert recorder.outputs == [({'angle': 0.1}, {'lanes': b'jpeg'})]
+    assert recorder.threads == [thread]
+
+
+def test_publisher_coalesces_frames_while_loop_is_busy(loop_thread):
+    loop, _ = loop_thread
+    recorder = OutputRecorder()
+    publisher = ContextPublisher(loop, recorder.send_outputs)
+
+    unblock = threading.Event()
+    loop.call_soon_threadsafe(unblock.wait, 1)
+    publisher.publish(create_context(angle=0.1, latency=5))
+    publisher.publish(create_context(angle=0.2))
+    publisher.publish(create_context(angle=0.3))
+    unblock.set()
+
+    assert recorder.sent.wait(1)
+    assert recorder.outputs == [({'angle': 0.3, 'latency': 5}, {})]
+    assert publisher.published_frames == 3
+    assert publisher.coalesced_frames == 2
+
+
+def test_publisher_without_running_loop_does_nothing():
+    recorder = OutputRecorder()
+    loop = asyncio.new_event_loop()
+    loop.close()
+
+    for publisher in (ContextPublisher(loop, recorder.send_outputs), ContextPublisher(None, recorder.send_outputs)):
+        publisher.publish(create_context(angle=0.1))
+        assert publisher.published_frames == 0
+
+    assert recorder.outputs == []
+
+
+def test_publisher_from_processing_thread_after_loop_closed(loop_thread):
+    loop, thread = loop_thread
+    recorder = OutputRecorder()
+    publisher = ContextPublisher(loop, recorder.send_outputs)
+    # The server shuts down while the processing thread still runs.
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(1)
+    loop.close()
+
+    errors = []
+
+    def publish():
+        try:
+            publisher.publish(create_context(angle=0.1))
+        except Exception as e:
+            errors.append(e)
+
+    processing_thread = threading.Thread(target=publish)
+    processing_thread.start()
+    processing_thread.join(1)
+
+    assert errors == []
+    assert recorder.outputs == []
@@ -0,0 +1,187 @@
+from time import perf_counter
+from types import SimpleNamespace
+import pytest
+from chain.builtin import FrameContext
+from chain.controller import ControllerInstance, SteeringFilter, ControllerOutput, FakeControllerBackend, \
+    VjoyBackend, VjoyController
+
+
+class RecordingController(ControllerInstance):
+    def __init__(self):
+        super().__init__()
+        self.angles = []
+
+    def process(self, context: FrameContext):
+        self.angles.append(self.get_steering_angle(context))
+
+
+def test_filter_passes_constant_angle():
+    steering_filter = SteeringFilter(smoothing=0.5, max_rate=1)
+    commands = [steering_filter.update(0.25, capture_time=i * 0.02, now=i * 0.02 + 0.05) for i in range(10)]
+
+    assert commands == pytest.approx([0.25] * 10)
+
+
+def test_filter_extrapolates_over_latency():
+    steering_filter = SteeringFilter()
+    # The angle grows by 1 per second, every command is 50 ms behind its capture.
+    for i in range(5):
+        command = steering_filter.update(i * 0.02, capture_time=i * 0.02, now=i * 0.02 + 0.05)
+
+    assert steering_filter.latency == pytest.approx(0.05)
+    assert command == pytest.approx(4 * 0.02 + 0.05)
+
+
+def test_filter_keeps_extrapolating_repeated_frames():
+    steering_filter = SteeringFilter()
+    for i in range(5):
+        steering_filter.update(i * 0.02, capture_time=i * 0.02, now=i * 0.02 + 0.05)
+
+    # The chain runs twice as fast as the grabber and gets the last frame again 10 ms later.
+    command = steering_filter.update(4 * 0.02, capture_time=4 * 0.02, now=4 * 0.02 + 0.06)
+    assert command == pytest.approx(4 * 0.02 + 0.06)
+    assert steering_filter.update(5 * 0.02, capture_time=5 * 0.02, now=5 * 0.02 + 0.05) == pytest.approx(
+        5 * 0.02 + 0.05)
+
+
+def test_filter_does_not_extrapolate_without_capture_time_or_after_gaps():
+    steering_filter = SteeringFilter()
+    steering_filter.update(0, capture_time=None, now=0)
+    assert steering_filter.update(0.1, capture_time=None, now=0.02) == pytest.approx(0.1)
+
+    steering_filter.update(0.1, capture_time=1, now=1.05)
+    # One second without frames is longer than max_latency.
+    assert steering_filter.update(0.2, capture_time=2, now=2.05) == pytest.approx(0.2)
+
+
+def test_filter_smooths_and_limits_rate():
+    steering_filter = SteeringFilter(smoothing=0.5, compensation=False)
+    steering_filter.update(0, capture_time=0, now=0)
+    assert steering_filter.update(1, capture_time=0.02, now=0.02) == pytest.approx(0.5)
+
+    steering_filter = SteeringFilter(max_rate=2, compensation=False)
+    steering_filter.update(0, capture_time=0, now=0)
+    assert steering_filter.update(1, capture_time=0.1, now=0.1) == pytest.approx(0.2)
+    assert steering_filter.update(-1, capture_time=0.2, now=0.2) == pytest.approx(0)
+
+
+def test_filter_clips_command():
+    steering_filter = SteeringFilter()
+    steering_filter.update(0.5, capture_time=0, now=0.1)
+    assert steering_filter.update(1, capture_time=0.02, now=0.12) == 1
+
+
+def test_controller_sends_compensated_angle_and_latency():
+    controller = RecordingController()
+    controller.smoothing.value = '0'
+    controller.start()
+
+    context = FrameContext()
+    context.angle = 0.5
+    context.capture_time = perf_counter() - 0.03
+    controller.process(context)
+
+    assert controller.angles == [0.5]
+    assert context.data_to_send['angle'] == 0.5
+    assert context.data_to_send['latency'] >= 30
+
+
+def create_vjoy_controller(backend, threaded_output='1'):
+    controller = VjoyController(backend=backend)
+    # Pass the angles through unchanged.
+    controller.smoothing.value = '0'
+    controller.max_rate.value = '0'
+    controller.latency_compensation.value = '0'
+    controller.threaded_output.value = threaded_output
+    return controller
+
+
+def send_angles(controller, angles):
+    context = FrameContext()
+    for angle in angles:
+        context.angle = angle
+        controller.process(context)
+
+
+def test_controller_opens_backend_once_and_skips_deadband():
+    backend = FakeControllerBackend()
+    controller = create_vjoy_controller(backend, threaded_output='0')
+    controller.deadband.value = '0.01'
+    controller.start()
+    assert backend.is_open
+
+    send_angles(controller, [0, 0.005, 0.02, 0.025, -0.5])
+    controller.stop()
+
+    assert not backend.is_open
+    assert backend.values == [0, 0.02, -0.5]
+
+
+def test_lazy_start_keeps_first_angle_in_filter():
+    backend = FakeControllerBackend()
+    controller = create_vjoy_controller(backend, threaded_output='0')
+    controller.smoothing.value = '0.5'
+
+    # Not started, the first frame opens the backend.
+    send_angles(controller, [0, 1])
+    controller.stop()
+
+    assert backend.values == [0, 0.5]
+
+
+def test_slow_backend_does_not_stall_controller():
+    backend = FakeControllerBackend(write_delay=0.05)
+    controller = create_vjoy_controller(backend)
+    controller.start()
+    output = controller.output
+
+    start = perf_counter()
+    send_angles(controller, [i / 10 for i in range(10)])
+    assert perf_counter() - start < 0.05
+
+    controller.stop()
+    # Overtaken values get dropped, but the newest one is always written.
+    assert backend.values[-1] == 0.9
+    assert output.written_values == len(backend.values)
+    assert output.written_values + output.dropped_values == 10
+
+
+def test_output_keeps_writing_after_backend_errors():
+    class FailingBackend(FakeControllerBackend):
+        def set_axis(self, value):
+            if value < 0:
+                raise OSError('Device lost.')
+            super().set_axis(value)
+
+    backend = FailingBackend()
+    output = ControllerOutput(backend)
+    output.start()
+    output.write(-1)
+    output.stop()
+    output.start()
+    output.write(1)
+    output.stop()
+
+    assert backend.values == [1]
+
+
+def test_vjoy_backend_scales_axis():
+    calls = []
+
+    class VJoyDevice:
+        def __init__(self, device_id):
+            calls.append(('open', device_id))
+
+        def reset(self):
+            calls.append(('reset',))
+
+        def set_axis(self, axis, value):
+            calls.append(('set_axis', axis, value))
+
+    backend = VjoyBackend(SimpleNamespace(VJoyDevice=VJoyDevice, HID_USAGE_X=0x30), 1)
+    backend.open()
+    for value in (-1, 0, 1):
+        backend.set_axis(value)
+
+    assert calls == [('open', 1), ('reset',), ('set_axis', 0x30, 0), ('set_axis', 0x30, 16384),
+                     ('set_axis', 0x30, 32768)]
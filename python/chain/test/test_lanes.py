@@ -0,0 +1,174 @@
+from time import perf_counter
+import cv2
+import numpy as np
+import pytest
+from benchmarks.standins import create_road_frame
+from chain import lanes
+from chain.builtin import FrameContext
+from chain.capturing import ReplayDevice
+from chain.processing import CVLaneDetectionProcessingUnit, DownscalePreProcessingUnit
+from chain.recording import FrameRecordingWriter
+
+WIDTH, HEIGHT = 1920, 1080
+LANE_OFFSETS = (-192, -96, 0, 96, 192)
+
+
+@pytest.fixture(scope='module')
+def recording_path(tmp_path_factory):
+    """
+    Recording of grayscale road frames with the lane offsets of LANE_OFFSETS.
+    """
+    path = tmp_path_factory.mktemp('lanes') / 'road'
+    writer = FrameRecordingWriter(path)
+    for timestamp, lane_offset in enumerate(LANE_OFFSETS):
+        frame = create_road_frame(WIDTH, HEIGHT, lane_offset=lane_offset, seed=timestamp)
+        writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY), float(timestamp))
+    writer.close()
+
+    return path
+
+
+def replay(recording_path):
+    device = ReplayDevice(str(recording_path))
+    context = FrameContext()
+    for _ in LANE_OFFSETS:
+        device.process(context)
+        yield context
+
+
+def test_lanes_are_found_at_recorded_positions(recording_path):
+    unit = CVLaneDetectionProcessingUnit()
+    angles = []
+    for lane_offset, context in zip(LANE_OFFSETS, replay(recording_path)):
+        context.preview_scale = 0.5
+        unit.process(context)
+
+        detection = unit.detection
+        assert detection.has_lanes()
+        assert abs(np.polyval(detection.left_fit, HEIGHT - 1) - (WIDTH * 0.2 + lane_offset)) < 5
+        assert abs(np.polyval(detection.right_fit, HEIGHT - 1) - (WIDTH * 0.8 + lane_offset)) < 5
+        assert 'lanes' in context.preview_frames
+        angles.append(context.angle)
+
+    # Lanes right of the center steer to the right.
+    assert angles == sorted(angles)
+    assert abs(angles[LANE_OFFSETS.index(0)]) < 0.01
+    assert all(-1 <= angle <= 1 for angle in angles)
+
+
+def test_lanes_of_downscaled_frames_are_sent_in_viewport_coordinates(recording_path):
+    downscale_unit = DownscalePreProcessingUnit()
+    downscale_unit.scale.value = '0.25'
+    unit = CVLaneDetectionProcessingUnit()
+    context = next(replay(recording_path))
+    downscale_unit.process(context)
+    unit.process(context)
+
+    assert unit.detection.shape == (HEIGHT // 4, WIDTH // 4)
+    for side, x in (('left', WIDTH * 0.2), ('right', WIDTH * 0.8)):
+        assert abs(np.polyval(context.data_to_send['lanes'][side], HEIGHT - 1) - (x + LANE_OFFSETS[0])) < 8
+
+
+def test_scale_fit_maps_polynomial_back():
+    fit = np.array([0.002, -0.5, 300])
+    rows = np.array([100, 400, 1000])
+    assert np.allclose(np.polyval(lanes.scale_fit(fit, 0.5), rows), np.polyval(fit, rows * 0.5) / 0.5)
+
+
+def test_missing_lane_is_estimated_with_last_lane_width(recording_path):
+    unit = CVLaneDetectionProcessingUnit()
+    context = next(replay(recording_path))
+    unit.process(context)
+    lane_width_fit = unit.detection.right_fit - unit.detection.left_fit
+
+    # Paint over the right half, so only the left lane is visible.
+    context.frame = context.frame.copy()
+    context.frame[:, WIDTH // 2:] = 80
+    unit.process(context)
+
+    assert np.allclose(unit.detection.right_fit - unit.detection.left_fit, lane_width_fit)
+
+
+def test_no_lanes_keep_straight():
+    unit = CVLaneDetectionProcessingUnit()
+    context = FrameContext()
+    context.frame = np.full((HEIGHT, WIDTH), 80, dtype=np.uint8)
+    unit.process(context)
+
+    assert context.angle == 0
+    assert context.data_to_send['lanes_detected'] is False
+
+
+def test_steering_angle_is_clipped():
+    center_fit = np.array([0, 0, 10 * WIDTH])
+    assert lanes.steering_angle(center_fit, (HEIGHT, WIDTH)) == 1
+    assert lanes.steering_angle(-center_fit, (HEIGHT, WIDTH)) == -1
+
+
+def test_detection_stays_within_time_budget(recording_path):
+    unit = CVLaneDetectionProcessingUnit()
+    unit.overlay.value = '0'
+    # Without tracking every run takes the full search.
+    unit.tracking.value = '0'
+    context = next(replay(recording_path))
+
+    timings = []
+    for _ in range(10):
+        start = perf_counter()
+        unit.process(context)
+        timings.append(perf_counter() - start)
+
+    # The fastest run is the least disturbed by other processes.
+    assert min(timings) < CVLaneDetectionProcessingUnit.TIME_BUDGET
+
+
+def test_tracking_follows_moving_lanes(recording_path):
+    unit = CVLaneDetectionProcessingUnit()
+    unit.smoothing.value = '0'
+    device = ReplayDevice(str(recording_path))
+    context = FrameContext()
+    device.process(context)
+    frame = context.frame
+
+    for shift in range(0, 41, 8):
+        # Shifting the whole frame moves the lanes by shift pixels.
+        context.frame = np.roll(frame, shift, axis=1)
+        unit.process(context)
+        assert abs(np.polyval(unit.detection.left_fit, HEIGHT - 1) - (WIDTH * 0.2 + LANE_OFFSETS[0] + shift)) < 5
+
+    assert unit.full_searches == 1
+    assert unit.tracked_frames == 5
+    assert context.data_to_send['lanes_tracked'] is True
+
+
+def test_tracking_falls_back_to_full_search_after_jump(recording_path):
+    unit = CVLaneDetectionProcessingUnit()
+    contexts = replay(recording_path)
+    # The first and the last recorded frame are 384 pixels apart.
+    unit.process(next(contexts))
+    for context in contexts:
+        last_context = context
+    unit.process(last_context)
+
+    assert unit.full_searches == 2
+    assert unit.tracked_frames == 0
+    assert abs(np.polyval(unit.detection.left_fit, HEIGHT - 1) - (WIDTH * 0.2 + LANE_OFFSETS[-1])) < 5
+
+
+def test_tracking_is_cheaper_than_full_search(recording_path):
+    context = next(replay(recording_path))
+    min_timings = {}
+    for tracking in ('0', '1'):
+        unit = CVLaneDetectionProcessingUnit()
+        unit.overlay.value = '0'
+        unit.tracking.value = tracking
+
+        timings = []
+        # The minimum of enough runs ignores the noise of other processes on a busy machine.
+        for _ in range(30):
+            start = perf_counter()
+            unit.process(context)
+            timings.append(perf_counter() - start)
+        min_timings[tracking] = min(timings)
+
+    assert min_timings['1'] < min_timings['0'] / 2
@@ -0,0 +1,63 @@
+import cv2
+import numpy as np
+import pathlib
+import pytest
+import subprocess
+import sys
+from chain.builtin import FrameContext
+from chain.multiprocess import ProcessChainElement
+from chain.processing import GrayscaleConversionPreProcessingUnit, ROIPreProcessingUnit
+
+
+def process(element, frame) -> FrameContext:
+    context = FrameContext()
+    context.frame = frame
+    element.process(context)
+    return context
+
+
+@pytest.fixture
+def frame():
+    return np.random.default_rng(0).integers(0, 255, (60, 80, 3), dtype=np.uint8)
+
+
+def test_process_chain_element_returns_same_result(frame):
+    element = ProcessChainElement(GrayscaleConversionPreProcessingUnit())
+    element.start()
+    try:
+        for _ in range(2):
+            context = process(element, frame)
+            assert np.array_equal(context.frame, cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY))
+    finally:
+        element.stop()
+
+
+def test_process_chain_element_syncs_settings(frame):
+    roi_unit = ROIPreProcessingUnit()
+    element = ProcessChainElement(roi_unit)
+    try:
+        roi_unit.x1.value, roi_unit.y1.value, roi_unit.x2.value, roi_unit.y2.value = '10', '5', '30', '25'
+        context = FrameContext()
+        context.frame = frame
+        context.preview_scale = 1.0
+        element.process(context)
+
+        assert np.array_equal(context.frame, frame[5:25, 10:30])
+        assert np.array_equal(context.preview_frames['roi'], frame[5:25, 10:30])
+    finally:
+        element.stop()
+
+
+def test_process_chain_element_raises_worker_errors():
+    element = ProcessChainElement(GrayscaleConversionPreProcessingUnit())
+    try:
+        with pytest.raises(cv2.error):
+            process(element, np.zeros((4, 4, 2), dtype=np.uint8))
+    finally:
+        element.stop()
+
+
+def test_chain_does_not_import_multiprocess():
+    # chain.multiprocess needs Python 3.8, chain must import without it as long as no element runs in a process.
+    code = 'import sys, chain; assert "chain.multiprocess" not in sys.modules'
+    subprocess.run([sys.executable, '-c', code], check=True, cwd=pathlib.Path(__file__).parents[2])
@@ -0,0 +1,144 @@
+import asyncio
+from threading import Event
+from time import sleep
+import numpy as np
+import pytest
+from chain import ProcessingChain
+from chain.builtin import ChainElement, FrameContext
+from chain.capturing import CapturingDevice, ThreadedCapturingDevice
+from chain.pipeline import StageQueue
+from settingstree import Settings
+
+
+class CountingElement(ChainElement):
+    def __init__(self):
+        super().__init__()
+        self.frame_number = 0
+
+    def process(self, context: FrameContext):
+        self.frame_number += 1
+        context.frame = self.frame_number
+
+
+class DoublingElement(ChainElement):
+    def process(self, context: FrameContext):
+        context.frame *= 2
+        context.data_to_send['number'] = context.frame
+
+
+class NumberChain(ProcessingChain):
+    platform = None
+
+    def __init__(self, settings):
+        super().__init__(settings)
+
+        self.register(CountingElement())
+        self.register(DoublingElement())
+
+
+class SharedMemoryDevice(CapturingDevice):
+    """
+    Writes every capture into the same array, like XShmDevice.
+    """
+    REUSES_FRAME_MEMORY = True
+
+    def __init__(self):
+        super().__init__()
+        self.capture_count = 0
+        self.memory = np.zeros((4, 4), dtype=np.uint32)
+
+    def process(self, context: FrameContext):
+        self.capture_count += 1
+        self.memory[:] = self.capture_count
+        context.capture_time = self.capture_count
+        context.frame = self.memory
+        self._keep_frame(context)
+
+
+class SlowCheckingElement(ChainElement):
+    def process(self, context: FrameContext):
+        sleep(0.002)
+        context.data_to_send['frame_capture'] = int(context.frame[0, 0])
+        context.data_to_send['capture_time'] = context.capture_time
+
+
+class CaptureChain(ProcessingChain):
+    platform = None
+
+    def __init__(self, settings, capturing_device):
+        super().__init__(settings)
+
+        self.register(capturing_device)
+        self.register(SlowCheckingElement())
+
+
+def test_stage_queue_drop_oldest_keeps_newest_items():
+    stage_queue = StageQueue(maxsize=2, drop_policy='drop_oldest')
+    stop_event = Event()
+    for item in range(5):
+        stage_queue.put(item, stop_event)
+
+    assert stage_queue.dropped_items == 3
+    assert [stage_queue.get(stop_event), stage_queue.get(stop_event)] == [3, 4]
+
+
+def test_stage_queue_drop_newest_keeps_oldest_items():
+    stage_queue = StageQueue(maxsize=2, drop_policy='drop_newest')
+    stop_event = Event()
+    for item in range(5):
+        stage_queue.put(item, stop_event)
+
+    assert stage_queue.dropped_items == 3
+    assert [stage_queue.get(stop_event), stage_queue.get(stop_event)] == [0, 1]
+
+
+def test_pipelined_chain_keeps_frame_order():
+    chain = NumberChain(Settings())
+    chain.execution_mode.value = 'pipelined'
+    chain.start()
+    try:
+        results = [dict(chain.run().data_to_send) for _ in range(20)]
+    finally:
+        chain.stop()
+
+    assert results == [{'number': number * 2} for number in range(1, 21)]
+    assert chain.get_timing_stats()['frame']['count'] == 20
+
+
+def test_sequential_chain():
+    chain = NumberChain(Settings())
+    chain.start()
+    assert chain.run().data_to_send == {'number': 2}
+    assert chain.run().data_to_send == {'number': 4}
+    chain.stop()
+
+
+def test_async_chain():
+    chain = NumberChain(Settings())
+    chain.execution_mode.value = 'async'
+
+    async def run_twice():
+        return [dict((await chain.run_async()).data_to_send) for _ in range(2)]
+
+    chain.start()
+    try:
+        assert asyncio.run(run_twice()) == [{'number': 2}, {'number': 4}]
+    finally:
+        chain.stop()
+
+
+@pytest.mark.parametrize('wrapped', [False, True])
+def test_pipelined_chain_keeps_frames_of_memory_reusing_devices(wrapped):
+    capturing_device = SharedMemoryDevice()
+    if wrapped:
+        capturing_device = ThreadedCapturingDevice(capturing_device, threaded=False)
+    chain = CaptureChain(Settings(), capturing_device)
+    chain.execution_mode.value = 'pipelined'
+    chain.start()
+    try:
+        results = [dict(chain.run().data_to_send) for _ in range(20)]
+    finally:
+        chain.stop()
+
+    for result in results:
+        assert result['frame_capture'] == result['capture_time']
@@ -0,0 +1,166 @@
+import time
+from threading import Event
+import cv2
+import numpy as np
+from settingstree import Settings
+from chain import ProcessingChain
+from chain import preview
+from chain.builtin import ChainElement, FrameContext
+from chain.preview import PreviewScheduler, PreviewEncoder, create_preview_frame, pack_preview, PREVIEW_TYPES
+
+
+def scheduled_frames(scheduler, frame_times):
+    context = FrameContext()
+    scheduled = []
+    for frame_time in frame_times:
+        scheduler.schedule(context, now=frame_time)
+        if context.preview_scale is not None:
+            scheduled.append(frame_time)
+    return scheduled
+
+
+class PreviewElement(ChainElement):
+    def process(self, context: FrameContext):
+        if context.preview_scale is not None:
+            context.preview_frames['full'] = create_preview_frame(np.zeros((40, 60, 3), dtype=np.uint8),
+                                                                  context.preview_scale)
+
+
+class PreviewChain(ProcessingChain):
+    platform = None
+
+    def __init__(self, settings):
+        super().__init__(settings)
+
+        self.register(PreviewElement())
+
+
+def test_no_previews_without_subscribers():
+    scheduler = PreviewScheduler(fps=0)
+    assert scheduled_frames(scheduler, [0, 1, 2]) == []
+
+
+def test_previews_are_rate_limited():
+    scheduler = PreviewScheduler(fps=10, scale=0.5)
+    scheduler.add_subscriber()
+    # One second at 60 fps.
+    frame_times = [i / 60 for i in range(60)]
+
+    assert len(scheduled_frames(scheduler, frame_times)) == 10
+
+
+def test_previews_resume_without_burst_after_pause():
+    scheduler = PreviewScheduler(fps=10)
+    scheduler.add_subscriber()
+    scheduled_frames(scheduler, [0, 0.1])
+    scheduler.remove_subscriber()
+    scheduled_frames(scheduler, [i / 60 for i in range(60, 300)])
+    scheduler.add_subscriber()
+
+    scheduled = scheduled_frames(scheduler, [i / 60 for i in range(300, 330)])
+    assert len(scheduled) == 5
+    assert np.all(np.diff(scheduled) >= 0.09)
+
+
+def test_create_preview_frame_returns_new_array():
+    frame = np.zeros((100, 200, 3), dtype=np.uint8)
+
+    assert create_preview_frame(frame, 0.25).shape == (25, 50, 3)
+    preview_frame = create_preview_frame(frame, 1.0)
+    frame[:] = 255
+    assert not preview_frame.any()
+
+
+def test_encoder_drops_waiting_frames_of_same_type():
+    encoder = PreviewEncoder()
+    # Not started, so all frames wait.
+    for value in (0, 100, 200):
+        encoder.submit('full', np.full((10, 20, 3), value, dtype=np.uint8))
+    encoder.submit('roi', np.zeros((5, 5, 3), dtype=np.uint8))
+
+    assert encoder.get_queue_depth() == 2
+    assert encoder.get_stats()['dropped_previews'] == 2
+
+
+def test_encoder_encodes_latest_frame_in_background():
+    encoder = PreviewEncoder(worker_count=2)
+    encoder.submit('full', np.zeros((10, 20, 3), dtype=np.uint8))
+    encoder.submit('full', np.full((10, 20, 3), 200, dtype=np.uint8))
+    encoder.start()
+    try:
+        previews = {}
+        for _ in range(200):
+            previews.update(encoder.collect())
+            if previews:
+                break
+            time.sleep(0.01)
+
+        preview = cv2.imdecode(np.frombuffer(previews['full'], dtype=np.uint8), cv2.IMREAD_COLOR)
+        assert preview.shape == (10, 20, 3)
+        assert abs(int(preview.mean()) - 200) < 5
+        stats = encoder.get_stats()
+        assert (stats['encoded_previews'], stats['dropped_previews'], stats['queue_depth']) == (1, 1, 0)
+    finally:
+        encoder.stop()
+
+
+def test_pack_preview_prepends_type():
+    message = pack_preview('roi', b'\xff\xd8jpeg')
+
+    assert message[0] == PREVIEW_TYPES['roi']
+    assert message[1:] == b'\xff\xd8jpeg'
+
+
+def wait_for(condition):
+    for _ in range(200):
+        if condition():
+            return
+        time.sleep(0.01)
+    raise TimeoutError
+
+
+def test_encoder_discards_older_preview_finishing_after_newer_one(monkeypatch):
+    old_frame_started, release_old_frame = Event(), Event()
+
+    def encode(frame):
+        if not frame.any():
+            old_frame_started.set()
+            release_old_frame.wait(2)
+        return bytes([int(frame[0, 0, 0])])
+
+    monkeypatch.setattr(preview, 'encode_frame_to_jpeg', encode)
+    encoder = PreviewEncoder(worker_count=2)
+    encoder.start()
+    try:
+        encoder.submit('full', np.zeros((2, 2, 3), dtype=np.uint8))
+        assert old_frame_started.wait(2)
+        encoder.submit('full', np.full((2, 2, 3), 200, dtype=np.uint8))
+        wait_for(lambda: encoder.encoded_previews == 1)
+        assert encoder.collect() == {'full': bytes([200])}
+
+        release_old_frame.set()
+        wait_for(lambda: encoder.encoded_previews == 2)
+        assert encoder.collect() == {}
+        assert encoder.dropped_previews == 1
+    finally:
+        release_old_frame.set()
+        encoder.stop()
+
+
+def test_chain_attaches_encoded_previews_to_later_frames():
+    chain = PreviewChain(Settings())
+    chain.preview_fps.value = '0'
+    chain.preview_scheduler.add_subscriber()
+    chain.start()
+    try:
+        previews = {}
+        for _ in range(200):
+            previews.update(chain.run().previews)
+            if previews:
+                break
+            time.sleep(0.01)
+
+        assert cv2.imdecode(np.frombuffer(previews['full'], dtype=np.uint8), cv2.IMREAD_COLOR).shape == (20, 30, 3)
+        assert chain.get_timing_stats()['previews']['encoded_previews'] >= 1
+    finally:
+        chain.stop()
@@ -0,0 +1,150 @@
+import cv2
+import numpy as np
+import pytest
+from chain import optimizer
+from chain.builtin import FrameContext
+from chain.processing import ColorConversionPreProcessingUnit, GrayscaleConversionPreProcessingUnit, \
+    ROIPreProcessingUnit, DownscalePreProcessingUnit
+from chain.tools import OutputBuffers
+
+
+def process(element, frame) -> FrameContext:
+    context = FrameContext()
+    context.frame = frame
+    element.process(context)
+    return context
+
+
+def create_roi_unit(x1, y1, x2, y2):
+    roi_unit = ROIPreProcessingUnit()
+    roi_unit.x1.value, roi_unit.y1.value, roi_unit.x2.value, roi_unit.y2.value = x1, y1, x2, y2
+    return roi_unit
+
+
+@pytest.mark.parametrize('scale, shape', [('0.5', (540, 960)), ('0.25', (270, 480)), ('0.4', (432, 768)),
+                                          ('1', (1080, 1920))])
+def test_downscale_shrinks_frame_and_tracks_scale(scale, shape):
+    unit = DownscalePreProcessingUnit()
+    unit.scale.value = scale
+    context = FrameContext()
+    context.frame = np.random.default_rng(0).integers(0, 255, (1080, 1920), dtype=np.uint8)
+    context.scale = 0.5
+    unit.process(context)
+
+    assert context.frame.shape == shape
+    assert context.scale == pytest.approx(0.5 * shape[1] / 1920)
+
+
+def test_downscale_pyramid_matches_area_interpolation():
+    frame = np.random.default_rng(0).integers(0, 255, (1080, 1920, 3), dtype=np.uint8)
+    unit = DownscalePreProcessingUnit()
+    context = FrameContext()
+
+    for scale, size in (('0.5', (960, 540)), ('0.25', (480, 270))):
+        unit.scale.value = scale
+        context.reset()
+        context.frame = frame
+        unit.process(context)
+
+        expected = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        assert np.abs(context.frame.astype(int) - expected).max() <= 1
+
+
+def test_roi_bbox_requires_complete_viewport():
+    assert create_roi_unit('10', '20', '110', '70').get_bbox() == (10, 20, 110, 70)
+    assert create_roi_unit('10', '20', '', '70').get_bbox() is None
+    assert create_roi_unit('110', '20', '10', '70').get_bbox() is None
+
+
+def test_roi_crops_full_frame():
+    frame = np.arange(200 * 300 * 3, dtype=np.uint8).reshape((200, 300, 3))
+    roi_frame = process(create_roi_unit('10', '20', '110', '70'), frame).frame
+
+    assert np.array_equal(roi_frame, frame[20:70, 10:110])
+
+
+def test_roi_skips_already_cropped_frame():
+    frame = np.zeros((50, 100, 3), dtype=np.uint8)
+    context = FrameContext()
+    context.frame, context.capture_bbox = frame, (10, 20, 110, 70)
+    create_roi_unit('10', '20', '110', '70').process(context)
+
+    assert context.frame is frame
+
+
+def test_roi_crops_frame_grabbed_with_older_viewport():
+    frame = np.arange(50 * 100 * 3, dtype=np.uint8).reshape((50, 100, 3))
+    # The viewport got edited after the frame of the old viewport was grabbed.
+    roi_unit = create_roi_unit('30', '30', '80', '60')
+    context = FrameContext()
+    context.frame, context.capture_bbox = frame, (10, 20, 110, 70)
+    roi_unit.process(context)
+    assert np.array_equal(context.frame, frame[10:40, 20:70])
+
+    # A viewport outside of the grabbed area leaves the frame as it is until the next grab.
+    roi_unit.x1.value, roi_unit.x2.value = '500', '600'
+    context.frame = frame
+    roi_unit.process(context)
+    assert context.frame is frame
+
+
+@pytest.mark.parametrize('preview_scale', [None, 1.0, 0.5])
+@pytest.mark.parametrize('conversion, channels', [(cv2.COLOR_BGR2RGB, 3), (cv2.COLOR_BGRA2BGR, 4)])
+def test_fused_grayscale_roi_matches_single_elements(conversion, channels, preview_scale):
+    frame = np.random.default_rng(0).integers(0, 255, (120, 160, channels), dtype=np.uint8)
+    roi_unit = create_roi_unit('10', '20', '110', '70')
+    elements = [ColorConversionPreProcessingUnit(conversion), roi_unit, GrayscaleConversionPreProcessingUnit()]
+
+    context = FrameContext()
+    context.frame = frame
+    context.preview_scale = preview_scale
+    for element in elements:
+        element.process(context)
+
+    fused_elements = optimizer.optimize(elements)
+    assert len(fused_elements) == 1
+    fused_context = FrameContext()
+    fused_context.frame = frame
+    fused_context.preview_scale = preview_scale
+    fused_elements[0].process(fused_context)
+
+    assert np.array_equal(fused_context.frame, context.frame)
+    assert fused_context.data_to_send == context.data_to_send
+    assert fused_context.preview_frames.keys() == context.preview_frames.keys()
+    for preview_type, preview_frame in context.preview_frames.items():
+        assert np.array_equal(fused_context.preview_frames[preview_type], preview_frame)
+    assert ('roi' in context.preview_frames) == (preview_scale is not None)
+
+
+def test_optimizer_keeps_unknown_sequences():
+    elements = [ColorConversionPreProcessingUnit(cv2.COLOR_GRAY2BGR), ROIPreProcessingUnit(),
+                GrayscaleConversionPreProcessingUnit()]
+
+    assert optimizer.optimize(elements) == elements
+
+
+def test_output_buffers_are_reused_until_shape_changes():
+    output_buffers = OutputBuffers()
+    first = output_buffers.get((4, 4))
+
+    assert output_buffers.get((4, 4)) is first
+    assert output_buffers.get((4, 5)) is not first
+
+
+def test_output_buffers_rotate_with_depth():
+    output_buffers = OutputBuffers()
+    arrays = [output_buffers.get((4, 4), depth=2) for _ in range(3)]
+
+    assert arrays[0] is not arrays[1]
+    assert arrays[2] is arrays[0]
+
+
+def test_grayscale_conversion_writes_into_preallocated_buffer():
+    frame = np.random.default_rng(0).integers(0, 255, (20, 30, 3), dtype=np.uint8)
+    grayscale_unit = GrayscaleConversionPreProcessingUnit()
+
+    first = process(grayscale_unit, frame).frame
+    second = process(grayscale_unit, frame).frame
+
+    assert second is first
+    assert np.array_equal(second, cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY))
@@ -0,0 +1,31 @@
+from chain.profiling import ChainProfiler, RollingTimings
+
+
+def test_rolling_timings_only_keeps_window():
+    timings = RollingTimings(size=4)
+    for duration in (1.0, 0.001, 0.002, 0.003, 0.004):
+        timings.add(duration)
+
+    stats = timings.get_stats()
+    assert stats['count'] == 4
+    assert stats['max'] == 4.0
+    assert stats['p50'] == 2.5
+
+
+def test_rolling_timings_empty_stats():
+    assert RollingTimings().get_stats()['p99'] == 0.0
+
+
+def test_chain_profiler_collects_elements_and_frames():
+    profiler = ChainProfiler(window_size=10)
+    for _ in range(3):
+        profiler.add_element_timing('capture', 0.01)
+        profiler.add_frame_timing(0.02)
+
+    stats = profiler.get_stats()
+    assert stats['elements']['capture']['count'] == 3
+    assert stats['frame']['mean'] == 20.0
+    assert stats['frame']['fps'] > 0
+
+    profiler.reset()
+    assert profiler.get_stats()['elements'] == {}
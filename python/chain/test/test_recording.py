@@ -0,0 +1,118 @@
+import cv2
+import numpy as np
+import pytest
+from chain import CVChainLinux
+from chain.builtin import FrameContext
+from chain.capturing import ReplayDevice, PIXEL_FORMAT_BGRA, PIXEL_FORMAT_RGB
+from chain.recording import FrameRecorder, FrameRecordingReader, FrameRecordingWriter
+from settingstree import Settings
+
+
+def create_frames():
+    return [np.full((4, 6, 3), i, dtype=np.uint8) for i in range(3)] + [np.zeros((2, 2), dtype=np.uint16)]
+
+
+def test_writer_and_reader_round_trip(tmp_path):
+    frames = create_frames()
+    writer = FrameRecordingWriter(tmp_path / 'session')
+    for timestamp, frame in enumerate(frames):
+        writer.write(frame, float(timestamp))
+    writer.close()
+
+    reader = FrameRecordingReader(tmp_path / 'session')
+    assert len(reader) == len(frames)
+    for timestamp, (frame, (read_frame, read_timestamp)) in enumerate(zip(frames, reader)):
+        assert read_timestamp == timestamp
+        assert read_frame.dtype == frame.dtype
+        assert np.array_equal(read_frame, frame)
+
+
+def test_recorder_passes_frames_through_and_records(tmp_path):
+    recorder = FrameRecorder()
+    recorder.recording_path.value = str(tmp_path / 'session')
+
+    context = FrameContext()
+    for frame in create_frames()[:3]:
+        context.frame = frame
+        recorder.process(context)
+        assert context.frame is frame
+    recorder.stop()
+
+    assert recorder.dropped_frames == 0
+    assert [frame[0, 0, 0] for frame, _ in FrameRecordingReader(tmp_path / 'session')] == [0, 1, 2]
+
+
+def test_recorder_ignores_invalid_path(tmp_path):
+    (tmp_path / 'file').touch()
+    recorder = FrameRecorder()
+    recorder.recording_path.value = str(tmp_path / 'file' / 'session')
+
+    context = FrameContext()
+    context.frame = create_frames()[0]
+    recorder.process(context)
+    assert context.frame is not None
+    assert not recorder.is_recording()
+    recorder.stop()
+
+
+def test_recorder_stops_after_writer_error(tmp_path, monkeypatch):
+    def fail(*args, **kwargs):
+        raise OSError('Disk full')
+
+    monkeypatch.setattr(FrameRecordingWriter, 'write', fail)
+    recorder = FrameRecorder()
+    recorder.QUEUE_SIZE = 1
+    recorder.recording_path.value = str(tmp_path / 'session')
+
+    context = FrameContext()
+    context.frame = create_frames()[0]
+    recorder.process(context)
+    recorder._writer_thread.join(1)
+    # Fills the queue of the stopped writer.
+    recorder.process(context)
+    recorder.process(context)
+    assert recorder.dropped_frames == 1
+
+    recorder.stop()
+    assert not recorder.is_recording()
+
+
+def test_replay_device_loops_recording(tmp_path):
+    writer = FrameRecordingWriter(tmp_path / 'session')
+    for frame in create_frames()[:2]:
+        writer.write(frame, 0.0)
+    writer.close()
+
+    device = ReplayDevice(str(tmp_path / 'session'))
+    context = FrameContext()
+    frame_values = []
+    for _ in range(3):
+        device.process(context)
+        frame_values.append(context.frame[0, 0, 0])
+    assert frame_values == [0, 1, 0]
+
+    device.loop.value = '0'
+    device.process(context)
+    with pytest.raises(EOFError):
+        device.process(context)
+
+
+def test_replay_uses_color_conversion_of_recorded_device(tmp_path):
+    recorder = FrameRecorder(PIXEL_FORMAT_BGRA)
+    recorder.recording_path.value = str(tmp_path / 'session')
+    context = FrameContext()
+    context.frame = np.zeros((4, 6, 4), dtype=np.uint8)
+    recorder.process(context)
+    recorder.stop()
+
+    device = ReplayDevice(str(tmp_path / 'session'))
+    assert device.get_pixel_format() == PIXEL_FORMAT_BGRA
+    chain = CVChainLinux(Settings(), capturing_device=device)
+    assert chain.chain_elements[2].conversion == cv2.COLOR_BGRA2BGR
+
+
+def test_unconfigured_replay_device_uses_default_pixel_format():
+    device = ReplayDevice()
+    assert device.get_pixel_format() == PIXEL_FORMAT_RGB
+    chain = CVChainLinux(Settings(), capturing_device=device)
+    assert chain.chain_elements[2].conversion == cv2.COLOR_RGB2BGR
@@ -0,0 +1,53 @@
+from time import perf_counter, sleep
+import asyncio
+from chain.scheduling import FrameRateGovernor
+
+
+def test_governor_limits_frame_rate():
+    governor = FrameRateGovernor(target_fps=100)
+    start = perf_counter()
+    for _ in range(11):
+        governor.tick()
+
+    assert perf_counter() - start >= 10 / 100
+    assert governor.missed_deadlines == 0
+
+
+def test_governor_counts_missed_deadlines():
+    governor = FrameRateGovernor(target_fps=1000)
+    governor.tick()
+    for _ in range(3):
+        sleep(0.005)
+        governor.tick()
+
+    assert governor.missed_deadlines == 3
+
+
+def test_adaptive_governor_stretches_period():
+    governor = FrameRateGovernor(target_fps=1000, adaptive=True)
+    governor.average_work_time = 0.01
+
+    assert governor.get_period() == 0.01 * FrameRateGovernor.ADAPTIVE_HEADROOM
+
+
+def test_governor_without_limit_does_not_wait():
+    governor = FrameRateGovernor()
+    start = perf_counter()
+    for _ in range(100):
+        governor.tick()
+
+    assert perf_counter() - start < 0.05
+    assert governor.get_stats()['effective_fps'] == 0.0
+
+
+def test_governor_tick_async_limits_frame_rate():
+    governor = FrameRateGovernor(target_fps=200)
+
+    async def tick_repeatedly():
+        for _ in range(11):
+            await governor.tick_async()
+
+    start = perf_counter()
+    asyncio.run(tick_repeatedly())
+
+    assert perf_counter() - start >= 10 / 200
@@ -0,0 +1,58 @@
+import json
+import pytest
+from chain.telemetry import TelemetryState, negotiate_subprotocol, get_encoding, is_encoding_available
+
+
+def test_only_changed_fields_are_sent():
+    state = TelemetryState()
+    state.update({'angle': 0.1, 'lanes_detected': True})
+    assert json.loads(state.get_message()) == {'angle': 0.1, 'lanes_detected': True}
+
+    state.update({'angle': 0.2, 'lanes_detected': True})
+    assert json.loads(state.get_message()) == {'angle': 0.2}
+
+    state.update({'angle': 0.2, 'lanes_detected': True})
+    assert state.get_message() is None
+
+
+def test_frames_waiting_for_the_client_get_merged():
+    state = TelemetryState()
+    state.update({'angle': 0.1, 'latency': 5})
+    state.update({'angle': 0.3, 'lanes': {'left': None}})
+
+    assert json.loads(state.get_message()) == {'angle': 0.3, 'latency': 5, 'lanes': {'left': None}}
+    assert state.coalesced_updates == 1
+    assert not state.has_updates()
+
+
+def test_subscribing_sends_all_subscribed_fields_again():
+    state = TelemetryState()
+    state.update({'angle': 0.1, 'latency': 5, 'lanes_detected': True})
+    state.get_message()
+
+    state.subscribe(['angle', 'latency'])
+    assert state.has_updates()
+    assert json.loads(state.get_message()) == {'angle': 0.1, 'latency': 5}
+
+    state.update({'angle': 0.1, 'latency': 5, 'lanes_detected': False})
+    assert state.get_message() is None
+
+
+def test_json_is_the_default_encoding():
+    assert negotiate_subprotocol([]) is None
+    assert negotiate_subprotocol(['chat', 'telemetry.cbor', 'telemetry.json']) == 'telemetry.json'
+    assert get_encoding(None) == 'json'
+
+
+def test_msgpack_encoding():
+    msgpack = pytest.importorskip('msgpack')
+    assert is_encoding_available('msgpack')
+    subprotocol = negotiate_subprotocol(['telemetry.msgpack', 'telemetry.json'])
+    assert subprotocol == 'telemetry.msgpack'
+
+    state = TelemetryState(get_encoding(subprotocol))
+    state.update({'angle': 0.25, 'lanes': {'left': [1.0, 2.0, 3.0], 'right': None}})
+    message = state.get_message()
+
+    assert isinstance(message, bytes)
+    assert msgpack.unpackb(message) == {'angle': 0.25, 'lanes': {'left': [1.0, 2.0, 3.0], 'right': None}}
@@ -1,6 +1,106 @@
-from base64 import b64encode
+from functools import lru_cache
+from threading import Condition
+import numpy as np
 import cv2
 
 
-def encode_frame_to_base64(frame, format='.jpg'):
-    return b64encode(cv2.imencode(format, frame)[1]).decode('utf-8')
+def encode_frame_to_jpeg(frame) -> bytes:
+    return cv2.imencode('.jpg', frame)[1].tobytes()
+
+
+def setting_to_bool(value) -> bool:
+    """
+    Interprets the value of a SettingsNode as boolean. Values from the web ui are strings, so '0', 'false', 'off' and
+    empty strings count as False.
+    """
+    if isinstance(value, str):
+        return value.strip().lower() not in ('', '0', 'false', 'no', 'off')
+
+    return bool(value)
+
+
+class LatestFrameBuffer:
+    """
+    Small ring buffer with "latest frame wins" semantics. The writer never blocks and overwrites the oldest slot,
+    readers always get the newest item.
+    """
+    def __init__(self, size=2):
+        if size < 1:
+            raise ValueError('size needs to be at least 1.')
+
+        self._slots = [None] * size
+        self._item_count = 0
+        self._condition = Condition()
+
+    @property
+    def item_count(self) -> int:
+        """
+        Number of items written to the buffer so far.
+        """
+        return self._item_count
+
+    def put(self, item):
+        with self._condition:
+            self._slots[self._item_count % len(self._slots)] = item
+            self._item_count += 1
+            self._condition.notify_all()
+
+    def get_latest(self, timeout=None):
+        """
+        Returns a tuple (item number, item) of the newest item. Only blocks if nothing has been written yet.
+        :param timeout: Seconds to wait for the first item. None waits forever.
+        :raises TimeoutError: if no item arrived in time.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._item_count > 0, timeout):
+                raise TimeoutError('No item was written to the buffer in time.')
+
+            item_number = self._item_count - 1
+            return item_number, self._slots[item_number % len(self._slots)]
+
+    def clear(self):
+        with self._condition:
+            self._slots = [None] * len(self._slots)
+            self._item_count = 0
+
+
+class OutputBuffers:
+    """
+    Preallocated output arrays of a chain element. The arrays only get reallocated if the requested shape, dtype or
+    depth changes.
+    With a depth of n the element rotates through n arrays, so an output stays valid while the next n-1 frames are
+    written. The ProcessingChain sets ChainElement.output_buffer_depth to the number of frames in flight.
+    """
+    def __init__(self):
+        self._arrays = []
+        self._key = None
+        self._index = 0
+
+    def get(self, shape, dtype=np.uint8, depth=1) -> np.ndarray:
+        key = (tuple(shape), np.dtype(dtype), depth)
+        if key != self._key:
+            self._arrays = [np.empty(shape, dtype=dtype) for _ in range(depth)]
+            self._key = key
+            self._index = 0
+
+        array = self._arrays[self._index]
+        self._index = (self._index + 1) % depth
+        return array
+
+
+@lru_cache(maxsize=None)
+def _get_converted_channels(channels, dtype, conversion):
+    probe = np.zeros((1, 1, channels) if channels else (1, 1), dtype=dtype)
+    converted = cv2.cvtColor(probe, conversion)
+    return converted.shape[2] if converted.ndim == 3 else 0
+
+
+def convert_color(frame, conversion, output_buffers: OutputBuffers, depth=1) -> np.ndarray:
+    """
+    cv2.cvtColor which writes into a preallocated array of output_buffers instead of allocating a new one.
+    """
+    channels = frame.shape[2] if frame.ndim == 3 else 0
+    converted_channels = _get_converted_channels(channels, frame.dtype.str, conversion)
+    shape = frame.shape[:2] + ((converted_channels,) if converted_channels else ())
+
+    return cv2.cvtColor(frame, conversion, dst=output_buffers.get(shape, frame.dtype, depth))
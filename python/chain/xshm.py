@@ -0,0 +1,245 @@
+"""
+Minimal ctypes bindings for grabbing the X11 screen through the MIT-SHM extension.
+The X server writes the pixels directly into a shared memory segment which is exposed as numpy array without copying.
+"""
+import ctypes
+import ctypes.util
+import os
+import numpy as np
+
+ZPIXMAP = 2
+ALL_PLANES = ctypes.c_ulong(~0).value
+IPC_PRIVATE = 0
+IPC_CREAT = 0o1000
+IPC_RMID = 0
+
+
+class XImage(ctypes.Structure):
+    _fields_ = [
+        ('width', ctypes.c_int),
+        ('height', ctypes.c_int),
+        ('xoffset', ctypes.c_int),
+        ('format', ctypes.c_int),
+        ('data', ctypes.c_void_p),
+        ('byte_order', ctypes.c_int),
+        ('bitmap_unit', ctypes.c_int),
+        ('bitmap_bit_order', ctypes.c_int),
+        ('bitmap_pad', ctypes.c_int),
+        ('depth', ctypes.c_int),
+        ('bytes_per_line', ctypes.c_int),
+        ('bits_per_pixel', ctypes.c_int),
+        ('red_mask', ctypes.c_ulong),
+        ('green_mask', ctypes.c_ulong),
+        ('blue_mask', ctypes.c_ulong),
+        ('obdata', ctypes.c_void_p),
+        # struct funcs
+        ('create_image', ctypes.c_void_p),
+        ('destroy_image', ctypes.c_void_p),
+        ('get_pixel', ctypes.c_void_p),
+        ('put_pixel', ctypes.c_void_p),
+        ('sub_image', ctypes.c_void_p),
+        ('add_pixel', ctypes.c_void_p),
+    ]
+
+
+class XShmSegmentInfo(ctypes.Structure):
+    _fields_ = [
+        ('shmseg', ctypes.c_ulong),
+        ('shmid', ctypes.c_int),
+        ('shmaddr', ctypes.c_void_p),
+        ('readOnly', ctypes.c_int),
+    ]
+
+
+XErrorHandler = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p)
+XDestroyImageFunction = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.POINTER(XImage))
+
+_libraries = {}
+
+
+def _load_libraries():
+    """
+    Loads libX11, libXext and libc once and declares the used function signatures.
+    :raises OSError: if a library can not be found.
+    """
+    if _libraries:
+        return _libraries
+
+    for name in ('X11', 'Xext', 'c'):
+        path = ctypes.util.find_library(name)
+        if not path:
+            raise OSError(f'Library {name} not found.')
+        _libraries[name] = ctypes.CDLL(path, use_errno=True)
+
+    xlib, xext, libc = _libraries['X11'], _libraries['Xext'], _libraries['c']
+
+    xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+    xlib.XOpenDisplay.restype = ctypes.c_void_p
+    xlib.XCloseDisplay.argtypes = [ctypes.c_void_p]
+    xlib.XDefaultScreen.argtypes = [ctypes.c_void_p]
+    xlib.XRootWindow.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    xlib.XRootWindow.restype = ctypes.c_ulong
+    xlib.XDefaultVisual.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    xlib.XDefaultVisual.restype = ctypes.c_void_p
+    xlib.XDefaultDepth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    xlib.XDisplayWidth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    xlib.XDisplayHeight.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    xlib.XSync.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    xlib.XSetErrorHandler.argtypes = [XErrorHandler]
+    xlib.XSetErrorHandler.restype = ctypes.c_void_p
+
+    xext.XShmQueryExtension.argtypes = [ctypes.c_void_p]
+    xext.XShmCreateImage.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p,
+                                     ctypes.POINTER(XShmSegmentInfo), ctypes.c_uint, ctypes.c_uint]
+    xext.XShmCreateImage.restype = ctypes.POINTER(XImage)
+    xext.XShmAttach.argtypes = [ctypes.c_void_p, ctypes.POINTER(XShmSegmentInfo)]
+    xext.XShmDetach.argtypes = [ctypes.c_void_p, ctypes.POINTER(XShmSegmentInfo)]
+    xext.XShmGetImage.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(XImage), ctypes.c_int,
+                                  ctypes.c_int, ctypes.c_ulong]
+
+    libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+    libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+    libc.shmat.restype = ctypes.c_void_p
+    libc.shmdt.argtypes = [ctypes.c_void_p]
+    libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+
+    return _libraries
+
+
+@XErrorHandler
+def _error_handler(display, event):
+    # The default handler terminates the process. Failing calls are detected through their return values instead.
+    return 0
+
+
+def is_available() -> bool:
+    """
+    Checks cheaply (without connecting) whether a X display and the required libraries are present.
+    """
+    if not os.environ.get('DISPLAY'):
+        return False
+
+    try:
+        _load_libraries()
+    except OSError:
+        return False
+
+    return True
+
+
+class XShmScreenGrabber:
+    """
+    Grabs (a part of) the root window into a shared memory segment.
+
+    The array returned by grab() is a view on the shared memory segment and is only valid until the next call to
+    grab() (which overwrites the pixels in place) or close() (which unmaps the memory). Copy it if you need it longer.
+    The view has the shape (height, width, 4) in BGRA order.
+    """
+    def __init__(self, display_name=None):
+        libraries = _load_libraries()
+        self._xlib, self._xext, self._libc = libraries['X11'], libraries['Xext'], libraries['c']
+        self._xlib.XSetErrorHandler(_error_handler)
+
+        self._display = self._xlib.XOpenDisplay(display_name.encode() if display_name else None)
+        if not self._display:
+            raise OSError('Could not open X display.')
+
+        if not self._xext.XShmQueryExtension(self._display):
+            self._xlib.XCloseDisplay(self._display)
+            self._display = None
+            raise OSError('The X server does not support the MIT-SHM extension.')
+
+        screen = self._xlib.XDefaultScreen(self._display)
+        self._root_window = self._xlib.XRootWindow(self._display, screen)
+        self._visual = self._xlib.XDefaultVisual(self._display, screen)
+        self._depth = self._xlib.XDefaultDepth(self._display, screen)
+        self.screen_size = (self._xlib.XDisplayWidth(self._display, screen),
+                            self._xlib.XDisplayHeight(self._display, screen))
+
+        self._image = None
+        self._segment_info = None
+        self._view = None
+
+    def _create_image(self, width, height):
+        self._destroy_image()
+
+        segment_info = XShmSegmentInfo()
+        image = self._xext.XShmCreateImage(self._display, self._visual, self._depth, ZPIXMAP, None,
+                                           ctypes.byref(segment_info), width, height)
+        if not image:
+            raise OSError('XShmCreateImage failed.')
+
+        if image.contents.bits_per_pixel != 32:
+            XDestroyImageFunction(image.contents.destroy_image)(image)
+            raise OSError(f'Unsupported pixel format with {image.contents.bits_per_pixel} bits per pixel.')
+
+        size = image.contents.bytes_per_line * image.contents.height
+        segment_info.shmid = self._libc.shmget(IPC_PRIVATE, size, IPC_CREAT | 0o600)
+        if segment_info.shmid < 0:
+            XDestroyImageFunction(image.contents.destroy_image)(image)
+            raise OSError(ctypes.get_errno(), 'shmget failed.')
+
+        address = self._libc.shmat(segment_info.shmid, None, 0)
+        if address in (None, ctypes.c_void_p(-1).value):
+            self._libc.shmctl(segment_info.shmid, IPC_RMID, None)
+            XDestroyImageFunction(image.contents.destroy_image)(image)
+            raise OSError(ctypes.get_errno(), 'shmat failed.')
+
+        segment_info.shmaddr = image.contents.data = address
+        segment_info.readOnly = 0
+        attached = self._xext.XShmAttach(self._display, ctypes.byref(segment_info))
+        self._xlib.XSync(self._display, 0)
+        # The segment gets removed as soon as both the X server and we detached from it.
+        self._libc.shmctl(segment_info.shmid, IPC_RMID, None)
+
+        self._image, self._segment_info = image, segment_info
+
+        if not attached:
+            self._destroy_image()
+            raise OSError('XShmAttach failed.')
+
+        buffer = (ctypes.c_uint8 * size).from_address(address)
+        self._view = np.ndarray(shape=(height, width, 4), dtype=np.uint8, buffer=buffer,
+                                strides=(image.contents.bytes_per_line, 4, 1))
+        self._view.flags.writeable = False
+
+    def _destroy_image(self):
+        if self._image is None:
+            return
+
+        self._view = None
+        self._xext.XShmDetach(self._display, ctypes.byref(self._segment_info))
+        self._xlib.XSync(self._display, 0)
+        self._libc.shmdt(self._segment_info.shmaddr)
+        # Only the XImage structure gets freed, the data belongs to the shared memory segment.
+        self._image.contents.data = None
+        XDestroyImageFunction(self._image.contents.destroy_image)(self._image)
+        self._image = None
+        self._segment_info = None
+
+    def grab(self, bbox=None) -> np.ndarray:
+        """
+        Grabs the screen area bbox (x1, y1, x2, y2) or the whole screen if bbox is None.
+        :return: read-only BGRA view on the shared memory. See the class docstring for its lifetime.
+        """
+        if self._display is None:
+            raise OSError('The grabber is already closed.')
+
+        x1, y1, x2, y2 = bbox or (0, 0, *self.screen_size)
+        width, height = x2 - x1, y2 - y1
+
+        if self._image is None or (self._image.contents.width, self._image.contents.height) != (width, height):
+            self._create_image(width, height)
+
+        if not self._xext.XShmGetImage(self._display, self._root_window, self._image, x1, y1, ALL_PLANES):
+            raise OSError('XShmGetImage failed.')
+
+        return self._view
+
+    def close(self):
+        if self._display is None:
+            return
+
+        self._destroy_image()
+        self._xlib.XCloseDisplay(self._display)
+        self._display = None